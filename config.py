@@ -32,14 +32,28 @@ HTML_PATH = DATA + "html/%s.html"
 TOKENS_PATH  = DATA + "tokens/%s.txt"
 TOKENS_PATH_PARTS = DATA + "tokens_parts/%s.txt"
 
+# Packed token stores (see words/token_store.py). They replace the per
+# document files above, which are only kept to import old data.
+TOKENS_STORE = DATA + "tokens_store/"
+TOKENS_STORE_PARTS = DATA + "tokens_store_parts/"
+
 # External tool used to convert PDFs to text and html
 PDFBOX_PATH = "/home/luamct/apps/pdfbox/pdfbox.jar"
 
 INDEX_PATH = DATA + "index_" + DATASET
+# Memory-mapped copies of the paper -> item tables (see ranking.model.load_doc_values).
+# Each one is rebuilt when its table's row count or largest paper id changes.
 CACHE_FOLDER = DATA + "cache/"
 CTXS_VOCAB_PATH = DATA + "contexts_tfidfs_tokens.txt"
 CTX_PATH = DATA + "contexts_tfidfs/%s.txt"
 
+# Sparse TF-IDF matrix of the citation contexts, rows keyed by edge (see words/tfidf.py)
+CTX_TFIDF_PATH = DATA + "contexts_tfidfs_sparse/"
+
+# Same for the contexts stored in the 'graph' table (csx datasets), used by ranking/model.py.
+# Rebuilt when the contexts change (see load_graph_contexts_tfidf).
+GRAPH_CTX_TFIDF_PATH = DATA + "graph_contexts_tfidf_" + DATASET + "/"
+
 #TOKENS_PATH = TOKENS_PATH_PARTS
 
 # Evaluation and ground truth settings
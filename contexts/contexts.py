@@ -7,11 +7,12 @@ from mymysql.mymysql import MyMySQL
 from collections import defaultdict, Counter
 import re
 import nltk
-from utils import progress, tokenize
+from utils import progress, tokenize_many
 import os
 import utils
 import  pylucene
-from config import DB_NAME, DB_USER, DB_PASSWD
+from config import DB_NAME, DB_USER, DB_PASSWD, CTX_TFIDF_PATH
+from words.tfidf import SparseRows
 
 
 
@@ -99,8 +100,8 @@ def tag_contexts(doc_id):
 
 	words = defaultdict(Counter)
 	count = Counter()
-	for context in get_contexts(doc_id) :
-		for word, tag in nltk.pos_tag(tokenize(context)) :
+	for context_tokens in tokenize_many(get_contexts(doc_id)) :
+		for word, tag in nltk.pos_tag(context_tokens) :
 			words[tag].update([word])
 
 			count.update([tag])
@@ -175,25 +176,9 @@ def index_cited_contexts(doc_ids, index_folder, files_folder) :
 			print "%d documents indexed." % i
 
 
-def parse_context_line(line) :
-	tokens_dict = {}
-	doc_id, tokens_tfidf = line.strip().split('\t')
-	for token_tfidf in tokens_tfidf.split():
-		token,tfidf = token_tfidf.split(':')
-		tokens_dict[token] = float(tfidf)
-	
-	return doc_id, tokens_dict
-
-
-def load_contexts_tfidf(folder) :
-
-	tokens_per_citation = {}
-	for fn in progress(os.listdir(folder)) :
-		fp = os.path.join(folder, fn)
-		with open(fp, 'r') as f :
-			for line in f :
-				doc_id, tokens = parse_context_line(line)
-				tokens_per_citation[doc_id] = tokens
-
-	
-	
\ No newline at end of file
+def load_contexts_tfidf(folder=CTX_TFIDF_PATH) :
+	'''
+	Loads the citation contexts' TF-IDF vectors written by words.write_contexts_tfidf. 
+	Rows are memory-mapped and looked up by words.tfidf.edge_key(citing, cited).
+	'''
+	return SparseRows.load(folder)
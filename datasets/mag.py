@@ -16,6 +16,9 @@ from parser.parse_dblp_paf import get_dblp_key_by_author_paper, reg_parse_affil_
 
 db = MyMySQL(config.DB_NAME, user=config.DB_USER, passwd=config.DB_PASSWD)
 
+# Results of get_selected_expand_pubs, kept only once enable_pubs_cache is called
+pubs_cache = None
+
 
 
 def import_selected_affils(file_path, table_name='selected_affils'):
@@ -1296,6 +1299,11 @@ def get_selected_expand_pubs(conf, year, _type="selected", online_search=True):
     else:
         where_cond = None
 
+    # Cached records are shared, callers copy them before making changes
+    cache_key = (table_name, where_cond, online_search)
+    if pubs_cache is not None and cache_key in pubs_cache:
+        return pubs_cache[cache_key]
+
     rst = db.select(['%s.%s'%(table_name, col_id_name), 'paper_author_affils.author_id', 'paper_author_affils.affil_id', '%s.year'%table_name], \
             [table_name, 'paper_author_affils'], join_on=[col_id_name, 'paper_id'], \
             where=where_cond)
@@ -1354,9 +1362,24 @@ def get_selected_expand_pubs(conf, year, _type="selected", online_search=True):
             pub_records[paper_id] = {'author': {author_id: affil_id}, 'year':int(year)}
     print "missing author: %s/%s"%(count, len(author))
     print "get_affil_count: %s"%get_affil_count
+
+    if pubs_cache is not None:
+        pubs_cache[cache_key] = (pub_records, author, affils)
+
     return pub_records, author, affils
 
 
+def enable_pubs_cache():
+    """
+    Keeps the records returned by get_selected_expand_pubs in memory, so the
+    same (conference, years) query is only run once per process. Processes
+    forked afterwards (e.g. evaluation workers) share what was already loaded.
+    """
+    global pubs_cache
+    if pubs_cache is None:
+        pubs_cache = {}
+
+
 
 if __name__ == '__main__':
     # import_papers(config.DATA + 'Papers/Papers.txt')
@@ -0,0 +1,176 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import numpy as np
+
+
+# Value of each relevance label, as in metrics.ndcg
+RELEVS_VALUES = {"R1": 2.0, "R2": 1.0}
+
+# Default relevance of the correct items when none is given
+DEFAULT_RELEV = 2.0
+
+
+# Discount of each rank position, same as metrics.dcg: 1 for the first two
+# positions and 1/log2(i+1) after that. Grown as needed.
+discount_table = np.ones(0)
+
+def discounts(k) :
+	global discount_table
+	if len(discount_table) < k :
+		discount_table = np.ones(k)
+		discount_table[1:] = 1.0/np.log2(np.arange(2, k+1))
+
+	return discount_table[:k]
+
+
+def relevance_values(relevs, n) :
+	''' Relevance labels (or values) as floats, DEFAULT_RELEV if not given. '''
+	if not relevs :
+		return np.repeat(DEFAULT_RELEV, n)
+
+	return np.array([RELEVS_VALUES.get(r, r) if isinstance(r, basestring) else r for r in relevs],
+									dtype=np.float64)
+
+
+def first_occurrences(pred) :
+	'''
+	Mask of the entries of each row that are the first occurrence of their
+	value in the row. A stable sort keeps the earliest position first.
+	'''
+	rows = np.arange(pred.shape[0])[:, np.newaxis]
+	order = np.argsort(pred, axis=1, kind='mergesort')
+	ranked = pred[rows, order]
+
+	dup = np.zeros(pred.shape, dtype=bool)
+	dup[:, 1:] = (ranked[:, 1:] == ranked[:, :-1])
+
+	mask = np.empty(pred.shape, dtype=bool)
+	mask[rows, order] = ~dup
+	return mask
+
+
+class Rankings() :
+	'''
+	Many predicted rankings evaluated at once. Each ranking is a row of 'pred'
+	(runs x k) whose entries are the position of the predicted item in the list
+	of correct items, or -1 if it's not a correct one (or the ranking is shorter
+	than k). 'relev' holds the relevance of the correct items, either one array
+	shared by all runs (e.g. a parameter sweep over one query) or one row per
+	run (e.g. one run per query), padded with zeros. 'ncorrect' is the number
+	of correct items of each run.
+	'''
+
+	def __init__(self, pred, relev, ncorrect) :
+		self.pred = np.asarray(pred, dtype=np.int64)
+		self.k = self.pred.shape[1]
+
+		# A trailing 0 column makes every -1 entry point to a null relevance
+		relev = np.asarray(relev, dtype=np.float64)
+		if relev.ndim == 1 :
+			self.relev = np.append(relev, 0.0)
+			self.gains = self.relev[self.pred]
+		else :
+			self.relev = np.hstack((relev, np.zeros((relev.shape[0], 1))))
+			self.gains = self.relev[np.arange(len(self.pred))[:, np.newaxis], self.pred]
+
+		self.ncorrect = np.broadcast_to(np.asarray(ncorrect, dtype=np.float64), (len(self.pred),))
+
+		# Correct items counted only once per ranking, as in metrics.apk
+		self.hits = (self.pred >= 0) & first_occurrences(self.pred)
+
+
+	@staticmethod
+	def shared(actual, runs, relevs=None, k=20) :
+		'''
+		Rankings of several runs against the same correct items.
+		'''
+		index = {item: i for i, item in enumerate(actual)}
+
+		pred = np.empty((len(runs), k), dtype=np.int64)
+		pred.fill(-1)
+		for i, run in enumerate(runs) :
+			top = [index.get(item, -1) for item in run[:k]]
+			pred[i, :len(top)] = top
+
+		return Rankings(pred, relevance_values(relevs, len(actual)), len(actual))
+
+
+	@staticmethod
+	def queries(results, k=20) :
+		'''
+		Rankings of a list of (correct items, relevances, returned items), each
+		against its own correct items, as saved by the experiments.
+		'''
+		width = max([len(actual) for actual, _relevs, _returned in results] + [1])
+
+		pred = np.empty((len(results), k), dtype=np.int64)
+		relev = np.zeros((len(results), width))
+		ncorrect = np.zeros(len(results))
+		pred.fill(-1)
+
+		for i, (actual, relevs, returned) in enumerate(results) :
+			index = {item: j for j, item in enumerate(actual)}
+			top = [index.get(item, -1) for item in returned[:k]]
+			pred[i, :len(top)] = top
+
+			relev[i, :len(actual)] = relevance_values(relevs, len(actual))
+			ncorrect[i] = len(actual)
+
+		return Rankings(pred, relev, ncorrect)
+
+
+	def cutoff(self, k) :
+		return self.k if k is None else min(k, self.k)
+
+
+	def dcg(self, k=None) :
+		''' Discounted Cummulative Gain of every run. '''
+		k = self.cutoff(k)
+		return self.gains[:, :k].dot(discounts(k))
+
+
+	def ideal_dcg(self, k=None) :
+		''' DCG of the best possible ranking of every run. '''
+		k = self.cutoff(k)
+		if self.relev.ndim == 1 :
+			best = np.sort(self.relev)[::-1][:k]
+			return np.repeat(best.dot(discounts(len(best))), len(self.pred))
+
+		best = -np.sort(-self.relev, axis=1)[:, :k]
+		return best.dot(discounts(best.shape[1]))
+
+
+	def ndcg(self, k=None) :
+		''' Normalized Discounted Cummulative Gain of every run. '''
+		return self.safe_div(self.dcg(k), self.ideal_dcg(k))
+
+
+	def average_precision(self, k=None) :
+		''' AP@k of every run, whose mean over runs is the MAP. '''
+		k = self.cutoff(k)
+		hits = self.hits[:, :k]
+		precisions = np.cumsum(hits, axis=1) / np.arange(1.0, k+1)
+		return self.safe_div((precisions*hits).sum(axis=1), np.minimum(self.ncorrect, k))
+
+
+	def precision(self, k=None) :
+		''' Precision at the top k of every run. '''
+		k = self.cutoff(k)
+		return self.hits[:, :k].sum(axis=1) / float(k)
+
+
+	def recall(self, k=None) :
+		''' Recall at the top k of every run. '''
+		k = self.cutoff(k)
+		return self.safe_div(self.hits[:, :k].sum(axis=1).astype(np.float64), self.ncorrect)
+
+
+	def safe_div(self, a, b) :
+		''' a/b, with 0 wherever b is 0. '''
+		values = np.zeros(len(a))
+		valid = (b != 0)
+		values[valid] = a[valid] / b[valid]
+		return values
@@ -21,7 +21,7 @@ import logging as log
 import os
 import cPickle
 from baselines.scholar import match_by_title
-from evaluation.metrics import apk, ndcg, recall_at, precision_at
+from evaluation.batch_metrics import Rankings
 #warnings.filterwarnings('error')
 
 
@@ -229,15 +229,14 @@ def get_search_metrics(truth, searcher, show=True, force=False, results_file=Non
 #		metrics["topics_dens"].append(builder.topic_density)
 #		metrics["ngrams_dens"].append(builder.ngram_density)
 
-#		print apk(correct_ids, returned_ids, k=20)
-
-		metrics["MAP"].append( apk(correct_ids, returned_ids, k=20) )
-		metrics["P@5"].append( precision_at(correct_ids, returned_ids, k=5) )
-		metrics["P@10"].append( precision_at(correct_ids, returned_ids, k=10) )
-		metrics["P@20"].append( precision_at(correct_ids, returned_ids, k=20) )
-		metrics["R@20"].append( recall_at(correct_ids, returned_ids, k=20) )
-		metrics["NDCG@20"].append( ndcg(correct_ids, returned_ids, relevs, 20) )
-
+	# All queries evaluated at once
+	rankings = Rankings.queries(results, k=20)
+	metrics["MAP"] = list(rankings.average_precision(20))
+	metrics["P@5"] = list(rankings.precision(5))
+	metrics["P@10"] = list(rankings.precision(10))
+	metrics["P@20"] = list(rankings.precision(20))
+	metrics["R@20"] = list(rankings.recall(20))
+	metrics["NDCG@20"] = list(rankings.ndcg(20))
 
 	if results_file :
 		save_results(results, results_file)
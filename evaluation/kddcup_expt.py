@@ -3,17 +3,22 @@ Created on Mar 13, 2016
 
 @author: hugo
 '''
-from mymysql.mymysql import MyMySQL
+from mymysql.mymysql import MyMySQL, reconnect_all
 import config
 from collections import defaultdict
 import time
 import json
 # import logging as log
 import os
+import sys
 import cPickle
+import traceback
+from multiprocessing import Pool
 # from baselines.scholar import match_by_title
 from evaluation.metrics import ndcg2
-from datasets.mag import get_selected_docs
+from datasets import mag
+from datasets.mag import get_selected_docs, get_selected_expand_pubs
+from ranking.kddcup_snapshot import ConferenceSnapshot
 from ranking.kddcup_searchers import simple_search, SimpleSearcher, RegressionSearcher, \
                     Searcher, ProjectedSearcher, IterProjectedSearcher, StatSearcher, \
                     TemporalSearcher, Bagging, SupervisedSearcher
@@ -24,6 +29,78 @@ from ranking.kddcup_searchers import simple_search, SimpleSearcher, RegressionSe
 db = MyMySQL(db=config.DB_NAME, user=config.DB_USER, passwd=config.DB_PASSWD)
 
 
+# Searcher classes by their name()
+SEARCHERS = {
+                "SimpleSearcher": SimpleSearcher,
+                "RegressionSearcher": RegressionSearcher,
+                "MultiLayered": Searcher,
+                "ProjectedLayered": ProjectedSearcher,
+                "IterProjectedLayered": IterProjectedSearcher,
+                "StatSearcher": StatSearcher,
+                "TemporalSearcher": TemporalSearcher,
+                "SupervisedSearcher": SupervisedSearcher,
+            }
+
+# Best parameters found so far for each searcher, set on top of config.PARAMS
+SEARCHER_PARAMS = {
+                "SimpleSearcher": {
+                              'age_relev': .2, # .5, .7, .08, .2
+                              },
+
+                "RegressionSearcher": {
+                              'age_relev': .0, # .5, .7, .08
+                              },
+
+                "MultiLayered": {
+                              'H': 0,
+                              'age_relev': 0.1, # 0.01
+                              'papers_relev': .99, # .99
+                              'authors_relev': .01, # .01
+                              # 'words_relev': .2,
+                              # 'venues_relev' : .2,
+                              'author_affils_relev': .99, # .95, .99, .99, .99
+                              'alpha': 0.4}, # .01, .35, .25, .4
+
+                "ProjectedLayered": {
+                          'H': 0,
+                          'age_relev': .0, # .0
+                          'alpha': 0.7, # .7
+                          },
+
+                "IterProjectedLayered": {
+                          'H': 0,
+                          'age_relev': .0, # .0
+                          # 'papers_relev': .7, # .99
+                          # 'authors_relev': .3, # .01
+                          'author_affils_relev': .95, # .95
+                          'alpha': .9, # .9, 0.4 (easy_search)
+                          'affil_relev': 1.0
+                          },
+
+                "StatSearcher": {
+                          'H': 0,
+                          'age_relev': .0, # .0
+                          },
+
+                "TemporalSearcher": {
+                          'H': 0,
+                          'age_relev': .0, # .0
+                          'alpha': .9, # .9, 0.4 (easy_search)
+                          },
+
+                "SupervisedSearcher": {
+                          'H': 0,
+                          'age_relev': .0, # .0
+                          'alpha': .9, # .9, 0.4 (easy_search)
+                          },
+            }
+
+
+# Read-only data for the evaluation jobs. It's loaded by load_shared_data
+# before the worker processes are forked, so they all share it.
+shared = {}
+
+
 def get_affil_based_on_id(affil_ids):
     affil_names = []
     for each in affil_ids:
@@ -252,79 +329,139 @@ def main():
         exclude_papers = zip(*get_selected_docs(c, "2015"))[0]
         # exclude_papers = []
 
+        # Loaded once and shared by all searchers
+        snapshot = ConferenceSnapshot(c, year)
+
         for s in searchers :
             print "Running %s." % s.name()
 
-            if s.name() == "SimpleSearcher":
-                s.set_params(**{
-                              'age_relev': .2, # .5, .7, .08, .2
-                              })
+            s.set_params(**SEARCHER_PARAMS.get(s.name(), {}))
+            s.set_snapshot(snapshot)
 
-            if s.name() == "RegressionSearcher":
-                s.set_params(**{
-                              'age_relev': .0, # .5, .7, .08
-                              })
+            rfile = get_results_file(c, s.name())
+            get_search_metrics(selected_affils, ground_truth, c, year, s,\
+                         exclude_papers=exclude_papers, results_file=rfile)
+            del s
 
-            if s.name() == "MultiLayered":
-                s.set_params(**{
-                              'H': 0,
-                              'age_relev': 0.1, # 0.01
-                              'papers_relev': .99, # .99
-                              'authors_relev': .01, # .01
-                              # 'words_relev': .2,
-                              # 'venues_relev' : .2,
-                              'author_affils_relev': .99, # .95, .99, .99, .99
-                              'alpha': 0.4}) # .01, .35, .25, .4
+        # get_search_metrics(selected_affils, ground_truth, c, year, Bagging(),\
+        #              exclude_papers=exclude_papers, results_file=None, bagging_list=bagging_list)
+        print
 
-            if s.name() == "ProjectedLayered":
-                s.set_params(**{
-                          'H': 0,
-                          'age_relev': .0, # .0
-                          'alpha': 0.7, # .7
-                          })
 
-            if s.name() == "IterProjectedLayered":
-                s.set_params(**{
-                          'H': 0,
-                          'age_relev': .0, # .0
-                          # 'papers_relev': .7, # .99
-                          # 'authors_relev': .3, # .01
-                          'author_affils_relev': .95, # .95
-                          'alpha': .9, # .9, 0.4 (easy_search)
-                          'affil_relev': 1.0
-                          })
+def load_shared_data(confs, year):
+    """
+    Loads what every job of the given conferences reads: the selected affils,
+    ground truth and excluded papers, plus the pub/author/affil records and
+    citation edges of the conferences' papers (a ConferenceSnapshot each),
+    which the searchers and graph builders then take from memory instead of
+    the DB.
+    """
+    mag.enable_pubs_cache()
 
-            if s.name() == "StatSearcher":
-                s.set_params(**{
-                          'H': 0,
-                          'age_relev': .0, # .0
-                          })
+    shared["year"] = year
+    shared["selected_affils"] = db.select(fields="id", table="selected_affils")
+    shared["confs"] = {}
 
-            if s.name() == "TemporalSearcher":
-                s.set_params(**{
-                          'H': 0,
-                          'age_relev': .0, # .0
-                          'alpha': .9, # .9, 0.4 (easy_search)
-                          })
+    for c in confs:
+        print "Loading '%s' conf." % c
 
+        # Also the affiliation resolution without online search, used by SimpleSearcher
+        snapshot = ConferenceSnapshot(c, year)
+        get_selected_expand_pubs(c, year, _type='selected', online_search=False)
 
-            if s.name() == "SupervisedSearcher":
-                s.set_params(**{
-                          'H': 0,
-                          'age_relev': .0, # .0
-                          'alpha': .9, # .9, 0.4 (easy_search)
-                          })
+        exclude_docs = get_selected_docs(c, "2015")
+        shared["confs"][c] = {
+            "ground_truth": calc_ground_truth_score(shared["selected_affils"], c),
+            "exclude_papers": zip(*exclude_docs)[0] if exclude_docs else (),
+            "snapshot": snapshot,
+        }
 
 
-            rfile = get_results_file(c, s.name())
-            get_search_metrics(selected_affils, ground_truth, c, year, s,\
-                         exclude_papers=exclude_papers, results_file=rfile)
-            del s
+def run_job(job):
+    """
+    Evaluates one (conference, searcher name, parameters) job. Errors are
+    reported instead of raised so the other jobs still finish.
+    """
+    conf_name, searcher_name, params = job
 
-        # get_search_metrics(selected_affils, ground_truth, c, year, Bagging(),\
-        #              exclude_papers=exclude_papers, results_file=None, bagging_list=bagging_list)
-        print
+    searcher = SEARCHERS[searcher_name](**config.PARAMS)
+    searcher.set_params(**SEARCHER_PARAMS.get(searcher_name, {}))
+    searcher.set_params(**params)
+    searcher.set_snapshot(shared["confs"][conf_name]["snapshot"])
+
+    # Jobs with the same searcher would race on the cached graph files
+    if hasattr(searcher, "set_save"):
+        searcher.set_save(False)
+
+    try:
+        metrics = get_search_metrics(shared["selected_affils"], shared["confs"][conf_name]["ground_truth"],
+                                     conf_name, shared["year"], searcher,
+                                     exclude_papers=shared["confs"][conf_name]["exclude_papers"], show=False)
+    except Exception:
+        print "Job %s failed:\n%s" % (str(job), traceback.format_exc())
+        metrics = None
+
+    return conf_name, searcher_name, params, metrics
+
+
+def get_jobs(confs, searchers, params_grid={}):
+    """
+    One job for every conference, searcher and parameter set. 'params_grid'
+    maps searcher names to lists of parameter dicts, tried on top of the
+    searcher's SEARCHER_PARAMS.
+    """
+    return [(c, s, params) for c in confs for s in searchers for params in params_grid.get(s, [{}])]
+
+
+def run_jobs(confs, year, jobs, nprocs=4, results_file=None):
+    """
+    Runs the jobs in a pool of 'nprocs' processes sharing the data loaded for
+    the conferences and writes NDCG@20 and time of every job in one table.
+    """
+    load_shared_data(confs, year)
+
+    # The DB connections inherited from this process can't be shared
+    pool = Pool(nprocs, initializer=reconnect_all)
+    rows = []
+    for i, (c, s, params, metrics) in enumerate(pool.imap_unordered(run_job, jobs)):
+        if metrics is not None:
+            rows.append((c, s, params, metrics["NDCG"], metrics["Time"]))
+
+        print "%d/%d jobs done." % (i+1, len(jobs))
+
+    pool.close()
+    pool.join()
+
+    # Best first within each conference
+    rows.sort(key=lambda row: (row[0], -row[3]))
+
+    if not results_file:
+        results_file = get_results_file("leaderboard", "results")
+
+    with open(results_file, 'w') as f:
+        print >> f, "conf\tsearcher\tparams\tNDCG@20\ttime"
+        for c, s, params, ndcg, secs in rows:
+            print >> f, "%s\t%s\t%s\t%f\t%.2f" % (c, s, json.dumps(params, sort_keys=True), ndcg, secs)
+
+    for c, s, params, ndcg, secs in rows:
+        print "%-8s %-22s NDCG: %f  Time: %.2fs  %s" % (c, s, ndcg, secs, json.dumps(params, sort_keys=True))
+
+    return rows
+
+
+def leaderboard():
+    """
+    Parallel version of main(): every searcher on every conference.
+    """
+    confs = ["KDD", "ICML"]
+    searchers = ["SimpleSearcher", "MultiLayered", "IterProjectedLayered", "StatSearcher", "TemporalSearcher"]
+    year = ["2011", "2012", "2013", "2014"]
+
+    run_jobs(confs, year, get_jobs(confs, searchers))
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "parallel":
+        leaderboard()
+    else:
+        main()
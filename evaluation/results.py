@@ -10,7 +10,7 @@ import cPickle
 import os
 from collections import defaultdict
 import metrics
-from evaluation.metrics import apk, ndcg
+from evaluation.batch_metrics import Rankings
 
 
 LATEX_TEMPLATE = """
@@ -50,12 +50,10 @@ def get_values(method, dataset, query_set, metrics) :
 #		return ["-"]*len(metrics)
     return [None]*2*len(metrics)
 
-  MAP = []
-  NDCG = []
   results = cPickle.load(open(file_path, 'r'))
-  for correct, relevances, returned in results :
-    MAP.append(apk(correct, returned, 20))
-    NDCG.append(ndcg(correct, returned, relevances, 20))
+  rankings = Rankings.queries(results, k=20)
+  MAP = rankings.average_precision(20)
+  NDCG = rankings.ndcg(20)
 
 
   values = [np.mean(MAP), np.std(MAP),
@@ -9,6 +9,11 @@ from scipy.stats.stats import ttest_rel
 from scipy.stats import distributions
 import config
 import cPickle
+from collections import defaultdict
+
+
+# Resamples drawn at once. Bounds memory to about BLOCK_SIZE x (n + pairs) values.
+BLOCK_SIZE = 10000
 
 
 def paired_ttest(x, y):
@@ -24,24 +29,167 @@ def paired_ttest(x, y):
 	return t, p
 
 
-def stats_signif(folder, methods1, methods2) :
+def method_pairs(nmethods) :
+	''' Rows i and j of every pair of methods (i < j). '''
+	return np.triu_indices(nmethods, 1)
+
+
+def resample_blocks(n, nresamples, block_size, rng) :
+	'''
+	Yields the bootstrap resamples of n paired observations in blocks, as a
+	(block x n) matrix with the number of times each observation was drawn.
+	'''
+	done = 0
+	while done < nresamples :
+		size = min(block_size, nresamples-done)
+
+		# One bincount for the whole block, with the draws of each resample offset
+		draws = rng.randint(0, n, size=(size, n)) + n*np.arange(size)[:, np.newaxis]
+		yield np.bincount(draws.ravel(), minlength=size*n).reshape(size, n)
+
+		done += size
+
+
+def paired_bootstrap(values, nresamples=100000, alpha=0.05, block_size=BLOCK_SIZE, seed=None) :
+	'''
+	Paired bootstrap over the metric values of every method (methods x n, e.g. the
+	NDCG@20 of each conference or query). All pairs of methods are tested on the
+	same resamples. Returns, for the pairs (i, j) given by method_pairs, the mean
+	difference of i over j, its (1-alpha) percentile confidence interval and the
+	two-sided p-value of no difference, from the bootstrap distribution shifted
+	to zero mean.
+	'''
+	values = np.asarray(values, dtype=np.float64)
+	n = values.shape[1]
+	rows, cols = method_pairs(len(values))
+
+	observed = values.mean(axis=1)
+	observed = observed[rows] - observed[cols]
+
+	rng = np.random.RandomState(seed)
+	diffs = []
+	for counts in resample_blocks(n, nresamples, block_size, rng) :
+		means = counts.dot(values.T) / float(n)
+		diffs.append(means[:, rows] - means[:, cols])
+
+	diffs = np.vstack(diffs)
+
+	low, high = np.percentile(diffs, [100*alpha/2, 100*(1-alpha/2)], axis=0)
+	extreme = (np.abs(diffs - observed) >= np.abs(observed)).sum(axis=0)
+	pvalues = (extreme + 1.0) / (len(diffs) + 1.0)
+
+	return observed, low, high, pvalues
+
+
+def randomization_test(values, nresamples=100000, block_size=BLOCK_SIZE, seed=None) :
+	'''
+	Paired randomization test for every pair of methods (as in method_pairs): the
+	sign of each paired difference is flipped at random and the mean difference
+	compared to the observed one. Returns the observed mean differences and their
+	two-sided p-values.
+	'''
+	values = np.asarray(values, dtype=np.float64)
+	n = values.shape[1]
+	rows, cols = method_pairs(len(values))
+
+	# Paired differences of every pair (pairs x n)
+	diffs = values[rows] - values[cols]
+	observed = diffs.mean(axis=1)
+
+	rng = np.random.RandomState(seed)
+	extreme = np.zeros(len(diffs))
+	done = 0
+	while done < nresamples :
+		size = min(block_size, nresamples-done)
+
+		signs = 2.0*rng.randint(0, 2, size=(size, n)) - 1.0
+		means = signs.dot(diffs.T) / float(n)
+		extreme += (np.abs(means) >= np.abs(observed) - 1e-12).sum(axis=0)
+
+		done += size
+
+	return observed, (extreme + 1.0) / (nresamples + 1.0)
+
+
+def significance(names, values, nresamples=100000, alpha=0.05, seed=None) :
+	'''
+	Both tests for all pairs of methods. Returns a dict {(method1, method2):
+	(mean difference, CI low, CI high, bootstrap p-value, randomization p-value)}.
+	'''
+	observed, low, high, boot_p = paired_bootstrap(values, nresamples, alpha, seed=seed)
+	_, perm_p = randomization_test(values, nresamples, seed=seed)
+
+	rows, cols = method_pairs(len(names))
+	return {(names[i], names[j]): (observed[p], low[p], high[p], boot_p[p], perm_p[p])
+					for p, (i, j) in enumerate(zip(rows, cols))}
+
+
+def read_leaderboard(file_path, metric="NDCG@20") :
+	'''
+	Reads the table written by kddcup_expt.run_jobs as a (methods x conferences)
+	matrix, a method being a searcher with its parameters. Only methods run on
+	every conference are kept.
+	'''
+	table = defaultdict(dict)
+	with open(file_path, 'r') as f :
+		header = f.readline().rstrip('\n').split('\t')
+		col = header.index(metric)
+		for line in f :
+			fields = line.rstrip('\n').split('\t')
+			table["%s %s" % (fields[1], fields[2])][fields[0]] = float(fields[col])
+
+	confs = sorted(set([c for scores in table.values() for c in scores]))
+	names = sorted([m for m, scores in table.items() if len(scores) == len(confs)])
+	values = np.array([[table[m][c] for c in confs] for m in names])
+
+	return names, confs, values
+
+
+def print_significance(names, values, nresamples=100000, alpha=0.05) :
+	''' Prints the tests of all pairs of methods, one pair per line. '''
+	print "Method 1\tMethod 2\tDiff\t%d%% CI\tp (bootstrap)\tp (randomization)" % (100*(1-alpha))
+	for (m1, m2), (diff, low, high, boot_p, perm_p) in sorted(significance(names, values, nresamples, alpha).items()) :
+		print "%s\t%s\t%.4f\t[%.4f, %.4f]\t%e\t%e" % (m1, m2, diff, low, high, boot_p, perm_p)
+
+
+def stats_signif(folder, methods1, methods2, metric="MAP", test="ttest") :
 	'''
 	Cross checks statistical significance between all method in `methods1` with
-	`methods2` using a t-test. Results are read from `folder`.
+	`methods2` using a t-test, or the 'bootstrap' or 'randomization' tests. Results
+	are read from `folder`.
 	'''
 	
 	results = {}
 	for file_name in os.listdir(folder) :
 		file_path = os.path.join(folder, file_name)
 		metrics = cPickle.load(open(file_path, 'r'))
-		values = np.array(metrics["MAP"])
+		values = np.array(metrics[metric])
 
 		results[file_name[:-2]] = values, np.mean(values), np.std(values)
 
+	# All pairs are tested at once by the resampling tests
+	pvalues = {}
+	if test != "ttest" :
+		names = sorted(set(methods1) | set(methods2))
+		values = [results[m][0] for m in names]
+
+		if test == "bootstrap" :
+			pairs_p = paired_bootstrap(values)[3]
+		else :
+			pairs_p = randomization_test(values)[1]
+
+		for p, (i, j) in enumerate(zip(*method_pairs(len(names)))) :
+			pvalues[(names[i], names[j])] = pvalues[(names[j], names[i])] = pairs_p[p]
+
+	def pvalue(m1, m2) :
+		if test == "ttest" :
+			return paired_ttest(results[m1][0], results[m2][0])[1]
+		return pvalues[(m1, m2)]
+
 	# Print header with the methods names and 
 	# second header with MAP values for reference
 	print "\t".join(["Methods", ""] + methods2)
-	print "\t".join(["", "MAP@20"] + [u"%.3f \xb1 %.3f" % (results[m][1], results[m][2]) for m in methods2])
+	print "\t".join(["", metric] + [u"%.3f \xb1 %.3f" % (results[m][1], results[m][2]) for m in methods2])
 
 #	ttests = np.empty((len(methods1), len(methods2)))
 	for _i, m1 in enumerate(methods1) :
@@ -50,7 +198,7 @@ def stats_signif(folder, methods1, methods2) :
 		for _j, m2 in enumerate(methods2) :
 			if (m1 != m2) :
 	#			ttests[i,j] = ttest_rel(results[m1], results[m2])
-				print "%e\t" % paired_ttest(values1, results[m2][0])[1],
+				print "%e\t" % pvalue(m1, m2),
 
 			else:
 				# Empty cell
@@ -68,6 +216,10 @@ if __name__ == '__main__':
 								["MultiLayered", "TopCited(G)", "PageRank(G)"], 
 								["MultiLayered", "TopCited(G)", "PageRank(G)", "BM25", "TF-IDF", "TopCited", "PageRank(pre)", "PageRank(pos)"])
 
+	# KDD Cup searchers over the conferences of the parallel evaluation
+#	names, confs, values = read_leaderboard(config.DATA + "results/leaderboard/results.tsv")
+#	print_significance(names, values)
+
 	# Max 2 layers 
 #	stats_signif(config.DATA + "results/layers", 
 #								["P", "PA", "PT", "PW", "PV"], 
@@ -5,12 +5,41 @@ Created on Jul 6, 2014
 '''
 from mymysql import MyMySQL
 import os
+import sys
 from pylucene import Index, DocField
 import time
+import zlib
 import config
+from multiprocessing.pool import ThreadPool
 import logging as log
 
 
+# Settings for bulk indexing
+RAM_BUFFER_MB = 256
+BATCH_SIZE = 5000
+
+# Segments left after a full build, so searches don't go through the many small
+# segments flushed while indexing.
+MERGED_SEGMENTS = 1
+
+
+def paper_signature(title, abstract, year, ncitations, txt_mtime=None) :
+  """ Checksum of everything indexed for a paper, to detect changes. """
+  key = u"%s|%s|%s|%s|%s" % (title, abstract, year, ncitations, txt_mtime)
+  return "%08x" % (zlib.crc32(key.encode("UTF-8")) & 0xffffffff)
+
+
+def load_signatures(path) :
+  signatures = {}
+  if os.path.exists(path) :
+    with open(path, "r") as f :
+      for line in f :
+        pub_id, signature = line.split()
+        signatures[pub_id] = signature
+
+  return signatures
+
+
 class Indexer:
 
   def __init__(self):
@@ -23,50 +52,119 @@ class Indexer:
 #		for id, title, abs in rows :
 #			self.pubs[str(id)] = ((title if title else ""), (abs if abs else ""))
 
-    self.pub_ids = self.db.select("id", table="papers")
-    print "Ids loaded."
+    # Citation counts are stored in the index as doc values
+    self.ncitations = dict(self.db.select_query("SELECT cited, COUNT(*) FROM graph GROUP BY cited"))
 
 
   def get_texts(self, pub_id) :
-    title, abs = self.db.select_one(["title", "abstract"], table="papers", where="id='%s'"%pub_id)
+    title, abs, year = self.db.select_one(["title", "abstract", "year"], table="papers", where="id='%s'"%pub_id)
     title = title if title else ''
     abs = abs if abs else ''
-    return title, abs
+    return title, abs, year
+
+
+  def prepare(self, row, include_text, signatures) :
+    """
+    Builds the fields of a paper from its DB row, reading its text file if
+    needed. Returns None if the paper didn't change since it was indexed.
+    """
+    pub_id, title, abstract, year = row
+    pub_id = str(pub_id)
+    title = title if title else ''
+    abstract = abstract if abstract else ''
+    ncitations = self.ncitations.get(pub_id, 0)
+
+    txt_path = config.TXT_PATH % pub_id
+    txt_mtime = None
+    if include_text :
+      txt_mtime = int(os.path.getmtime(txt_path)) if os.path.exists(txt_path) else 0
 
+    signature = paper_signature(title, abstract, year, ncitations, txt_mtime)
+    if signatures.get(pub_id) == signature :
+      return pub_id, signature, None
 
-  def add_papers(self, index_folder, include_text=True):
+    field_values = {'id':pub_id, 'title':title, 'abstract':abstract,
+                    'year':year, 'ncitations':ncitations}
 
-    print "Adding %s documents to index in '%s'" % (len(self.pub_ids), index_folder)
+    # Check if we are including to text before loading it
+    if include_text :
+      with open(txt_path, "r") as txt_file :
+        field_values['text'] = txt_file.read()
 
-    fields = [DocField("id", stored=True, indexed=True),
+    return pub_id, signature, field_values
+
+
+  def add_papers(self, index_folder, include_text=True, incremental=False, nreaders=8, nwriters=4):
+    """
+    Indexes the papers, streamed from the DB in batches. Text files are read by
+    'nreaders' threads and documents are added by 'nwriters' threads sharing
+    the same writer, with a single commit at the end. Full builds are merged
+    down to MERGED_SEGMENTS segments before that commit. If 'incremental', only
+    papers that are new or changed since the last run are (re)indexed and
+    papers no longer in the DB are removed.
+    """
+    print "Adding documents to index in '%s'" % index_folder
+
+    fields = [DocField("id", stored=True, indexed=True, docvalues="sorted"),
               DocField("title", stored=True, indexed=True),
-              DocField("abstract", stored=False, indexed=True)]
+              DocField("abstract", stored=False, indexed=True),
+              DocField("year", docvalues="numeric"),
+              DocField("ncitations", docvalues="numeric")]
     if include_text:
       fields.append(DocField("text", stored=False, indexed=True))
 
+    # Checksums of the indexed papers, kept next to the index
+    signatures_path = index_folder.rstrip("/") + "_signatures.txt"
+    incremental = incremental and os.path.exists(signatures_path)
+    signatures = load_signatures(signatures_path) if incremental else {}
+
     index = Index(index_folder, fields)
-#		for i, (id, (title, abstract)) in enumerate(self.pubs.items()) :
-    for i, pub_id in enumerate(self.pub_ids) :
+    index.open_writer(create=not incremental, ram_buffer_mb=RAM_BUFFER_MB)
+
+    readers = ThreadPool(nreaders)
+    writers = ThreadPool(nwriters)
+
+    # Writes papers replacing their previous version, if any
+    write = (lambda fields: index.update("id", **fields)) if incremental else (lambda fields: index.add(**fields))
 
-      title, abstract = self.get_texts(pub_id)
-      field_values = {'id':pub_id, 'title':title, 'abstract':abstract}
+    seen = {}
+    nadded = 0
+    query = "SELECT id, title, abstract, year FROM papers"
+    for rows in self.db.select_stream(query, BATCH_SIZE) :
 
-      # Check if we are including to text before loading it
-      if include_text :
-        with open(os.path.join(config.TXT_PATH % pub_id), "r") as txt_file :
-          text = txt_file.read()
-        field_values['text'] = text
+      prepared = readers.map(lambda row: self.prepare(row, include_text, signatures), rows)
 
-      index.add(**field_values)
+      docs = []
+      for pub_id, signature, field_values in prepared :
+        seen[pub_id] = signature
+        if field_values :
+          docs.append(field_values)
 
-      # Commit and print progress every 1000 entries
-      if i and i%1000==0 :
-        index.commit()
-        log.info("%d documents added." % i)
+      writers.map(write, docs)
+      nadded += len(docs)
+      log.info("%d documents added." % nadded)
+
+    # Remove papers no longer in the DB
+    for pub_id in set(signatures) - set(seen) :
+      index.delete("id", pub_id)
+
+    readers.close()
+    writers.close()
+
+    # Incremental runs keep the existing segments, so per segment caches stay valid
+    if not incremental :
+      log.info("Merging index into %d segment(s)." % MERGED_SEGMENTS)
+      index.merge(MERGED_SEGMENTS)
 
     index.commit()
     index.close()
 
+    with open(signatures_path, "w") as f :
+      for pub_id, signature in seen.items() :
+        print >> f, pub_id, signature
+
+    print "%d documents indexed, %d unchanged." % (nadded, len(seen)-nadded)
+
 
 def search_index(index_folder, query) :
   index = Index(index_folder)
@@ -79,7 +177,7 @@ if __name__ == '__main__':
   start = time.time()
 
   indexer = Indexer()
-  indexer.add_papers(config.INDEX_PATH, include_text=False)
+  indexer.add_papers(config.INDEX_PATH, include_text=False, incremental=("incremental" in sys.argv[1:]))
 
   print "Process finished in %.2f seconds." % (time.time()-start)
 
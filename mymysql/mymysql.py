@@ -16,13 +16,28 @@ class MyMySQL():
 		'''
 		Opens database connection.
 		'''
-		self.db = MySQLdb.connect(host=host,
-															db=db,
-															user=user,
-															passwd=passwd,
-															charset="utf8",
-															unix_socket="/tmp/mysql.sock", # /var/run/mysqld/mysqld.sock
-															**params)
+		self.params = dict(host=host,
+											 db=db,
+											 user=user,
+											 passwd=passwd,
+											 charset="utf8",
+											 unix_socket="/tmp/mysql.sock", # /var/run/mysqld/mysqld.sock
+											 **params)
+
+		self.db = MySQLdb.connect(**self.params)
+
+		# Connections replaced by reconnect()
+		self.inherited = []
+
+
+	def reconnect(self) :
+		'''
+		Opens a new connection with the same parameters. Meant for forked processes,
+		whose inherited connection shares its socket with the parent. That one is kept
+		referenced, and never closed, since closing it would also end the parent's.
+		'''
+		self.inherited.append(self.db)
+		self.db = MySQLdb.connect(**self.params)
 
 	def create_table(self, table_name, table_description, force=False):
 		if not isinstance(table_name, str) or not isinstance(table_description, list):
@@ -120,6 +135,24 @@ class MyMySQL():
 		return result[0] if len(result)>0 else None
 
 
+	def select_stream(self, query, batch_size=1000) :
+		'''
+		Executes the select query with a server side cursor and yields its rows in
+		lists of at most 'batch_size', so the result set is never fully loaded in
+		memory. No other query can run on this connection until it's exhausted.
+		'''
+		cursor = self.db.cursor(MySQLdb.cursors.SSCursor)
+		try :
+			cursor.execute(query)
+			while True :
+				rows = cursor.fetchmany(batch_size)
+				if not rows :
+					break
+				yield list(rows)
+		finally :
+			cursor.close()
+
+
 # 	def execute(self, query, load_all=True) :
 #
 # 		if load_all :
@@ -234,6 +267,22 @@ class MyMySQL():
 
 
 
+def reconnect_all() :
+	'''
+	Reconnects every module level MyMySQL instance (the 'db' convention of this
+	project). Meant as the initializer of forked worker processes.
+	'''
+	import sys
+
+	seen = set()
+	for module in sys.modules.values() :
+		conn = getattr(module, "db", None)
+		if isinstance(conn, MyMySQL) and id(conn) not in seen :
+			conn.reconnect()
+			seen.add(id(conn))
+
+
+
 if __name__ == "__main__" :
 	pass
 	# import config
@@ -11,11 +11,11 @@ from mymysql import MyMySQL
 from collections import defaultdict
 from exceptions import TypeError
 
-import itertools
 import logging as log
 #import words
 from config import DATA, DATASET
 import config
+import utils
 import line_profiler
 import csv
 import time
@@ -31,11 +31,6 @@ db = MyMySQL(db=DATASET, user="root")
 ## Helper methods                     
 ########################################
 
-def sorted_tuple(a,b):
-	''' Simple pair sorting to avoid repetitions when inserting into set or dict. '''
-	return (a,b) if a<b else (b,a)
-
-
 def get_unicode(s):
 	''' Return an unicode of the string encoded with the most likely format. '''
 	if not s :
@@ -94,35 +89,11 @@ def get_rules_by_lift(transactions, min_lift=1.0) :
 	Get relevant association between topics assuming that every document is a 
 	transaction and relevant topics for each documents are items in that transaction.
 	We then use the lift metric to find strong co-occurrences between topics.
+	Pairs need to appear together more than once, otherwise lift values can be
+	huge and not really significant. Lifts are returned in log scale.
 	'''
-
-	freqs1 = defaultdict(int)  # Frequencies of 1-itemsets
-	freqs2 = defaultdict(int)  # Frequencies of 2-itemsets
-	for trans in transactions :
-		for i in trans :
-			freqs1[i] += 1
-
-		# If there are at least 2 items, let's compute pairs support
-		if len(trans) >= 2 :
-			for i1, i2 in itertools.combinations(trans, 2) :
-				freqs2[sorted_tuple(i1, i2)] += 1
-
-	n = float(len(transactions))
-
-	# Check every co-occurring ngram
-	rules = []
-	for (i1,i2),f in freqs2.items() :
-
-		# Consider only the ones that appear more than once together,
-		# otherwise get_rules_by_lift values can be huge and not really significant 
-		if f > 1 :
-			lift = f*n/(freqs1[i1]*freqs1[i2])
-
-			# Include only values higher than min_lift
-			if lift>=min_lift :
-				rules.append( (i1, i2, np.log10(lift)) )
-
-	return rules
+	rules = utils.get_rules_by_lift(transactions, min_lift, min_support=2)
+	return [(i1, i2, np.log10(lift)) for i1, i2, lift in rules]
 
 
 def make_csv(file_path, headers, rows):
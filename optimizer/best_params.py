@@ -3,11 +3,14 @@ Created on Jun 23, 2015
 
 @author: luamct
 '''
-from evaluation.experiments import apk
+import sys
+from evaluation.metrics import apk
 import numpy as np
 from ranking.searchers import Searcher
 from optimizer import BayesianOptCV
+from halving import HyperbandCV
 from evaluation.query_sets import load_query_set
+from mymysql.mymysql import reconnect_all
 import config
 
 
@@ -33,28 +36,39 @@ class SearchEvaluator :
 		return np.mean(maps)
 
 
+PARAM_BOUNDS = {
+								'K': (5, 50),
+								'papers_relev': (0.001, 1.0), 
+								'authors_relev': (0.001, 1.0), 
+								'venues_relev': (0.001, 1.0), 
+								'words_relev': (0.001, 1.0), 
+								'alpha': (0.1, 0.9),
+								'age_relev': (0.001, 1.0), 
+								'query_relev': (0.001, 1.0),
+								'ctx_relev': (0.01, 10.0)
+								}
+
+
 if __name__=='__main__' :
 
 	query_set = 'manual'
 	queries = load_query_set(query_set, 30)
 
 	se = SearchEvaluator(Searcher(**config.PARAMS))
-	bocv = BayesianOptCV(estimator = se, param_bounds={
-																										'K': (5, 50),
-																										'papers_relev': (0.001, 1.0), 
-																										'authors_relev': (0.001, 1.0), 
-																										'venues_relev': (0.001, 1.0), 
-																										'words_relev': (0.001, 1.0), 
-																										'alpha': (0.1, 0.9),
-																										'age_relev': (0.001, 1.0), 
-																										'query_relev': (0.001, 1.0),
-																										'ctx_relev': (0.01, 10.0)
-																										 },
+
+	# Successive halving over subsets of the queries
+	if "hyperband" in sys.argv :
+		hb = HyperbandCV(estimator = se, param_bounds = PARAM_BOUNDS, eta = 3, n_iter = 5, n_jobs = 3,
+										 initializer = reconnect_all)
+		print hb.fit(queries)
+		sys.exit()
+
+	bocv = BayesianOptCV(estimator = se, param_bounds = dict(PARAM_BOUNDS),
 										 #param_list = {'kernel' : ['rbf', 'linear']},\
 #										 param_fixed = {'random_state' : 1},\
-										 n_jobs = 3, cv = 3, n_iter = 500,
+										 n_jobs = 3, cv = 3, n_iter = 500, initializer = reconnect_all,
+										 trials_file = config.DATA + "bo_trials_%s.jsonl" % query_set,
 										 gp_params = {'corr' : 'squared_exponential', 'regr' : 'constant'},
 										 acq = 'ei')
 
 	bocv.fit(queries)
-
@@ -0,0 +1,145 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import math
+import numpy as np
+from multiprocessing import Pool
+
+
+# Search being run by HyperbandCV. It's set before the worker processes are
+# forked, so each of them evaluates with its own copy of the estimator.
+current_search = None
+
+def evaluate_items(job) :
+	params, start, end = job
+	return current_search.score(params, start, end)
+
+
+class HyperbandCV :
+	'''
+	Hyperband tuner for the same estimators as BayesianOptCV, i.e. anything with
+	set_params(**params) and evaluate(X). The fidelity is the number of items of
+	X (e.g. queries) a configuration is evaluated on. Each bracket runs successive
+	halving: many configurations are scored on a few items and only the best 1/eta
+	of them go on to eta times as many items, up to all of X. Brackets differ in
+	how many configurations they start with, trading exploration for reliability.
+
+	evaluate must return a mean over the given items (as the MAP), so a promoted
+	configuration is only evaluated on the items it hadn't been yet, and its score
+	is the weighted mean of both parts. With n_jobs > 1, evaluations run on worker
+	processes, each started by calling initializer (e.g. to reopen DB connections).
+	'''
+
+	def __init__(self, estimator, param_bounds, min_items=None, eta=3, n_iter=1, n_jobs=1, random_state=None, initializer=None) :
+		self.estimator = estimator
+		self.pbounds = param_bounds
+		self.ptypes = {key: type(low) for key, (low, _high) in param_bounds.items()}
+
+		self.min_items = min_items
+		self.eta = eta
+		self.niter = n_iter
+		self.n_jobs = n_jobs
+		self.initializer = initializer
+		self.rng = np.random.RandomState(random_state)
+
+		# Configurations evaluated on all items, as (score, params)
+		self.results = []
+
+		# Number of configurations sampled and of items evaluated over all of them
+		self.nconfigs = 0
+		self.budget = 0
+
+
+	def sample(self, n) :
+		'''
+		n configurations drawn uniformly from the log scale of the bounds, as
+		bayes_opt.log_maximize, converted to the type of the bounds.
+		'''
+		keys = sorted(self.pbounds.keys())
+		low = np.log10([self.pbounds[k][0] for k in keys])
+		high = np.log10([self.pbounds[k][1] for k in keys])
+
+		values = 10**self.rng.uniform(low, high, size=(n, len(keys)))
+		return [{k: self.ptypes[k](v) for k, v in zip(keys, row)} for row in values]
+
+
+	def score(self, params, start, end) :
+		''' Mean of the estimator over items [start, end) of X. '''
+		self.estimator.set_params(**params)
+		return self.estimator.evaluate(self.X[start:end])
+
+
+	def evaluate(self, configs, nitems, pool=None) :
+		''' Brings the score of every configuration up to the first nitems items. '''
+		pending = [c for c in configs if c['done'] < nitems]
+		jobs = [(c['params'], c['done'], nitems) for c in pending]
+
+		if pool :
+			scores = pool.map(evaluate_items, jobs, chunksize=1)
+		else :
+			scores = [self.score(*job) for job in jobs]
+
+		for c, s in zip(pending, scores) :
+			c['score'] = (c['done']*c['score'] + (nitems - c['done'])*s) / float(nitems)
+			self.budget += nitems - c['done']
+			c['done'] = nitems
+
+
+	def successive_halving(self, n, nitems, rungs, pool=None) :
+		'''
+		Starts n configurations on nitems items and runs the given number of rungs,
+		keeping the best 1/eta of them from one to the next.
+		'''
+		configs = [{'params': params, 'done': 0, 'score': 0.0} for params in self.sample(n)]
+		self.nconfigs += n
+
+		for i in range(rungs) :
+			items = min(len(self.X), max(1, int(round(nitems * self.eta**i))))
+			self.evaluate(configs, items, pool)
+
+			configs.sort(key=lambda c: c['score'], reverse=True)
+			print "  %4d configurations on %3d items. Best: %.4f %s" % (len(configs), items, configs[0]['score'], configs[0]['params'])
+
+			if items == len(self.X) :
+				self.results.extend([(c['score'], c['params']) for c in configs])
+				break
+
+			configs = configs[:max(1, len(configs) // self.eta)]
+
+
+	def fit(self, X) :
+		'''
+		Runs n_iter rounds of Hyperband over the items of X, in a random order, and
+		returns the parameters with the best score on all of them.
+		'''
+		self.X = [X[i] for i in self.rng.permutation(len(X))]
+
+		nitems = len(self.X)
+		min_items = self.min_items if self.min_items else max(1, nitems // self.eta**3)
+		smax = int(math.log(nitems / float(min_items)) / math.log(self.eta) + 1e-9)
+
+		# Workers are forked once, with the estimator as it is now
+		global current_search
+		current_search = self
+		pool = Pool(self.n_jobs, initializer=self.initializer) if self.n_jobs > 1 else None
+
+		try :
+			for it in range(self.niter) :
+				for s in range(smax, -1, -1) :
+					n = int(math.ceil((smax + 1) / (s + 1.0) * self.eta**s))
+					print "Round %d, bracket %d: %d configurations from %d items." % (it+1, s, n, int(round(nitems * self.eta**-s)))
+
+					self.successive_halving(n, nitems * self.eta**-s, s+1, pool)
+		finally :
+			if pool :
+				pool.close()
+				pool.join()
+
+		best_score, best_params = max(self.results, key=lambda r: r[0])
+		print "Best: %.4f %s. Cost of %.1f full evaluations for %d configurations." % \
+					(best_score, best_params, self.budget / float(nitems), self.nconfigs)
+
+		return best_params
+
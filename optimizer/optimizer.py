@@ -7,16 +7,25 @@ Random state has yet to be fully implemented. Otherwise it is working!
 __author__ = 'fernando nogueira'
 
 
+import os
+import json
 import numpy
 from datetime import datetime
+from multiprocessing import Pool
 
-from scipy.optimize import basinhopping
 from scipy.optimize import minimize
 from scipy.stats import norm
-from math import sqrt
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 
 from sklearn.cross_validation import cross_val_score
-from sklearn.gaussian_process import GaussianProcess
+
+
+# Search being run by BayesianOptCV. It's set before the worker processes are
+# forked, so each of them evaluates points with its own copy of the estimator.
+current_search = None
+
+def evaluate_params(params):
+		return current_search.cv(params)
 
 
 class BayesianOptCV:
@@ -28,7 +37,8 @@ class BayesianOptCV:
 								 param_bounds, param_types = None, param_fixed = None, param_list = None, \
 								 acq = 'ei', gp_params = None,\
 								 n_iter=10, scoring=None, fit_params=None, cv=None,\
-								 n_jobs=1, verbose=0, random_state=None):
+								 n_jobs=1, verbose=0, random_state=None, batch_size=None, trials_file=None,\
+								 initializer=None):
 
 
 				self.estimator = estimator
@@ -60,8 +70,16 @@ class BayesianOptCV:
 
 				self.random_state = random_state
 
-				self.restarts = 150
-				self.bh_steps = 50
+				# Best candidates of the acquisition function polished with L-BFGS-B
+				self.restarts = 5
+
+				# Points proposed per round, evaluated on n_jobs processes, each started
+				# by calling initializer (e.g. to reopen DB connections). Evaluations
+				# are appended to trials_file, from which a stopped search resumes.
+				self.n_jobs = n_jobs
+				self.initializer = initializer
+				self.batch_size = batch_size if batch_size else n_jobs
+				self.trials_file = trials_file
 
 
 
@@ -74,13 +92,15 @@ class BayesianOptCV:
 				#for keys in params.keys():
 				return 0
 
-		def set_acqmax(self, restarts, bh_steps):
+		def set_acqmax(self, restarts):
 				self.restarts = restarts
-				self.bh_steps = bh_steps
 
 		# --------------------------------------------- // --------------------------------------------- #
 		def cv(self, estimator_params):
 
+				# The given params are also logged to the trials, so they're left untouched
+				estimator_params = dict(estimator_params)
+
 				if self.ptypes != None:
 
 						if self.ptypes == 'int':
@@ -122,7 +142,25 @@ class BayesianOptCV:
 				if self.plist != None:
 						bo.set_list(self.plist)
 
-				max_val, argmax = bo.log_maximize(restarts = self.restarts, bh_steps = self.bh_steps, verbose = 2, num_it = self.niter)
+				trials = trial_log(self.trials_file, self.pbounds) if self.trials_file else None
+
+				# Workers are forked once, with the estimator as it is now
+				global current_search
+				current_search = self
+				pool = Pool(self.n_jobs, initializer = self.initializer) if self.n_jobs > 1 else None
+
+				def evaluate(params_list):
+						if pool:
+								return pool.map(evaluate_params, params_list, chunksize = 1)
+						return [self.cv(params) for params in params_list]
+
+				try:
+						max_val, argmax = bo.log_maximize(restarts = self.restarts, verbose = 2, num_it = self.niter,\
+																							batch_size = self.batch_size, evaluate = evaluate, trials = trials)
+				finally:
+						if pool:
+								pool.close()
+								pool.join()
 
 				return argmax
 
@@ -183,9 +221,9 @@ class bayes_opt:
 		set_kernel : Member function to set the kernel function to be used. Similar as the for the GP class.
 
 		acq_max : A member function to find the maximum of the acquisition function. It takes a GP object and
-							the number os restarts as additional arguments. It uses the scipy object minimize with method 'L-BFGS-B'
-							to find the local minima of minus the acquisition function. It reapeats it a number of times to avoid
-							falling into local minima.
+							the number os restarts as additional arguments. It evaluates the acquisition function at once on a
+							large latin hypercube of candidates and polishes the best 'restarts' of them with the scipy object
+							minimize with method 'L-BFGS-B'.
 
 		maximize : One of the two main methods of this object. It performs bayesian optimization and return the
 							 maximum value of the function together with the position of the maximum. A full_output option can be
@@ -294,8 +332,15 @@ class bayes_opt:
 
 
 				# ----------------------- // ----------------------- # ----------------------- // ----------------------- #
-				# pass parameters to the Gaussian process.
+				# pass parameters to the Gaussian process. The same one is refit as points are added, which
+				# only extends its Cholesky factor.
 				self.gpparams = gp_params
+				self.gp = gaussian_process()
+				if self.gpparams != None:
+						self.gp.set_params(**self.gpparams)
+
+				# Number of points the acquisition function is evaluated at before polishing the best ones
+				self.n_candidates = 10000
 
 				# When parameters are floats or elements of a list
 				self.ptype = None
@@ -309,7 +354,9 @@ class bayes_opt:
 
 						Parameters
 						----------
-						acq : One of the supported acquisition function names or a custom one.
+						acq : One of the supported acquisition function names or a custom one. A custom
+									function takes an array of points (one per row), the gp and ymax, and returns
+									the value at each point.
 
 						k : Parameter k of the UCB acquisition function.
 
@@ -333,30 +380,77 @@ class bayes_opt:
 				self.plist = lists
 
 		# ------------------------------ // ------------------------------ # ------------------------------ // ------------------------------ #
-		def init(self, init_points, return_log):
+		def init(self, init_points, return_log, evaluate, trials = None):
 				'''A function to perform all initialization and clear the optimize methods - To be constructed'''
 
 				if self.randomstate != None:
 						numpy.random.seed(self.randomstate)
 
+				# Points already evaluated by a previous run count as initialized
+				xtrain, ytrain = numpy.empty((0, self.dim)), numpy.empty(0)
+				if trials:
+						xtrain, ytrain = trials.load(self.dim)
+						print('%d points loaded from the trials log.' % len(ytrain))
+
+				init_points = max(init_points - len(ytrain), 0)
 				print('Optimization procedure is initializing at %i random points.' % init_points)
 
 				#Sampling some points are random to define xtrain.
-				xtrain = numpy.asarray([numpy.random.uniform(x[0], x[1], size = init_points) for x in self.log_bounds]).T
-				ytrain = []
-				for x in xtrain : 
-					ytrain.append(self.f(dict(zip(self.keys, return_log(x)))))
-					print('%d points initialized.' % len(ytrain))
+				xinit = numpy.asarray([numpy.random.uniform(x[0], x[1], size = init_points) for x in self.log_bounds]).T
+				if init_points:
+						yinit = self.evaluate_points(xinit, return_log, evaluate, trials)
 
-				ytrain = numpy.asarray(ytrain)
+						xtrain = numpy.concatenate((xtrain, xinit), axis = 0)
+						ytrain = numpy.append(ytrain, yinit)
 
 				print('Optimization procedure is done initializing.')
 
 				return xtrain, ytrain
 
+
+		def evaluate_points(self, xs, return_log, evaluate, trials = None):
+				''' Evaluates the target at the given (log scaled) points at once and logs them. '''
+
+				params_list = [dict(zip(self.keys, return_log(x))) for x in xs]
+				ys = numpy.asarray(evaluate(params_list), dtype = float)
+
+				if trials:
+						for x, params, y in zip(xs, params_list, ys):
+								trials.add(x, params, y)
+
+				return ys
+
+
+		def fit_gp(self, xtrain, ytrain):
+				return self.gp.fit(xtrain, ytrain)
+
+
+		def propose_batch(self, xtrain, ytrain, batch_size, restarts):
+				''' Proposes batch_size points to evaluate concurrently, with the Kriging
+						believer strategy: each point is chosen by maximizing the acquisition function
+						of a GP that takes the points chosen before it as observed at their predicted
+						mean, which keeps the points of the batch apart.
+				'''
+
+				ymax = ytrain.max()
+				batch = []
+				for j in range(batch_size):
+						gp = self.fit_gp(xtrain, ytrain)
+						x_max = self.acq_max(gp, ymax, restarts, self.log_bounds)
+						batch.append(x_max)
+
+						if j < batch_size - 1:
+								believed = gp.predict(x_max.reshape((1, self.dim)))[0]
+								xtrain = numpy.concatenate((xtrain, x_max.reshape((1, self.dim))), axis = 0)
+								ytrain = numpy.append(ytrain, believed)
+
+				return numpy.asarray(batch)
+
 		# ----------------------- // ----------------------- # ----------------------- // ----------------------- #
-		def acq_max(self, gp, ymax, restarts, bh_steps, Bounds):
-				''' A function to find the maximum of the acquisition function using the 'L-BFGS-B' method.
+		def acq_max(self, gp, ymax, restarts, Bounds):
+				''' A function to find the maximum of the acquisition function. It's evaluated at once on
+						self.n_candidates points of a latin hypercube and the best of them are then polished
+						with the 'L-BFGS-B' method.
 
 						Parameters
 						----------
@@ -364,7 +458,7 @@ class bayes_opt:
 
 						ymax : The current maximum known value of the target function.
 
-						restarts : The number of times minimation if to be repeated. Larger number of restarts
+						restarts : The number of best candidates to start a minimization from. More restarts
 											 improves the chances of finding the true maxima.
 
 						Bounds : The variables bounds to limit the search of the acq max.
@@ -375,36 +469,32 @@ class bayes_opt:
 						x_max : The arg max of the acquisition function.
 				'''
 
-				x_max = Bounds[:, 0]
-				ei_max = 0
+				candidates = latin_hypercube(self.n_candidates, Bounds)
+				values = numpy.ravel(self.ac(candidates, gp = gp, ymax = ymax))
 
-				for i in range(restarts):
-						#Sample some points at random.
-						x_try = numpy.asarray([numpy.random.uniform(x[0], x[1], size = 1) for x in Bounds]).T
+				best = numpy.argsort(values)[::-1][:restarts]
+				x_max = candidates[best[0]]
+				ac_max = values[best[0]]
 
-						#Find the minimum of minus que acquisition function
-						'''
-						res = basinhopping(lambda x: -self.ac(x, gp = gp, ymax = ymax), \
-															 x0 = x_try, niter=bh_steps, T=2, stepsize=0.1,\
-															 minimizer_kwargs = {'bounds' : Bounds, 'method' : 'L-BFGS-B'})
-						'''
+				for x_try in candidates[best]:
 
-						res = minimize(lambda x: -self.ac(x, gp = gp, ymax = ymax), x_try, bounds = Bounds, method = 'L-BFGS-B')
+						#Find the minimum of minus que acquisition function
+						res = minimize(lambda x: -numpy.ravel(self.ac(x.reshape((1, -1)), gp = gp, ymax = ymax))[0],\
+													 x_try, bounds = Bounds, method = 'L-BFGS-B')
 
 
 						#Store it if better than previous minimum(maximum).
-						if -res.fun >= ei_max:
+						if -res.fun >= ac_max:
 								x_max = res.x
-								ei_max = -res.fun
-
-						#print(-res.fun, ei_max)
+								ac_max = -res.fun
 
-				return x_max
+				return numpy.clip(x_max, Bounds[:, 0], Bounds[:, 1])
 
 
 		# ----------------------- // ----------------------- # ----------------------- // ----------------------- #
 		# ----------------------- // ----------------------- # ----------------------- // ----------------------- #
-		def log_maximize(self, restarts = 10, bh_steps = 50, num_it = 15, verbose = 2, full_out = False):
+		def log_maximize(self, restarts = 10, num_it = 15, verbose = 2, full_out = False,\
+										 batch_size = 1, evaluate = None, trials = None):
 				''' Main optimization method perfomed in a log scale.
 
 						Parameters
@@ -423,6 +513,15 @@ class bayes_opt:
 
 						full_out : If the full output is to be returned or just the function maximum and arg max.
 
+						batch_size : Number of points proposed per round. They are evaluated together by 'evaluate'.
+
+						evaluate : Function evaluating a list of parameter dicts at once (e.g. on a process pool).
+											 Defaults to calling the target function on each of them.
+
+						trials : A trial_log. Previously logged points are used instead of being evaluated again,
+										 and new evaluations are appended to it, so an interrupted optimization can resume.
+										 num_it then counts the points logged beyond the initial ones.
+
 
 						Returns
 						-------
@@ -453,37 +552,31 @@ class bayes_opt:
 				xmins = self.bounds[:, 0]
 
 
+				if evaluate is None:
+						evaluate = lambda params_list: [self.f(params) for params in params_list]
+
 				# ------------------------------ // ------------------------------ // ------------------------------ #
-				xtrain, ytrain = self.init(init_points, return_log)
+				xtrain, ytrain = self.init(init_points, return_log, evaluate, trials)
 				ymax = ytrain.max()
 
 
 				# ------------------------------ // ------------------------------ // ------------------------------ #
-				# Fitting the gaussian process
-				gp = GaussianProcess()
-				if self.gpparams != None:
-						gp.set_params(**self.gpparams)
-
-				gp.fit(xtrain, ytrain)
-
-				# Finding argmax of the acquisition function.
-				x_max = self.acq_max(gp, ymax, restarts, bh_steps, self.log_bounds)
-
-				for i in range(num_it):
+				# Each round fits the gaussian process and evaluates a batch of argmaxes of the acquisition function
+				total_points = max(init_points, len(ytrain) - num_it) + num_it
+				i = 0
+				while len(ytrain) < total_points:
 						op_start = datetime.now()
 
-						xtrain = numpy.concatenate((xtrain, x_max.reshape((1, self.dim))), axis = 0)
-						ytrain = numpy.append(ytrain, self.f(dict(zip(self.keys, return_log(x_max)))))
+						batch = self.propose_batch(xtrain, ytrain, min(batch_size, total_points - len(ytrain)), restarts)
 
-						ymax = ytrain.max()
+						xtrain = numpy.concatenate((xtrain, batch), axis = 0)
+						ytrain = numpy.append(ytrain, self.evaluate_points(batch, return_log, evaluate, trials))
 
-						#Updating the GP.
-						gp.fit(xtrain, ytrain)
+						ymax = ytrain.max()
 
-						# Finding new argmax of the acquisition function.
-						x_max = self.acq_max(gp, ymax, restarts, bh_steps, self.log_bounds)
 						# Printing everything
-						pi.print_log(op_start, i, x_max, xmins, min_max_ratio, ymax, xtrain, ytrain, self.keys)
+						pi.print_log(op_start, i, batch[-1], xmins, min_max_ratio, ymax, xtrain, ytrain, self.keys)
+						i += 1
 
 
 				tmin, tsec = divmod((datetime.now() - total_time).total_seconds(), 60)
@@ -505,6 +598,165 @@ class bayes_opt:
 ################################################################################
 ################################################################################
 
+def latin_hypercube(n, bounds):
+		'''n points within bounds, exactly one of them in each of the n slices of every dimension.'''
+
+		dim = len(bounds)
+		slices = numpy.argsort(numpy.random.random_sample((n, dim)), axis = 0)
+		u = (slices + numpy.random.random_sample((n, dim))) / n
+
+		return bounds[:, 0] + u * (bounds[:, 1] - bounds[:, 0])
+
+
+
+################################################################################
+################################## Trial Log ###################################
+################################################################################
+
+class trial_log:
+		'''Persistent log of the evaluated points, one JSON object per line with the (log scaled)
+			 point, the parameters and the value found. Lines are flushed as they are written,
+			 so an interrupted optimization can resume from it. The first line holds the bounds
+			 the points were scaled with, and a log written with other bounds is rejected.'''
+
+		def __init__(self, file_path, bounds):
+				self.file_path = file_path
+				self.bounds = {key: [float(low), float(high)] for key, (low, high) in bounds.items()}
+
+		def write_header(self):
+				with open(self.file_path, 'w') as f:
+						f.write(json.dumps({'bounds': self.bounds}) + '\n')
+
+		def load(self, dim):
+				if not os.path.exists(self.file_path) or os.path.getsize(self.file_path) == 0:
+						self.write_header()
+
+				xs, ys = [], []
+				with open(self.file_path, 'r') as f:
+						header = json.loads(f.readline())
+						if header.get('bounds') != self.bounds:
+								raise ValueError('Trials in %s were logged with bounds %s, not %s.' % \
+																 (self.file_path, header.get('bounds'), self.bounds))
+
+						for line in f:
+								if line.strip():
+										trial = json.loads(line)
+										xs.append(trial['x'])
+										ys.append(trial['y'])
+
+				return numpy.asarray(xs, dtype = float).reshape((len(xs), dim)), numpy.asarray(ys, dtype = float)
+
+		def add(self, x, params, y):
+				if not os.path.exists(self.file_path):
+						self.write_header()
+
+				with open(self.file_path, 'a') as f:
+						f.write(json.dumps({'x': list(map(float, x)), 'params': {k: float(v) for k, v in params.items()}, 'y': float(y)}) + '\n')
+
+
+################################################################################
+############################### Gaussian Process ###############################
+################################################################################
+
+class gaussian_process:
+		'''Gaussian process with a constant mean estimated from the data (ordinary kriging) and the squared
+			 exponential correlation exp(-sum_l theta_l * (x_l - x'_l)^2), with theta given for the [0, 1]
+			 log scaled coordinates.
+
+			 The correlation parameters are fixed, so the Cholesky factor of the correlation matrix only
+			 depends on the points. When fit is called with the previous points followed by new ones, the
+			 factor is extended with the new rows instead of being computed again, and only the (cheap)
+			 triangular solves depend on the values. Predictions are computed for many points at once.
+
+			 Differences with the defaults of sklearn's GaussianProcess, which it replaces:
+
+			 - No normalization. sklearn scales X by the std of the training points, which changes as
+			   points are added and would invalidate the factor. Normalizing y has no effect on the
+			   predictions of ordinary kriging, as the mean and variance are fitted anyway.
+			 - theta0 = 1.0 instead of 0.1, to make up for the missing normalization: the coordinates
+			   are in [0, 1], where spread out points have a std of about 0.3, so sklearn's 0.1 on the
+			   normalized coordinates is about 0.1 / 0.3^2 = 1.1 here.
+			 - nugget = 1e-6 instead of 10 * machine epsilon, to keep the factor of nearby points (e.g.
+			   the Kriging believer batches) numerically positive definite.'''
+
+		def __init__(self, theta0 = 1.0, nugget = 1e-6):
+				self.theta = theta0
+				self.nugget = nugget
+
+				self.X = None
+				self.L = None
+
+		def set_params(self, **params):
+				'''Takes the parameters of sklearn's GaussianProcess that apply to this one.'''
+
+				for key, value in params.items():
+						if key == 'theta0':
+								self.theta = value
+						elif key == 'nugget':
+								self.nugget = value
+						elif (key, value) not in (('corr', 'squared_exponential'), ('regr', 'constant')):
+								raise ValueError("Gaussian process parameter not supported: %s = %s" % (key, value))
+
+				# The factor depends on the parameters
+				self.X = None
+				self.L = None
+
+		def corr(self, X1, X2):
+				scale = numpy.sqrt(numpy.asarray(self.theta, dtype = float))
+				X1, X2 = X1 * scale, X2 * scale
+
+				d2 = (X1**2).sum(axis = 1)[:, numpy.newaxis] + (X2**2).sum(axis = 1) - 2 * X1.dot(X2.T)
+				return numpy.exp(-numpy.maximum(d2, 0))
+
+		def fit(self, X, y):
+				X = numpy.atleast_2d(numpy.asarray(X, dtype = float))
+				y = numpy.asarray(y, dtype = float).ravel()
+
+				n = len(self.X) if self.X is not None else 0
+				if n and len(X) >= n and numpy.array_equal(X[:n], self.X):
+						if len(X) > n:
+								self.extend(X[n:])
+				else:
+						self.L = cholesky(self.corr(X, X) + self.nugget * numpy.eye(len(X)), lower = True)
+						self.X = X
+
+				# Constant mean and process variance by maximum likelihood
+				self.Rinv_ones = cho_solve((self.L, True), numpy.ones(len(y)))
+				self.beta = self.Rinv_ones.dot(y) / self.Rinv_ones.sum()
+				self.gamma = cho_solve((self.L, True), y - self.beta)
+				self.sigma2 = max((y - self.beta).dot(self.gamma) / len(y), 0.0)
+
+				return self
+
+		def extend(self, Xnew):
+				'''Appends the rows of Xnew to the Cholesky factor, [[L, 0], [L12', L22]].'''
+
+				n, m = len(self.X), len(Xnew)
+
+				L12 = solve_triangular(self.L, self.corr(self.X, Xnew), lower = True)
+				S = self.corr(Xnew, Xnew) + self.nugget * numpy.eye(m) - L12.T.dot(L12)
+
+				L = numpy.zeros((n + m, n + m))
+				L[:n, :n] = self.L
+				L[n:, :n] = L12.T
+				L[n:, n:] = cholesky(S, lower = True)
+
+				self.L = L
+				self.X = numpy.concatenate((self.X, Xnew), axis = 0)
+
+		def predict(self, x, eval_MSE = False):
+				'''Mean (and mean squared error) of the process at each row of x.'''
+
+				r = self.corr(numpy.atleast_2d(x), self.X)
+				mean = self.beta + r.dot(self.gamma)
+				if not eval_MSE:
+						return mean
+
+				v = solve_triangular(self.L, r.T, lower = True)
+				u = 1 - r.dot(self.Rinv_ones)
+				mse = self.sigma2 * (1 - (v**2).sum(axis = 0) + u**2 / self.Rinv_ones.sum())
+
+				return mean, numpy.maximum(mse, 0)
 
 
 ################################################################################
@@ -512,7 +764,7 @@ class bayes_opt:
 ################################################################################
 
 class acquisition:
-		'''An object to compute the acquisition functions.'''
+		'''An object to compute the acquisition functions, at each row of x at once.'''
 
 
 		def __init__(self, k = 1):
@@ -521,23 +773,26 @@ class acquisition:
 
 		def UCB(self, x, gp, ymax):
 				mean, var = gp.predict(x, eval_MSE = True)
-				return mean + self.kappa * sqrt(var)
+				return mean + self.kappa * numpy.sqrt(var)
 
 		def EI(self, x, gp, ymax):
 				mean, var = gp.predict(x, eval_MSE = True)
-				if var == 0:
-						return 0
-				else:
-						Z = (mean - ymax)/sqrt(var)
-						return (mean - ymax) * norm.cdf(Z) + sqrt(var) * norm.pdf(Z)
+				ei = numpy.zeros(len(mean))
+
+				pos = (var > 0)
+				std = numpy.sqrt(var[pos])
+				Z = (mean[pos] - ymax)/std
+				ei[pos] = (mean[pos] - ymax) * norm.cdf(Z) + std * norm.pdf(Z)
+				return ei
 
 		def PoI(self, x, gp, ymax):
 				mean, var = gp.predict(x, eval_MSE = True)
-				if var == 0:
-						return 1
-				else:
-						Z = (mean - ymax)/sqrt(var)
-						return norm.cdf(Z)
+				poi = numpy.ones(len(mean))
+
+				pos = (var > 0)
+				Z = (mean[pos] - ymax)/numpy.sqrt(var[pos])
+				poi[pos] = norm.cdf(Z)
+				return poi
 
 
 ################################################################################
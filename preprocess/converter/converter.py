@@ -8,6 +8,7 @@ from lxml import html
 import config
 
 import os
+import cgi
 import traceback
 import sys
 import time
@@ -18,12 +19,40 @@ import utils
 import logging
 from zeno.task_manager import NothingToProcessException
 
+# pdfminer allows converting the PDFs within the process, avoiding 
+# starting a JVM for each document. PDFBox is used if not available.
+try :
+	from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+	from pdfminer.converter import PDFPageAggregator
+	from pdfminer.layout import LAParams, LTTextBox
+	from pdfminer.pdfpage import PDFPage
+	HAS_PDFMINER = True
+except ImportError :
+	HAS_PDFMINER = False
+
 
 
 class Converter:
 
-	def __init__(self):
-		''' Converter constructor.'''
+	def __init__(self, batch_size=20, engine=None):
+		''' 
+		Converter constructor. <engine> is either 'pdfminer' or 'pdfbox'. If 
+		not given, pdfminer is used when available.
+		'''
+
+		# Number of tasks leased at once
+		self.batch_size = batch_size
+
+		if engine is None :
+			engine = "pdfminer" if HAS_PDFMINER else "pdfbox"
+		self.engine = engine
+
+		# The resource manager caches fonts across documents, so it's kept for 
+		# the whole life of the process. 
+		if self.engine == "pdfminer" :
+			self.rsrcmgr = PDFResourceManager(caching=True)
+			self.device = PDFPageAggregator(self.rsrcmgr, laparams=LAParams())
+			self.interpreter = PDFPageInterpreter(self.rsrcmgr, self.device)
 
 		# Zeno task manager
 		self.tasks = zeno.TasksManager("tasks", 
@@ -68,21 +97,67 @@ class Converter:
 		self.convert_pdfbox(infile, outfile)
 
 
-	def totxt(self, paperid):
+	def totxt(self, paperid, pars=None):
 		'''
 		Converts HTML to pure text by extracting all text elements from the the HTML.  
+		If the paragraphs were already extracted, they are used instead.
 		'''
 		infile  = config.HTML_PATH % paperid
 		outfile = config.TXT_PATH % paperid
 
-		h = html.parse(infile)
-		pars = h.xpath("//p")
-		text = ''.join([par.text_content() for par in pars])
+		if pars is None :
+			h = html.parse(infile)
+			pars = [par.text_content() for par in h.xpath("//p")]
+
+		text = ''.join(pars)
 		text = text.replace("-\n", "")
 	
 		with open(outfile, 'w') as f :
 			f.write(text.encode("UTF-8"))
 
+		return pars
+
+
+	def convert_pdfminer(self, paperid):
+		'''
+		Converts the PDF within the process and writes both the HTML and the text
+		files in a single pass. Each text box becomes a paragraph, so the HTML has
+		the same structure as the one output by PDFBox. Returns the paragraphs.
+		'''
+		pars = []
+		with open(config.PDF_PATH % paperid, 'rb') as f :
+			for page in PDFPage.get_pages(f) :
+				self.interpreter.process_page(page)
+				for obj in self.device.get_result() :
+					if isinstance(obj, LTTextBox) :
+						pars.append(obj.get_text())
+
+		if not pars :
+			raise Exception("No text could be extracted from %s." % paperid)
+
+		with open(config.HTML_PATH % paperid, 'w') as f :
+			body = '\n'.join(["<p>%s</p>" % cgi.escape(par) for par in pars])
+			f.write(("<html><body>\n%s\n</body></html>" % body).encode("UTF-8"))
+
+		return self.totxt(paperid, pars)
+
+
+	def convert(self, paperid):
+		''' 
+		Writes the HTML and text versions of the document and returns its 
+		paragraphs, so later stages don't need to parse the HTML again.
+		'''
+		if self.engine == "pdfminer" :
+			return self.convert_pdfminer(paperid)
+
+		self.tohtml(paperid)
+		return self.totxt(paperid)
+
+
+	def process(self, paper_id):
+		''' Converts a single document. Called by the zeno supervisor. '''
+		self.convert(paper_id)
+
 
 	def run(self):
 
@@ -91,28 +166,35 @@ class Converter:
 		# Keep running until a stop file is found
 		while (not os.path.exists("stop")) :
 
-			paper_id = None
 			try :
-				paper_id = self.tasks.get_next('DOWNLOADED')
-
-				self.tohtml(paper_id)
-				self.totxt(paper_id)
-
-				# Update the task status and the disk in which the file was saved. 
-				self.tasks.update_success(paper_id, 'CONVERTED')
-
-				# Everything went OK if got here
-				self.log.info("%s: OK" % paper_id)
+				paper_ids = self.tasks.get_next_batch('DOWNLOADED', self.batch_size)
 
 			# Nothing to collect
 			except NothingToProcessException:
 				self.log.warn("Nothing to process.")
 				time.sleep(10)
+				continue
+
+			done, failed = [], []
+			for paper_id in paper_ids :
+				try :
+					# Keep our leases alive while the batch is processed
+					self.tasks.heartbeat()
+
+					self.process(paper_id)
+					done.append(paper_id)
+
+					# Everything went OK if got here
+					self.log.info("%s: OK" % paper_id)
+
+				# Any other exception we log the traceback and life goes on
+				except Exception, e:
+					self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
+					failed.append((paper_id, str(e)))
 
-			# Any other exception we log the traceback, update the DB and life goes on
-			except Exception, e:
-				self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
-				self.tasks.update_error(paper_id, message=str(e))
+			# Update the whole batch at once
+			self.tasks.update_success(done, 'CONVERTED')
+			self.tasks.update_error_batch(failed)
 
 		# Last thing before exiting thread
 		self.close()
@@ -138,6 +220,8 @@ if __name__ == '__main__':
 	if nprocs==1:
 		Converter().run()
 
+	# Keeps waiting for new downloaded documents
 	else:
-		zeno.launch(Converter, nprocs)
+		zeno.supervise(Converter, nprocs, 'DOWNLOADED', 'CONVERTED', wait=True,
+									 tasks_params={'host': config.DB_HOST, 'user': config.DB_USER, 'passwd': config.DB_PASSWD})
 
@@ -107,6 +107,28 @@ class Downloader() :
 		img_file.close()
 
 
+	def process(self, paper_id):
+		''' 
+		Downloads a single document. Called by the zeno supervisor, so errors
+		are reported through exceptions.
+		'''
+		try :
+			self.download(paper_id)
+
+		# IP limit reached. Replace the proxy instance and give the task back.
+		except LimitReachedException:
+			self.log.error("%s: Limit Reached" % (paper_id))
+			self.ec2_manager.terminate_instance(self.ec2_instance_id)
+			self.ec2_instance_id, self.ec2_instance_dns =  self.ec2_manager.launch_instance_and_wait()
+			raise zeno.ReleaseTaskException("Request limit reached.")
+
+		except NotFoundException:
+			raise Exception("Document not found.")
+
+		except RequestException, e:
+			raise zeno.RetryTaskException(e.msg)
+
+
 	def run(self):
 
 		print "Starting %d." % os.getpid()
@@ -196,5 +218,6 @@ if __name__ == '__main__':
 						 'ec2_instance_dns': i.public_dns_name} for i in instances]
 
 		# If args is a list or tuple, then each process gets its own argument dict
-		zeno.launch(Downloader, nprocs, args)
+		zeno.supervise(Downloader, nprocs, "START", "DOWNLOADED", args, batch_size=10,
+									 tasks_params={'host': config.DB_HOST, 'user': config.DB_USER, 'passwd': config.DB_PASSWD})
 	
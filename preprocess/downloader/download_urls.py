@@ -36,11 +36,14 @@ class LimitReachedException(Exception):
 
 class Downloader() :
 	
-	def __init__(self):
+	def __init__(self, batch_size=10):
 		'''
 		Stores the process id and creates a task manager to get 
 		and update tasks.
 		'''
+		# Number of tasks leased at once
+		self.batch_size = batch_size
+
 		# Zeno task manager
 		self.tasks = zeno.TasksManager("tasks", 
 																	 host=config.DB_HOST, 
@@ -163,6 +166,24 @@ class Downloader() :
 		return False
 
 
+	def process(self, paper_id) :
+		''' 
+		Downloads a single document. Called by the zeno supervisor, so errors
+		are reported through exceptions.
+		'''
+		try :
+			if not self.download(paper_id) :
+				raise DownloadException("Could not download paper '%s'." % paper_id)
+
+		# Not the paper's fault. Give the tasks back and hold this worker for a while.
+		except LimitReachedException:
+			self.log.error("Request limit reached!! Waiting...")
+			raise zeno.ReleaseTaskException("Request limit reached. Will try again later.", pause=60*60)
+
+		except requests.exceptions.RequestException, e:
+			raise zeno.RetryTaskException(str(e))
+
+
 	def run(self) :
 
 		self.log.info("Starting %s." % os.getpid())
@@ -171,41 +192,55 @@ class Downloader() :
 		while (not os.path.exists("stop")) :
 
 			try :
-				paper_id = self.tasks.get_next("START")
-
-				if not self.download(paper_id) :
-					raise DownloadException("Could not download paper '%s'." % paper_id)
-
-				# Update the task status and the disk in which the file was saved. 
-				self.tasks.update_success(paper_id, "DOWNLOADED")
-
-				# Everything went OK if got here
-				self.log.info("%s: OK" % paper_id)
+				paper_ids = self.tasks.get_next_batch("START", self.batch_size)
 
 			# Nothing to collect
 			except NothingToProcessException:
 				self.log.error("Nothing to process.")
 				break
 
-			except LimitReachedException:
-				self.log.error("Request limit reached!! Waiting...")
-				self.tasks.update_release(paper_id, "Request limit reached. Will try again later.")
-				time.sleep(60*60)
-
-			# URL missing in the DB or not returning the resource.
-			except DownloadException, e:
-				self.log.error("%s: FAIL" % (paper_id))
-				self.tasks.update_error(paper_id, message=str(e))
-
-			# Request errors
-# 			except RequestException, e:
-# 				self.log("%s: %s\n%s" % (paper_id, e.msg, traceback.format_exc()), show=True)
-# 				self.db.update_status(paper_id, DBManager.DOWNLOAD_ERROR)
-
-			# Any other exception we log the traceback, update the DB and life goes on
-			except Exception, e:
-				self.log.error("%s: FAIL: %s" % (paper_id, traceback.format_exc()))
-				self.tasks.update_error(paper_id, message=str(e))
+			done, failed = [], []
+			for i, paper_id in enumerate(paper_ids) :
+				try :
+					# Keep our leases alive while the batch is processed
+					self.tasks.heartbeat()
+
+					if not self.download(paper_id) :
+						raise DownloadException("Could not download paper '%s'." % paper_id)
+
+					done.append(paper_id)
+
+					# Everything went OK if got here
+					self.log.info("%s: OK" % paper_id)
+
+				# Release this and the remaining tasks of the batch, since the problem is not with them
+				except LimitReachedException:
+					self.log.error("Request limit reached!! Waiting...")
+					self.tasks.update_release(paper_ids[i:], "Request limit reached. Will try again later.")
+					self.tasks.update_success(done, "DOWNLOADED")
+					self.tasks.update_error_batch(failed)
+					done, failed = [], []
+					time.sleep(60*60)
+					break
+
+				# URL missing in the DB or not returning the resource.
+				except DownloadException, e:
+					self.log.error("%s: FAIL" % (paper_id))
+					failed.append((paper_id, str(e)))
+
+				# Request problems (timeouts, broken transfers) are usually transient, so try again later
+				except requests.exceptions.RequestException, e:
+					self.log.error("%s: RETRY: %s" % (paper_id, traceback.format_exc()))
+					self.tasks.update_retry(paper_id, message=str(e))
+
+				# Any other exception we log the traceback, update the DB and life goes on
+				except Exception, e:
+					self.log.error("%s: FAIL: %s" % (paper_id, traceback.format_exc()))
+					failed.append((paper_id, str(e)))
+
+			# Update the whole batch at once
+			self.tasks.update_success(done, "DOWNLOADED")
+			self.tasks.update_error_batch(failed)
 
 		# Last thing before exiting thread
 		self.close()
@@ -238,8 +273,8 @@ if __name__ == '__main__':
 		Downloader().run()
 
 	else:
-		
-		zeno.launch(Downloader, nprocs)
+		zeno.supervise(Downloader, nprocs, "START", "DOWNLOADED", batch_size=10,
+									 tasks_params={'host': config.DB_HOST, 'user': config.DB_USER, 'passwd': config.DB_PASSWD})
 #			proc = mp.Process(target=launch, args=(Downloader(tid),))
 #			proc.start()
 
@@ -10,7 +10,6 @@ import os
 import traceback
 import sys
 import re
-from collections import Counter
 # from relevance.topics import get_docs
 from lxml import html
 from subprocess import call, PIPE
@@ -20,6 +19,8 @@ import config
 import logging
 import utils
 from zeno.task_manager import NothingToProcessException
+from preprocess.converter.converter import Converter
+from words.token_store import TokenStore
 
 
 stemmer = PorterStemmer()
@@ -48,7 +49,14 @@ def match_any(text, names):
 
 class Tokenizer() :
 
-	def __init__(self) :
+	# Tasks states this stage reads from and moves to
+	from_state = "CONVERTED"
+	to_state = "TOKENIZED"
+
+	def __init__(self, batch_size=20) :
+
+		# Number of tasks leased at once
+		self.batch_size = batch_size
 
 		# Zeno task manager
 		self.tasks = zeno.TasksManager("tasks", 
@@ -69,24 +77,26 @@ class Tokenizer() :
 
 		self.MIN_TOKENS = 10
 
-		# Create folders with non existing
-		utils.ensure_folder(os.path.dirname(config.TOKENS_PATH))
-		utils.ensure_folder(os.path.dirname(config.TOKENS_PATH_PARTS))
+		# Titles and abstracts prefetched for the current batch
+		self.texts = {}
 
+		# Packed stores for the full text and the important parts token counts
+		self.store = TokenStore(config.TOKENS_STORE)
+		self.parts_store = TokenStore(config.TOKENS_STORE_PARTS)
 
-	def save_tokens(self, tokens, tok_file) :
-		counter = Counter(tokens)
-		with open(tok_file, 'w') as f :
-# 			print >> f, (' '.join(tokens)).encode("utf-8")
-			lines = ["%s %d" % (token, count) for (token, count) in counter.items()]
-			print >> f, '\n'.join(lines).encode("UTF-8")
 
+	def parse_paragraphs(self, html_file) :
+		''' Open and parse HTML, then extract all textual content from each paragraph '''
+		h = html.parse(html_file) #, parser=etree.XMLParser(encoding="utf-8"))
+		return [paragraph.text_content() for paragraph in h.xpath("//p")]
 
-	def get_section(self, html_file, possible_section_names, possible_next_sections):
 
-		# Open and parse HTML, then extract all textual content from each paragraph 
-		h = html.parse(html_file) #, parser=etree.XMLParser(encoding="utf-8"))
-		pars = [paragraph.text_content().lower().encode("UTF-8") for paragraph in h.xpath("//p")]   # .encode("utf-8")
+	def find_section(self, pars, possible_section_names, possible_next_sections):
+		'''
+		Returns the content of the section starting at a paragraph matching one of the
+		<possible_section_names> up to the one matching one of <possible_next_sections>.
+		The paragraphs are expected to be lower case.
+		'''
 
 		# First we go backwards trying to find the latest occurrence of 
 		# one of the possible names of the section of interest 
@@ -98,7 +108,7 @@ class Tokenizer() :
 
 		# If the start wasn't found, just halt right away	
 		if (begin is None) :
-			return ""
+			return u""
 
 		# Otherwise we can look for the end of the section starting from the start
 		# of the found section.
@@ -111,67 +121,127 @@ class Tokenizer() :
 		# End of section not found, so it's not safe to keep this content, 
 		# so we return an empty string.
 		if (end is None) :
-			return ""
+			return u""
 
 		# Otherwise join all paragraphs inside the section found
-		return unicode("".join([fix_hyphens(p) for p in pars[begin:end]]), "UTF-8")
+		return u"".join([fix_hyphens(p) for p in pars[begin:end]])
+
+
+	def get_section(self, html_file, possible_section_names, possible_next_sections):
+
+		pars = [par.lower() for par in self.parse_paragraphs(html_file)]
+		return self.find_section(pars, possible_section_names, possible_next_sections)
+
+
+	def prefetch(self, paper_ids) :
+		''' 
+		Loads the titles and abstracts of a batch of papers with a single query.
+		Those left from the previous batch (papers that failed before using them)
+		are dropped.
+		'''
+		self.texts = {}
+		if not paper_ids :
+			return
+
+		ids_str = ",".join(["'%s'" % paper_id for paper_id in paper_ids])
+		rows = self.db.select(["id", "title", "abstract"], table="papers", where="id IN (%s)" % ids_str)
+		for paper_id, title, abstract in rows :
+			self.texts[str(paper_id)] = (title, abstract)
 
 
 	def get_title_and_abstract(self, paper_id) :
-		title, abstract = self.db.select_one(["title", "abstract"], table="papers", where="id='%s'"%paper_id)
+
+		# Use the prefetched values if available
+		if paper_id in self.texts :
+			title, abstract = self.texts.pop(paper_id)
+		else :
+			title, abstract = self.db.select_one(["title", "abstract"], table="papers", where="id='%s'"%paper_id)
+
 		if title is None : title = ""
 		if abstract is None : abstract = ""
 
 		return title, abstract
 
 
-	def process_full_text(self, paper_id):
-		'''
-		Tokenizes and store in disk the full text of the document provided.
-		'''
-		txt_file  = config.TXT_PATH % paper_id
-		tok_file  = config.TOKENS_PATH % paper_id
-
-		with open(txt_file, 'r') as f :
-			text = unicode(f.read(), "utf-8")
+	def tokenize_full_text(self, text) :
 
 		tokens = utils.tokenize(text)
 		if (len(tokens) < self.MIN_TOKENS) :
 			raise MinimumTokensException('''Minimum number of tokens (%d) could not be extracted. 
 			 				Document is likely to be badly encoded.''' % self.MIN_TOKENS)
-
-		self.save_tokens(tokens, tok_file) 
+		return tokens
 
 
-	def process_important_parts(self, paper_id): 
+	def tokenize_important_parts(self, paper_id, pars) :
 		'''
-		Tokenizes some specific parts of the document deemed as important, like
-		the title, abstract and conclusion.
+		Tokenizes the title and abstract (from the DB) and the conclusion, 
+		extracted from the given document paragraphs.
 		'''
-		html_file = config.HTML_PATH % paper_id
-		tokens_file = config.TOKENS_PATH_PARTS % paper_id
-
 		# Get title and abstract from DB
 		title, abstract = self.get_title_and_abstract(paper_id)
 
 		# Get conclusion from full text
-		conclusion = self.get_section(html_file, ['conclusion', 'concluding', 'summary'], 
-																	['reference', 'bibliography', 'acknowledg', 'appendix'])
+		conclusion = self.find_section([par.lower() for par in pars], 
+																	 ['conclusion', 'concluding', 'summary'], 
+																	 ['reference', 'bibliography', 'acknowledg', 'appendix'])
 
 		# Uncomment if you don't want to use the abstract from the DB
-#		abstract = self.get_section(html_file, ['abstract'], ['categories', 'keywords', 'introduction'])
+#		abstract = self.find_section(pars, ['abstract'], ['categories', 'keywords', 'introduction'])
 
-		# Tokenize each part and save into a file
+		# Tokenize each part
 		tokens = []
-		tokens += utils.tokenize(title)
-		tokens += utils.tokenize(abstract)
-		tokens += utils.tokenize(conclusion)
+		for part_tokens in utils.tokenize_many([title, abstract, conclusion]) :
+			tokens += part_tokens
 
 		if (len(tokens) < self.MIN_TOKENS) :
 			raise MinimumTokensException(("Minimum number of tokens (%d) could not be extracted." % self.MIN_TOKENS) +
 											 "Document is likely to have decoding problems." )
+		return tokens
 
-		self.save_tokens(tokens, tokens_file)
+
+	def process_full_text(self, paper_id):
+		'''
+		Tokenizes and store in disk the full text of the document provided.
+		'''
+		txt_file  = config.TXT_PATH % paper_id
+
+		with open(txt_file, 'r') as f :
+			text = unicode(f.read(), "utf-8")
+
+		self.store.add(paper_id, self.tokenize_full_text(text))
+
+
+	def process_important_parts(self, paper_id): 
+		'''
+		Tokenizes some specific parts of the document deemed as important, like
+		the title, abstract and conclusion.
+		'''
+		pars = self.parse_paragraphs(config.HTML_PATH % paper_id)
+		self.parts_store.add(paper_id, self.tokenize_important_parts(paper_id, pars))
+
+
+	def process_paragraphs(self, paper_id, pars) :
+		'''
+		Tokenizes the full text and the important parts of a document from its 
+		already parsed paragraphs. Both are tokenized before anything is stored,
+		but the two stores are written one after the other, so if the second
+		write fails the full text alone is stored. The document then fails and
+		is written again (the last entry wins) when it's processed again.
+		'''
+		# Same text written to TXT_PATH by the converter
+		full_tokens = self.tokenize_full_text(fix_hyphens(u"".join(pars)))
+		parts_tokens = self.tokenize_important_parts(paper_id, pars)
+
+		self.store.add(paper_id, full_tokens)
+		self.parts_store.add(paper_id, parts_tokens)
+
+
+	def process(self, paper_id) :
+		''' Tokenizes a single document. Called by the zeno supervisor. '''
+
+		# The HTML is parsed once for both the full text and the important parts
+		pars = self.parse_paragraphs(config.HTML_PATH % paper_id)
+		self.process_paragraphs(paper_id, pars)
 
 
 	def run(self) :
@@ -182,31 +252,50 @@ class Tokenizer() :
 		while (not os.path.exists("stop")) :
 
 			try :
-				paper_id = self.tasks.get_next("CONVERTED")
-
-				# Pre-processes the full text and only the important parts to different folders 
-				self.process_full_text(paper_id)
-				self.process_important_parts(paper_id)
-
-				# Update the task status and the disk in which the file was saved. 
-				self.tasks.update_success(paper_id, "TOKENIZED")
-
-				# Everything went OK if got here
-				self.log.info("%s: OK" % paper_id)
+				paper_ids = self.tasks.get_next_batch(self.from_state, self.batch_size)
 
 			# Nothing to collect
 			except NothingToProcessException:
 				self.log.info("Nothing to process.")
 				break
 
-			except MinimumTokensException, e :
-				self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
-				self.tasks.update_error(paper_id, message=str(e))
+			done, failed = [], []
+			try :
+				self.prefetch(paper_ids)
+
+				for paper_id in paper_ids :
+					try :
+						# Keep our leases alive while the batch is processed
+						self.tasks.heartbeat()
+
+						self.process(paper_id)
+						done.append(paper_id)
+
+						# Everything went OK if got here
+						self.log.info("%s: OK" % paper_id)
+
+					except MinimumTokensException, e :
+						self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
+						failed.append((paper_id, str(e)))
+
+					# Any other exception we log the traceback and update the DB
+					except Exception:
+						self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
+						failed.append((paper_id, "TOKENIZE_ERROR"))
+
+			# Texts of papers that failed before using them
+			finally :
+				self.texts.clear()
+
+			# Update the whole batch at once
+			self.tasks.update_success(done, self.to_state)
+			self.tasks.update_error_batch(failed)
 
-			# Any other exception we log the traceback and update the DB
-			except Exception:
-				self.log.error("%s: FAIL\n%s\n" % (paper_id, traceback.format_exc()))
-				self.tasks.update_error(paper_id, "TOKENIZE_ERROR")
+
+	def close(self):
+		'''Clean up routine'''
+		self.db.close()
+		self.tasks.close()
 
 
 	def test_extracted_words(self) :
@@ -214,15 +303,10 @@ class Tokenizer() :
 		Simples manual verification of the extracted tokens.
 		'''
 
-		def parse_line(line):
-			token, count = line.strip().split()
-			return (int(count), unicode(token, "UTF-8"))
-	
 		ids = self.db.select(fields="id", table="tasks", where="status='TOKENIZED'")
 		for id in ids :
 
-			with open(config.TOKENS_PATH_PARTS % id) as f :
-				words = map(parse_line, f.readlines())
+			words = [(count, token) for token, count in self.parts_store.get_tokens(id)]
 			
 			print "\n-- %s --" % id
 			print "\n".join(map(str,sorted(words, reverse=True)[:6]))
@@ -230,6 +314,29 @@ class Tokenizer() :
 			call(["google-chrome", "--incognito", "/data/pdf/%s.pdf"%id], stdout=PIPE, stderr=PIPE)
 
 
+class ConverterTokenizer(Tokenizer) :
+	'''
+	Fused conversion and tokenization stage. Each downloaded document is
+	converted and its paragraphs are tokenized straight from memory, so the
+	document is parsed only once and goes from DOWNLOADED to TOKENIZED.
+	'''
+	from_state = "DOWNLOADED"
+	to_state = "TOKENIZED"
+
+	def __init__(self, batch_size=20, engine=None) :
+		Tokenizer.__init__(self, batch_size)
+		self.converter = Converter(batch_size, engine)
+
+
+	def process(self, paper_id) :
+		pars = self.converter.convert(paper_id)
+		self.process_paragraphs(paper_id, pars)
+
+
+	def close(self) :
+		self.converter.close()
+		Tokenizer.close(self)
+
 
 if __name__ == "__main__" :
 
@@ -237,10 +344,16 @@ if __name__ == "__main__" :
 	if len(sys.argv)>1 :
 		nprocs = int(sys.argv[1])
 
+	# Converts and tokenizes in the same stage if 'fused' is given
+	cls = Tokenizer
+	if len(sys.argv)>2 and sys.argv[2]=="fused" :
+		cls = ConverterTokenizer
+
 	# If only 1 process do not use multiprocessing for easier debbuging
 	if nprocs==1:
-		Tokenizer().run()
-
+		cls().run()
 
-	zeno.launch(Tokenizer, nprocs)
+	else:
+		zeno.supervise(cls, nprocs, cls.from_state, cls.to_state, chunk_size=20,
+									 tasks_params={'host': config.DB_HOST, 'user': config.DB_USER, 'passwd': config.DB_PASSWD})
 
@@ -4,44 +4,385 @@ Created on Jun 12, 2014
 @author: luamct
 '''
 
+import os
 import sys
+import time
+import threading
 import lucene
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from config import INDEX_PATH, DATA
 
 from java.io import File
 from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.document import Document, Field, FieldType
-from org.apache.lucene.index import FieldInfo, IndexWriter, IndexWriterConfig, DirectoryReader, Term, MultiFields
+from org.apache.lucene.document import Document, Field, FieldType, SortedDocValuesField, NumericDocValuesField
+from org.apache.lucene.index import FieldInfo, IndexWriter, IndexWriterConfig, DirectoryReader, Term, MultiFields, ReaderUtil, AtomicReaderContext
 from org.apache.lucene.store import RAMDirectory, SimpleFSDirectory
-from org.apache.lucene.util import Version
-from org.apache.lucene.search import IndexSearcher
+from org.apache.lucene.util import Version, BytesRef
+from org.apache.lucene.search import IndexSearcher, SearcherManager, CachingWrapperFilter
 from org.apache.lucene.search.similarities import BM25Similarity
 from org.apache.lucene.queryparser.classic import QueryParser, MultiFieldQueryParser
 from org.apache.lucene.queries import TermsFilter
 
+# Filters implemented in Python need PyLucene's extension classes
+try :
+	from org.apache.pylucene.search import PythonFilter
+	from org.apache.lucene.util import FixedBitSet
+	from org.apache.lucene.search import BitsFilteredDocIdSet
+	HAS_PYTHON_FILTER = True
+except ImportError :
+	HAS_PYTHON_FILTER = False
+
 # from lucene import RamDirectory, System, File, Document, \
 # 									Field, StandardAnalyzer, IndexWriter, Version
 
+# The JVM is started only once per process and shared by every index
+_vm = None
+_vm_lock = threading.Lock()
+
+# Threads already attached to the JVM
+_attached = threading.local()
+
+
+def get_vm() :
+	global _vm
+	with _vm_lock :
+		if _vm is None :
+			_vm = lucene.getVMEnv() or lucene.initVM()
+	return _vm
+
+
+def attach_thread() :
+	'''
+	Attaches the calling thread to the JVM. Required before any Lucene call
+	from a thread other than the one that started the JVM, but it's safe (and
+	cheap) to call it multiple times.
+	'''
+	vm = get_vm()
+	if not getattr(_attached, "done", False) :
+		vm.attachCurrentThread()
+		_attached.done = True
+
+
+class SearcherPool :
+	'''
+	Searchers over an index shared by every Index instance and thread of the
+	process, through Lucene's SearcherManager. They're refreshed at most every
+	'refresh_interval' seconds, so committed changes (or just added ones, if
+	the pool was opened from a writer) become visible without reopening the
+	index. Searchers must be released after use.
+	'''
+
+	def __init__(self, directory, writer=None, refresh_interval=1.0) :
+		if writer :
+			self.manager = SearcherManager(writer, True, None)
+		else :
+			self.manager = SearcherManager(directory, None)
+
+		self.writer = writer
+		self.refresh_interval = refresh_interval
+		self.last_refresh = time.time()
+
+		# Candidate set filters for this index
+		self.filters = FilterCache()
+
+		# Doc values readers of the current searchers
+		self.columns = ColumnCache()
+
+
+	def acquire(self) :
+		if (time.time() - self.last_refresh) > self.refresh_interval :
+			self.last_refresh = time.time()
+			self.manager.maybeRefresh()
+
+		return IndexSearcher.cast_(self.manager.acquire())
+
+
+	def release(self, searcher) :
+		self.manager.release(searcher)
+
+
+	def refresh(self) :
+		self.manager.maybeRefreshBlocking()
+		self.last_refresh = time.time()
+
+
+	def close(self) :
+		self.manager.close()
+
+
+class SegmentIds :
+	'''
+	Paper id -> doc id (local to the segment) of every document in a segment,
+	read from the terms of the 'id' field. Deleted documents are included, as
+	they are masked by the live docs when searching, so the map stays valid for
+	as long as the segment (its core) exists.
+	'''
+
+	def __init__(self, reader) :
+		self.docids = {}
+
+		# Ids found more than once (e.g. updated within the same segment)
+		self.extra = []
+
+		terms = reader.terms("id")
+		if terms is None :
+			return
+
+		terms_enum = terms.iterator(None)
+		while True :
+			term = terms_enum.next()
+			if term is None :
+				break
+
+			id = term.utf8ToString()
+			docs = terms_enum.docs(None, None)
+			doc = docs.nextDoc()
+			while doc != docs.NO_MORE_DOCS :
+				if id in self.docids :
+					self.extra.append((id, doc))
+				else :
+					self.docids[id] = doc
+				doc = docs.nextDoc()
+
+
+	def lookup(self, ids) :
+		''' Sorted local doc ids of the given paper ids found in the segment. '''
+		docs = [self.docids[id] for id in ids if id in self.docids]
+		docs += [doc for id, doc in self.extra if id in ids]
+		return np.sort(np.asarray(docs, dtype=np.int64))
+
+
+if HAS_PYTHON_FILTER :
+
+	class DocsFilter(PythonFilter) :
+		'''
+		Filter accepting a fixed set of papers. The bitset of each segment is
+		built with numpy from the segment's id map and handed to Lucene in a
+		single call. Bitsets are kept by segment core, so they're reused by
+		later readers sharing the segment.
+		'''
+
+		def __init__(self, ids, cache) :
+			super(DocsFilter, self).__init__()
+			self.ids = ids
+			self.cache = cache
+			self.bitsets = {}
+
+
+		def getDocIdSet(self, context, acceptDocs) :
+			reader = context.reader()
+			core_key = reader.getCoreCacheKey()
+
+			bitset = self.bitsets.get(core_key)
+			if bitset is None :
+				maxdoc = reader.maxDoc()
+				local = self.cache.segment(reader).lookup(self.ids)
+
+				words = np.zeros((maxdoc + 63) // 64, dtype=np.int64)
+				np.bitwise_or.at(words, local >> 6, np.left_shift(np.ones(len(local), dtype=np.int64), local & 63))
+				bitset = FixedBitSet(lucene.JArray('long')(words.tolist()), maxdoc)
+				self.bitsets[core_key] = bitset
+
+			return BitsFilteredDocIdSet.wrap(bitset, acceptDocs)
+
+
+class FilterCache :
+	'''
+	Filters restricting a search to a set of papers, cached by candidate set.
+	Paper ids are translated to Lucene doc ids through a map kept per segment
+	(by its core cache key), so a new candidate set costs a bitset construction
+	instead of one term lookup per id, and when the index changes only the new
+	segments are mapped. Without PyLucene's extension classes it falls back to
+	cached TermsFilters.
+	'''
+
+	def __init__(self, size=32) :
+		self.size = size
+		self.lock = threading.Lock()
+
+		self.core_keys = set()
+		self.segments = {}
+		self.filters = OrderedDict()
+
+
+	def segment(self, reader) :
+		''' Id map of the given segment reader, built on first use. '''
+		core_key = reader.getCoreCacheKey()
+		with self.lock :
+			if core_key not in self.segments :
+				self.segments[core_key] = SegmentIds(reader)
+			return self.segments[core_key]
+
+
+	def prune(self, reader) :
+		'''
+		Drops the maps and bitsets of segments no longer in the reader (e.g.
+		merged away). Must be called holding the lock.
+		'''
+		core_keys = set([AtomicReaderContext.cast_(leaf).reader().getCoreCacheKey() for leaf in reader.leaves()])
+		if core_keys == self.core_keys :
+			return
+
+		self.core_keys = core_keys
+		for core_key in self.segments.keys() :
+			if core_key not in core_keys :
+				del self.segments[core_key]
+
+		if HAS_PYTHON_FILTER :
+			for filter in self.filters.values() :
+				for core_key in filter.bitsets.keys() :
+					if core_key not in core_keys :
+						del filter.bitsets[core_key]
+
+
+	def get(self, reader, doc_ids) :
+
+		key = frozenset([str(doc_id) for doc_id in doc_ids])
+		with self.lock :
+			self.prune(reader)
+
+			if key in self.filters :
+				filter = self.filters.pop(key)
+
+			elif HAS_PYTHON_FILTER :
+				filter = DocsFilter(key, self)
+
+			else :
+				filter = CachingWrapperFilter(TermsFilter([Term("id", id) for id in key]))
+
+			# Most recently used go last
+			self.filters[key] = filter
+			if len(self.filters) > self.size :
+				self.filters.popitem(last=False)
+
+			return filter
+
+
+# Pools by index folder
+_pools = {}
+_pools_lock = threading.Lock()
+
+
 class DocField() :
-	def __init__(self, name, **kwargs):
+	'''
+	Index field description. Keyword arguments are FieldType properties (e.g.
+	stored=True, indexed=True). 'docvalues' can be "sorted" (strings) or
+	"numeric" (integers) to also store the field column-wise, so it can be
+	read for many hits without loading their stored documents.
+	'''
+	def __init__(self, name, docvalues=None, **kwargs):
 		self.name = name
+		self.docvalues = docvalues
 		self.props = kwargs
 
 
+def sorted_value(values, doc) :
+	ref = BytesRef()
+	values.get(doc, ref)
+	return ref.utf8ToString()
+
+
+class Columns :
+	'''
+	Reads the doc values of some fields for hits given by (global) doc id. The
+	values are read from each segment directly: the hit is mapped to its segment
+	with ReaderUtil.subIndex, so no merged view over the whole index is built.
+	'''
+
+	def __init__(self, leaves, getters) :
+		self.leaves = leaves
+		self.bases = [AtomicReaderContext.cast_(leaf).docBase for leaf in leaves]
+		self.getters = getters
+
+
+	def row(self, doc) :
+		''' Values of the fields for the given doc id. '''
+		i = ReaderUtil.subIndex(doc, self.leaves)
+		local = doc - self.bases[i]
+		return [get(local) for get in self.getters[i]]
+
+
+def column_getters(reader, fields) :
+	'''
+	Columns reading the given fields' doc values on each segment of the reader.
+	Returns None if any of the fields has no doc values (e.g. older indexes).
+	'''
+	leaves = reader.leaves()
+
+	getters = []
+	for leaf in leaves :
+		leaf_reader = AtomicReaderContext.cast_(leaf).reader()
+		infos = leaf_reader.getFieldInfos()
+
+		leaf_getters = []
+		for field in fields :
+			info = infos.fieldInfo(field)
+			if (info is None) or (not info.hasDocValues()) :
+				return None
+
+			if info.getDocValuesType() == FieldInfo.DocValuesType.NUMERIC :
+				values = leaf_reader.getNumericDocValues(field)
+				leaf_getters.append(lambda doc, values=values: values.get(doc))
+			else :
+				values = leaf_reader.getSortedDocValues(field)
+				leaf_getters.append(lambda doc, values=values: sorted_value(values, doc))
+
+		getters.append(leaf_getters)
+
+	return Columns(leaves, getters)
+
+
+class ColumnCache :
+	'''
+	Columns by requested fields, kept while the reader generation (its version)
+	doesn't change. Lucene hands out doc values per thread, so each thread
+	keeps its own.
+	'''
+
+	def __init__(self) :
+		self.local = threading.local()
+
+
+	def get(self, reader, fields) :
+
+		version = DirectoryReader.cast_(reader).getVersion()
+		if getattr(self.local, "version", None) != version :
+			self.local.version = version
+			self.local.columns = {}
+
+		fields = tuple(fields)
+		if fields not in self.local.columns :
+			self.local.columns[fields] = column_getters(reader, fields)
+
+		return self.local.columns[fields]
+
+
 class Index :
 	
 	def __init__(self, folder=None, fields=[], similarity="tfidf"):
 
-		self.jcc = lucene.initVM()
+		self.jcc = get_vm()
 
+		self.folder = os.path.abspath(folder) if folder else None
 		if folder :
 			self.directory = SimpleFSDirectory(File(folder))
 		else:
 			self.directory = RAMDirectory()
 
 		self.fields = {}
+		self.docvalues = {}
 
 		for field in fields :
+			if field.docvalues :
+				self.docvalues[field.name] = field.docvalues
+
+			# Doc values only field
+			if not field.props :
+				continue
+
 			ft = FieldType()
 			for pname, pvalue in field.props.items() :
 				setter = getattr(ft, "set"+pname.capitalize())
@@ -55,36 +396,81 @@ class Index :
 		self.similarity = similarity.lower()
 		self.analyzer = StandardAnalyzer(Version.LUCENE_CURRENT)
 		self.writer = None
-		self.searcher = None
+		self.pool = None
 
 
 	def attach_thread(self) :
-		self.jcc.attachCurrentThread()
+		attach_thread()
 
 
-	def open_writer(self) :
-
+	def open_writer(self, create=True, ram_buffer_mb=None) :
+		'''
+		Opens the writer. If 'create' is False, documents are added to the
+		existing index. A bigger RAM buffer means fewer, larger, segments
+		flushed while bulk indexing.
+		'''
 		config = IndexWriterConfig(Version.LUCENE_CURRENT, self.analyzer)
-		config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
+		if create :
+			config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
+		else :
+			config.setOpenMode(IndexWriterConfig.OpenMode.CREATE_OR_APPEND)
 
-		self.writer = IndexWriter(self.directory, config)
+		if ram_buffer_mb :
+			config.setRAMBufferSizeMB(float(ram_buffer_mb))
 
+		self.writer = IndexWriter(self.directory, config)
 
-	def add(self, **doc) :
 
-		if not self.writer :
-			self.open_writer()
+	def make_document(self, doc) :
 
 		d = Document()
 		for field, value in doc.items() :
-#			try :
+			if field in self.fields :
 				d.add(Field(field, value, self.fields[field]))
-#			except Exception, e :
-#				print 
-#				print "Fudeu"
-#				pass
 
-		self.writer.addDocument(d)
+			if field in self.docvalues :
+				if self.docvalues[field] == "numeric" :
+					d.add(NumericDocValuesField(field, long(value or 0)))
+				else :
+					d.add(SortedDocValuesField(field, BytesRef(value)))
+
+		return d
+
+
+	def add(self, **doc) :
+		'''
+		Adds a document. The writer is thread-safe, so several threads can add
+		documents concurrently.
+		'''
+		attach_thread()
+		if not self.writer :
+			self.open_writer()
+
+		self.writer.addDocument(self.make_document(doc))
+
+
+	def update(self, key, **doc) :
+		'''
+		Replaces the documents with the same value in the 'key' field (e.g. "id")
+		by the given one, or just adds it if there's none.
+		'''
+		attach_thread()
+		if not self.writer :
+			self.open_writer(create=False)
+
+		self.writer.updateDocument(Term(key, doc[key]), self.make_document(doc))
+
+
+	def delete(self, key, value) :
+		attach_thread()
+		if not self.writer :
+			self.open_writer(create=False)
+
+		self.writer.deleteDocuments(Term(key, value))
+
+
+	def merge(self, max_segments=1) :
+		self.writer.forceMerge(max_segments)
 
 
 	def commit(self) :
@@ -93,14 +479,65 @@ class Index :
 
 	def close(self):
 		if self.writer :
+			# Pools opened from this writer can't be used after it's closed
+			if self.pool and (self.pool.writer is self.writer) :
+				with _pools_lock :
+					if _pools.get(self.folder) is self.pool :
+						del _pools[self.folder]
+				self.pool.close()
+				self.pool = None
+
 			self.writer.close()
+			self.writer = None
+
+
+	def get_pool(self) :
+		'''
+		The searchers pool of this index folder, shared by the whole process.
+		In-memory indexes get their own pool.
+		'''
+		if self.pool is None :
+			if self.folder is None :
+				self.pool = SearcherPool(self.directory, self.writer)
+			else :
+				with _pools_lock :
+					if self.folder not in _pools :
+						_pools[self.folder] = SearcherPool(self.directory, self.writer)
+					self.pool = _pools[self.folder]
+
+		return self.pool
 
 
 	def open_searcher(self):
-		self.reader = DirectoryReader.open(self.directory)
-		self.searcher = IndexSearcher(self.reader)
-		if (self.similarity == "bm25") :
-			self.searcher.setSimilarity(BM25Similarity())
+		'''
+		Makes the latest changes to the index visible to the searchers.
+		'''
+		attach_thread()
+		self.get_pool().refresh()
+
+
+	@contextmanager
+	def searching(self) :
+		'''
+		Acquires a searcher from the shared pool, using this index' similarity,
+		and releases it when done. Can be used from any thread:
+
+			with index.searching() as searcher :
+				hits = searcher.search(query, 10)
+		'''
+		attach_thread()
+		pool = self.get_pool()
+		managed = pool.acquire()
+		try :
+			if (self.similarity == "bm25") :
+				# Cheap wrapper sharing the same (pooled) reader
+				searcher = IndexSearcher(managed.getIndexReader())
+				searcher.setSimilarity(BM25Similarity())
+				yield searcher
+			else :
+				yield managed
+		finally :
+			pool.release(managed)
 
 
 	def preprocess_query(self, query, fields, mode="ANY"):
@@ -108,6 +545,8 @@ class Index :
 		Fix query according to provided mode. If the value is not supported, 
 		the query remains unchanged
 		'''
+		attach_thread()
+
 
 		terms = query.lower().strip().split()
 		if mode=="ANY" :
@@ -130,17 +569,15 @@ class Index :
 						 ignore=set(),
 						 mode="ANY",
 						 return_scores=False,
-						 limit=1000000):
+						 limit=None):
 		'''
 		Search documents in the index using a standard analyzer (tokenizes and 
 		removes top words). Supports two search modes: ANY and ALL
 		  ANY: include documents that contain at least one term of the query.
 		  ALL: include only documents that contain all terms of the query. 
+		If no limit is given all matched documents are returned.
 		'''
 
-		if not self.searcher :
-			self.open_searcher()
-
 		# Return empty results if query is empty (Lucene can't handle it nicely)
 		if query.strip()=='':
 			if return_scores :
@@ -151,24 +588,24 @@ class Index :
 		
 		query = self.preprocess_query(query, search_fields, mode)
 
-		# If limit is not provided, return all matched documents. A little hack is required
-		# to do that. We query for one document and get the count total matched documents. 
-#		if not limit :
-#			hits = self.searcher.search(query, 1)
-#			limit = hits.totalHits
+		docs = []
+		with self.searching() as searcher :
 
-		# Fetch more than asked in case we have to remove entries from the ignore set
-		if limit!=None:
-			limit += len(ignore)
+			# If limit is not provided, return all matched documents. Lucene allocates
+			# room for as many hits as asked, so we first count the matched documents.
+			if limit is None :
+				nhits = max(searcher.search(query, filter, 1).totalHits, 1)
 
-		hits = self.searcher.search(query, filter, limit)
-		hits = hits.scoreDocs
+			# Fetch more than asked in case we have to remove entries from the ignore set
+			else :
+				nhits = limit + len(ignore)
 
-		docs = []
-		for hit in hits :
-			doc = self.searcher.doc(hit.doc)
-			if doc['id'] not in ignore:
-				docs.append([doc[f] for f in return_fields])
+			hits = searcher.search(query, filter, nhits)
+			hits = hits.scoreDocs
+
+			for hit, row in zip(hits, self.hits_fields(searcher, hits, ["id"] + list(return_fields))) :
+				if row[0] not in ignore:
+					docs.append(row[1:])
 
 		if return_scores :
 			scores = [hit.score for hit in hits]
@@ -177,42 +614,99 @@ class Index :
 		return docs[:limit]
 
 
-	def explain(self, query, fields, doc):
+	def hits_fields(self, searcher, hits, fields) :
+		'''
+		Yields the values of the given fields for each hit. Fields are read from
+		their doc values when available, avoiding loading the stored documents.
+		'''
+		columns = self.get_pool().columns.get(searcher.getIndexReader(), fields)
+		if columns :
+			for hit in hits :
+				yield columns.row(hit.doc)
+		else :
+			for hit in hits :
+				doc = searcher.doc(hit.doc)
+				yield [doc[f] for f in fields]
 
-		if not self.searcher :
-			self.open_searcher()
+
+	def iter_search(self, query, search_fields, return_fields, filter=None, mode="ANY", batch_size=1000) :
+		'''
+		Streaming version of search(): yields (fields, score) for every matched
+		document, fetching them 'batch_size' at a time, so large result sets are
+		never materialized at once.
+		'''
+		if query.strip()=='':
+			return
+
+		query = self.preprocess_query(query, search_fields, mode)
+		with self.searching() as searcher :
+			after = None
+			while True :
+				if after is None :
+					hits = searcher.search(query, filter, batch_size).scoreDocs
+				else :
+					hits = searcher.searchAfter(after, query, filter, batch_size).scoreDocs
+
+				if len(hits) == 0 :
+					break
+
+				for hit, row in zip(hits, self.hits_fields(searcher, hits, return_fields)) :
+					yield row, hit.score
+
+				after = hits[-1]
+
+
+	def explain(self, query, fields, doc):
 
 		query = QueryParser.escape(query)
 
 		parser = MultiFieldQueryParser(Version.LUCENE_CURRENT, fields, self.analyzer)
 		query = MultiFieldQueryParser.parse(parser, query)
 		
-		return self.searcher.explain(query, doc)
+		with self.searching() as searcher :
+			return searcher.explain(query, doc)
 
 
 	def get_documents(self, doc_ids, fields) :
 		
 		docs = []
-		for doc_id in doc_ids:
-			doc = self.reader.document(doc_id)
-			if isinstance(fields, basestring) :
-				docs.append(doc.get(fields))
-			else :
-				docs.append( {f:doc.get(f) for f in fields} )
+		with self.searching() as searcher :
+			reader = searcher.getIndexReader()
+			for doc_id in doc_ids:
+				doc = reader.document(doc_id)
+				if isinstance(fields, basestring) :
+					docs.append(doc.get(fields))
+				else :
+					docs.append( {f:doc.get(f) for f in fields} )
 
 		return docs
 
+
+	def search_many(self, queries, search_fields, return_fields, nthreads=4, **params) :
+		'''
+		Runs several queries concurrently on the shared searchers. Returns a list
+		with the results of each query, as returned by search().
+		'''
+		pool = ThreadPool(nthreads)
+		try :
+			return pool.map(lambda query: self.search(query, search_fields, return_fields, **params), queries)
+		finally :
+			pool.close()
+			pool.join()
+
 	
 	def get_query_scores(self, query, fields, doc_ids, mode="ANY") :
 
-		# Creates pre-filter to ignore all other documents
-		filter = TermsFilter([Term("id", id) for id in doc_ids])
-
 		query = self.preprocess_query(query, fields, mode)
-		hits = self.searcher.search(query, filter, len(doc_ids)).scoreDocs
+		with self.searching() as searcher :
+
+			# Pre-filter to ignore all other documents (cached by candidate set)
+			filter = self.get_pool().filters.get(searcher.getIndexReader(), doc_ids)
+			hits = searcher.search(query, filter, len(doc_ids)).scoreDocs
 
-		# Creates scores' mapping using entity id instead of internal index id
-		scores = {str(self.reader.document(hit.doc).get("id")): hit.score for hit in hits}
+			# Creates scores' mapping using entity id instead of internal index id
+			ids = self.hits_fields(searcher, hits, ["id"])
+			scores = {str(id): hit.score for hit, (id,) in zip(hits, ids)}
 
 		# Normalize to 0..1 interval
 #		n = 1.0/sum(scores.values())
@@ -260,9 +754,10 @@ if __name__ == "__main__" :
 	ids, scores = index.search("dude+ever", ["text"], filter, limit=10)
 	print index.get_documents(ids, "id")
 
-	fields = MultiFields.getMergedFieldInfos(index.reader).iterator()
-	for f in fields:
-		print f.attributes()
+	with index.searching() as searcher :
+		fields = MultiFields.getMergedFieldInfos(searcher.getIndexReader()).iterator()
+		for f in fields:
+			print f.attributes()
 #	print filter.getDocIdSet(index.reader)
 	
 	
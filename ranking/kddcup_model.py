@@ -21,6 +21,7 @@ import logging as log
 import words
 import config
 import utils
+from utils import get_rules_by_lift
 from datasets.mag import get_selected_docs, get_selected_expand_pubs, get_conf_docs, retrieve_affils_by_authors
 from ranking.kddcup_ranker import rank_single_layer_nodes
 import json
@@ -34,7 +35,6 @@ db = MyMySQL(db=config.DB_NAME,
              user=config.DB_USER,
              passwd=config.DB_PASSWD)
 
-
 def get_all_edges(papers):
   """
   Retrieve all edges related to given papers from the database.
@@ -53,6 +53,87 @@ def get_all_edges(papers):
   return rows
 
 
+def get_expanded_conf_pubs(conf_name, year):
+  """
+  (paper_id, year) of the papers expanding a conference in the given years,
+  as used by the 'conf' expansion of the pubs layer.
+  """
+  if not year:
+    return []
+
+  conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
+
+  year_str = ",".join(["'%s'" % y for y in year])
+  year_cond =  " AND year IN (%s)"%year_str if year_str else ''
+  return db.select(["paper_id", "year"], "expanded_conf_papers2", where="conf_id='%s'%s"%(conf_id, year_cond))
+
+
+def get_pubs(conf, year, _type="selected", online_search=True, snapshot=None):
+  """
+  Same as get_selected_expand_pubs, but served from the conference snapshot
+  (see kddcup_snapshot.ConferenceSnapshot) when it holds these records. The
+  records may be shared, so callers must copy them before making changes.
+  """
+  if snapshot and snapshot.has(conf, year, _type, online_search):
+    return snapshot.pubs(conf, year, _type, online_search)
+
+  return get_selected_expand_pubs(conf, year, _type=_type, online_search=online_search)
+
+
+def get_edges(papers, snapshot=None):
+  """
+  Same as get_all_edges, but the edges of papers held by the snapshot are
+  served from memory. Only the remaining papers, if any, are queried.
+  """
+  if not snapshot:
+    return get_all_edges(papers)
+
+  covered, missing = snapshot.citations.split(papers)
+
+  rows = set(snapshot.citations.edges(covered))
+  if missing:
+    rows.update([tuple(row) for row in get_all_edges(missing)])
+
+  return list(rows)
+
+
+class CitationIndex:
+  """
+  In-memory citation edges of a set of papers, looked up by paper.
+  """
+
+  def __init__(self, papers, edges):
+    self.papers = set(papers)
+    self.paper_edges = defaultdict(list)
+
+    for citing, cited in edges:
+      self.paper_edges[citing].append((citing, cited))
+      if cited != citing:
+        self.paper_edges[cited].append((citing, cited))
+
+
+  def split(self, papers):
+    """
+    Splits the given papers into the ones held by the index and the others.
+    """
+    covered, missing = [], []
+    for paper in papers:
+      (covered if paper in self.papers else missing).append(paper)
+
+    return covered, missing
+
+
+  def edges(self, papers):
+    """
+    Same rows get_all_edges would fetch: all edges citing or cited by the papers.
+    """
+    rows = set()
+    for paper in papers:
+      rows.update(self.paper_edges.get(paper, ()))
+
+    return list(rows)
+
+
 def show_stats(graph):
   print "%d nodes and %d edges." % (graph.number_of_nodes(), graph.number_of_edges())
 
@@ -117,39 +198,6 @@ def sorted_tuple(a, b):
   return (a, b) if a < b else (b, a)
 
 
-def get_rules_by_lift(transactions, min_lift=1.0):
-  """
-  Get strong rules from transactions and minimum lift provided.
-  """
-  freqs1 = defaultdict(int)  # Frequencies of 1-itemsets
-  freqs2 = defaultdict(int)  # Frequencies of 2-itemsets
-  for trans in transactions:
-    for i in trans:
-      freqs1[i] += 1
-
-    # If there are at least 2 items, let's compute pairs support
-    if len(trans) >= 2:
-      for i1, i2 in itertools.combinations(trans, 2):
-        freqs2[sorted_tuple(i1, i2)] += 1
-
-  n = float(len(transactions))
-
-  # Check every co-occurring ngram
-  rules = []
-  for (i1, i2), f in freqs2.items():
-
-    # Consider only the ones that appear more than once together,
-    # otherwise lift values can be huge and not really significant
-    if f >= 1:
-      lift = f * n / (freqs1[i1] * freqs1[i2])
-
-      # Include only values higher than min_lift
-      if lift >= min_lift:
-        rules.append((i1, i2, lift))
-
-  return rules
-
-
 ########################################
 ## Class definitions
 ########################################
@@ -212,10 +260,11 @@ class ModelBuilder:
   corresponding methods. Every layer is cached in a folder defined by the main parameters.
   """
 
-  def __init__(self, include_attributes=False):
+  def __init__(self, include_attributes=False, snapshot=None):
     """
     Initializes structures and load data into memory, such as the text index and
-    the citation graph.
+    the citation graph. If a conference snapshot is given, pub records and citation
+    edges are read from it whenever it holds them.
     """
     # # Build text index if non-existing
     # if not os.path.exists(config.INDEX_PATH):
@@ -233,6 +282,8 @@ class ModelBuilder:
     self.include_attributes = include_attributes
     self.pub_years = defaultdict()
 
+    self.snapshot = snapshot
+
     # Create a helper boolean to check if citation contexts are
     # going to be used (some datasets don't have it available)
     # self.use_contexts = (config.DATASET == 'csx')
@@ -244,6 +295,14 @@ class ModelBuilder:
     log.debug("ModelBuilder constructed.")
 
 
+  def get_pubs(self, conf, year, _type="selected", online_search=True):
+    return get_pubs(conf, year, _type, online_search, self.snapshot)
+
+
+  def get_edges(self, papers):
+    return get_edges(papers, self.snapshot)
+
+
   def get_weights_file(self, edges):
     return [(u, v, 1.0) for (u, v) in edges]
 
@@ -264,7 +323,7 @@ class ModelBuilder:
     if expand_method == 'n_hops':
 
       # Get doc ids as uni-dimensional list
-      self.edges_lookup = GraphBuilder(get_all_edges(docs))
+      self.edges_lookup = GraphBuilder(self.get_edges(docs))
       nodes = set(docs)
 
       # Expand the docs set by reference
@@ -305,7 +364,7 @@ class ModelBuilder:
           nodes.update(expanded_docs)
 
 
-      self.edges_lookup = GraphBuilder(get_all_edges(nodes))
+      self.edges_lookup = GraphBuilder(self.get_edges(nodes))
 
     else:
       raise ValueError("parameter expand_method should either be n_hops or conf.")
@@ -336,17 +395,8 @@ class ModelBuilder:
 
 
   def get_expanded_pubs_by_conf2(self, conf_name, year):
-    if not year:
-      return []
-
     # Expand the docs by getting more papers from the targeted conference
-    conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-
-    year_str = ",".join(["'%s'" % y for y in year])
-    year_cond =  " AND year IN (%s)"%year_str if year_str else ''
-    expanded_pubs = db.select(["paper_id", "year"], "expanded_conf_papers2", where="conf_id='%s'%s"%(conf_id, year_cond))
-
-    return expanded_pubs
+    return get_expanded_conf_pubs(conf_name, year)
 
 
   def get_expanded_pubs_by_nhops(self, nodes, edges_lookup, exclude_list, n_hops):
@@ -1258,18 +1308,19 @@ class ModelBuilder:
     current_year = config.PARAMS['current_year']
     old_year = config.PARAMS['old_year']
 
-    pubs, _, affils = get_selected_expand_pubs(conf_name, year)
+    pubs, _, affils = self.get_pubs(conf_name, year)
+    pubs, affils = dict(pubs), set(affils)  # Shared records (see get_pubs), extended below
     docs = set(pubs.keys()) - set(exclude)
 
     if expanded_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      pubs2, _, affils2 = get_selected_expand_pubs(conf_id, expanded_year, _type="expanded")
+      pubs2, _, affils2 = self.get_pubs(conf_id, expanded_year, _type="expanded")
       docs2 = set(pubs2.keys()) - set(exclude)
       docs.update(docs2)
       pubs.update(pubs2)
       affils.update(affils2)
 
-    self.edges_lookup = GraphBuilder(get_all_edges(docs))
+    self.edges_lookup = GraphBuilder(self.get_edges(docs))
     edges = self.edges_lookup.subgraph(docs)
     weighted_edges = self.get_weights_file(edges)
 
@@ -1292,19 +1343,20 @@ class ModelBuilder:
     current_year = config.PARAMS['current_year']
     old_year = config.PARAMS['old_year']
 
-    pubs, _, affils = get_selected_expand_pubs(conf_name, year)
+    pubs, _, affils = self.get_pubs(conf_name, year)
+    pubs, affils = dict(pubs), set(affils)  # Shared records (see get_pubs), extended below
     docs = set(pubs.keys()) - set(exclude)
 
     if expanded_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      pubs2, _, affils2 = get_selected_expand_pubs(conf_id, expanded_year, _type="expanded")
+      pubs2, _, affils2 = self.get_pubs(conf_id, expanded_year, _type="expanded")
       docs2 = set(pubs2.keys()) - set(exclude)
       docs.update(docs2)
       pubs.update(pubs2)
       affils.update(affils2)
 
 
-    self.edges_lookup = GraphBuilder(get_all_edges(docs))
+    self.edges_lookup = GraphBuilder(self.get_edges(docs))
     edges = self.edges_lookup.subgraph(docs)
 
     affil_affils = defaultdict()
@@ -1383,12 +1435,13 @@ class ModelBuilder:
     current_year = config.PARAMS['current_year']
     old_year = config.PARAMS['old_year']
 
-    pubs, authors, _ = get_selected_expand_pubs(conf_name, year)
+    pubs, authors, _ = self.get_pubs(conf_name, year)
+    pubs, authors = dict(pubs), set(authors)  # Shared records (see get_pubs), extended below
     docs = set(pubs.keys()) - set(exclude)
 
     if expanded_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      pubs2, authors2, _ = get_selected_expand_pubs(conf_id, expanded_year, _type="expanded")
+      pubs2, authors2, _ = self.get_pubs(conf_id, expanded_year, _type="expanded")
       docs2 = set(pubs2.keys()) - set(exclude)
       docs.update(docs2)
       pubs.update(pubs2)
@@ -1398,14 +1451,14 @@ class ModelBuilder:
     # expand docs set by getting more papers accepted by related conferences
     for conf, years in expand_conf_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf, limit=1)[0]
-      pubs2, authors2, _ = get_selected_expand_pubs(conf_id, years, _type='expanded')
+      pubs2, authors2, _ = self.get_pubs(conf_id, years, _type='expanded')
       docs2 = set(pubs2.keys()) - set(exclude)
       docs.update(docs2)
       pubs.update(pubs2)
       authors.update(authors2)
 
 
-    self.edges_lookup = GraphBuilder(get_all_edges(docs))
+    self.edges_lookup = GraphBuilder(self.get_edges(docs))
     edges = self.edges_lookup.subgraph(docs)
 
     # import pdb;pdb.set_trace()
@@ -1483,12 +1536,13 @@ class ModelBuilder:
     current_year = config.PARAMS['current_year']
     old_year = config.PARAMS['old_year']
 
-    pubs, authors, _ = get_selected_expand_pubs(conf_name, year)
+    pubs, authors, _ = self.get_pubs(conf_name, year)
+    pubs, authors = dict(pubs), set(authors)  # Shared records (see get_pubs), extended below
     docs = set(pubs.keys()) - set(exclude)
 
     if expanded_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      pubs2, authors2, _ = get_selected_expand_pubs(conf_id, expanded_year, _type="expanded")
+      pubs2, authors2, _ = self.get_pubs(conf_id, expanded_year, _type="expanded")
       docs2 = set(pubs2.keys()) - set(exclude)
       docs.update(docs2)
       pubs.update(pubs2)
@@ -1496,7 +1550,7 @@ class ModelBuilder:
 
 
 
-    self.edges_lookup = GraphBuilder(get_all_edges(docs))
+    self.edges_lookup = GraphBuilder(self.get_edges(docs))
     edges = self.edges_lookup.subgraph(docs)
 
     # import pdb;pdb.set_trace()
@@ -1958,12 +2012,13 @@ class ModelBuilder:
     """
     author_scores = defaultdict(float)
     author_affils = defaultdict(set)
-    pub_records, _, __ = get_selected_expand_pubs(conf_name, year, _type='selected')
+    pub_records, _, __ = self.get_pubs(conf_name, year, _type='selected')
+    pub_records = dict(pub_records)  # Shared records (see get_pubs), extended below
 
     # expand docs set by getting more papers accepted by the targeted conference
     if expand_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      expand_records, _, __ = get_selected_expand_pubs(conf_id, expand_year, _type='expanded')
+      expand_records, _, __ = self.get_pubs(conf_id, expand_year, _type='expanded')
       pub_records.update(expand_records)
       print 'expanded %s papers.'%len(expand_records)
 
@@ -1985,12 +2040,13 @@ class ModelBuilder:
     """
 
     affil_scores = defaultdict(float)
-    pub_records, _, __ = get_selected_expand_pubs(conf_name, year, _type='selected')
+    pub_records, _, __ = self.get_pubs(conf_name, year, _type='selected')
+    pub_records = dict(pub_records)  # Shared records (see get_pubs), extended below
 
     # expand docs set by getting more papers accepted by the targeted conference
     if expand_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      expand_records, _, __ = get_selected_expand_pubs(conf_id, expand_year, _type='expanded')
+      expand_records, _, __ = self.get_pubs(conf_id, expand_year, _type='expanded')
       pub_records.update(expand_records)
       print 'expanded %s papers.'%len(expand_records)
 
@@ -2303,7 +2359,7 @@ class ModelBuilder:
     pub_records = defaultdict()
 
     if year:
-      records, _, __ = get_selected_expand_pubs(conf_name, year, _type='selected', online_search=online_search)
+      records, _, __ = self.get_pubs(conf_name, year, _type='selected', online_search=online_search)
       pub_records.update(records)
 
 
@@ -2311,7 +2367,7 @@ class ModelBuilder:
     # expand docs set by getting more papers accepted by the targeted or related conference
     if expand_year:
       conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-      expand_records, _, __ = get_selected_expand_pubs(conf_id, expand_year, _type='expanded', online_search=online_search)
+      expand_records, _, __ = self.get_pubs(conf_id, expand_year, _type='expanded', online_search=online_search)
       pub_records.update(expand_records)
       print 'expanded %s papers from %s.' % (len(expand_records), conf_name)
 
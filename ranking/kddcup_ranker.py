@@ -529,88 +529,177 @@ def rank_nodes_mle(authors, author_authors, affils, author_affils, beta=.1):
 
 
 
-def rank_nodes_stat(author_graph, author_affils, author_per_paper_dist, author_scores):
-    n_paper = 200.0
-    new_author_per_paper_dist = {k:int(round(v*n_paper)) for k, v in author_per_paper_dist.iteritems()}
-    pred_authorships = []
-    author_idx = match_authorid_idx(author_graph)
+class CoauthorSampler:
+    """
+    Samples the authors of simulated papers, nauthor distinct ones per paper, with
+    the probabilities of author_scores, like np.random.choice(..., replace=False),
+    and counts the occurrences of the affiliations of the chosen authors.
+
+    The authors are indexed once, with an alias table to draw from p in constant
+    time. Each author of a paper is drawn from p, and drawn again while it repeats
+    one already in the paper, which is the same as drawing from the authors left.
+    All the papers with the same number of authors are drawn at once. Affiliation
+    occurrences are summed with np.bincount over an author -> affils CSR.
+    """
 
-    W = nx.stochastic_graph(author_graph, weight='weight')
+    # Redraws before the papers still repeating an author are completed by the
+    # Gumbel-top-k keys of the authors left, for weights concentrated on a few
+    MAX_REDRAWS = 20
 
-    # shifted distribution
-    # epsilon = 1e-6
-    # dist = np.array(author_scores.values())
-    # new_dist = (dist + epsilon)/sum(dist + epsilon)
-    # author_scores = dict(zip(author_scores.keys(), new_dist.tolist()))
+    def __init__(self, author_scores, author_affils):
+        self.authors = list(author_scores.keys())
+        p = np.array([author_scores[a] for a in self.authors], dtype=np.float64)
+        p /= p.sum()
+
+        # Zero probability authors are never chosen
+        with np.errstate(divide='ignore'):
+            self.log_p = np.log(p)
+        self.npositive = np.count_nonzero(p)
+
+        self.prob, self.alias = alias_table(p)
+
+        # CSR of the affiliations of each author
+        self.affils = sorted(set([affil for a in self.authors for affil in author_affils.get(a, [])]))
+        affil_idx = {affil: i for i, affil in enumerate(self.affils)}
+
+        degrees = [len(author_affils.get(a, [])) for a in self.authors]
+        self.indptr = np.concatenate(([0], np.cumsum(degrees))).astype(np.int64)
+        self.indices = np.array([affil_idx[affil] for a in self.authors for affil in author_affils.get(a, [])], dtype=np.int64)
+        self.owners = np.repeat(np.arange(len(self.authors)), degrees)
 
-    # import pdb;pdb.set_trace()
-    for nauthor, npaper in new_author_per_paper_dist.iteritems():
-        # 3)
-        # import pdb;pdb.set_trace()
-        # dependency_coauth_struct = find_dependency_coauth_struct(nauthor, author_scores, W, author_idx)
 
-        for i in xrange(npaper):
-            # 1) randomly choose authors
-            coauthors = ezpred_coauthors(nauthor, author_scores)
+    def draw(self, size, rng=np.random):
+        """ Authors drawn from p, with replacement. """
+        idx = rng.randint(0, len(self.authors), size=size)
+        return np.where(rng.random_sample(size) < self.prob[idx], idx, self.alias[idx])
 
-            # 2) randomly choose root author, then search coauthors
-            # coauthors = []
-            # while not coauthors:
-            #     coauthors = pred_coauthors(nauthor, author_scores, W, author_idx)
 
+    def sample(self, nauthor, npaper, rng=np.random):
+        """
+        Authors (indexes) of npaper papers with nauthor authors each, one paper per row.
+        """
+        if nauthor > self.npositive:
+            raise ValueError("Fewer non-zero entries in p than size")
 
-            # 3) randomly choose dependency coauthor structures
-            # dependency_coauth_struct = find_dependency_coauth_struct(nauthor, author_scores, W, author_idx)
+        papers = self.draw((npaper, nauthor), rng)
+        for j in xrange(1, nauthor):
+            rows = np.arange(npaper)
+            for _ in xrange(self.MAX_REDRAWS):
+                rows = rows[(papers[rows, j][:, np.newaxis] == papers[rows, :j]).any(axis=1)]
+                if not len(rows):
+                    break
+                papers[rows, j] = self.draw(len(rows), rng)
+
+            else:
+                rows = rows[(papers[rows, j][:, np.newaxis] == papers[rows, :j]).any(axis=1)]
+                if len(rows):
+                    keys = self.log_p + rng.gumbel(size=(len(rows), len(self.authors)))
+                    keys[np.arange(len(rows))[:, np.newaxis], papers[rows, :j]] = -np.inf
+                    papers[rows, j] = keys.argmax(axis=1)
+
+        return papers
+
+
+    def affil_occurrences(self, author_per_paper_dist, itr=1, n_paper=200.0, rng=np.random):
+        """
+        Occurrences of each affiliation (as in self.affils) among the authors of the
+        papers of itr simulations, one simulation per row. Each one has n_paper papers
+        distributed on the number of authors by author_per_paper_dist.
+        """
+        nauthors = len(self.authors)
+        author_counts = np.zeros(itr * nauthors)
+
+        for nauthor, v in author_per_paper_dist.iteritems():
+            npaper = int(round(v * n_paper))
+            if nauthor <= 0 or npaper == 0:
+                continue
 
-            # coauthors = pred_coauth_struct(dependency_coauth_struct)
+            # All papers of all simulations at once, offset by simulation
+            papers = self.sample(nauthor, itr * npaper, rng)
+            papers += nauthors * np.repeat(np.arange(itr), npaper)[:, np.newaxis]
+            author_counts += np.bincount(papers.ravel(), minlength=itr * nauthors)
 
+        author_counts = author_counts.reshape(itr, nauthors)
 
+        # Every author adds its count to each of its affiliations
+        naffils = len(self.affils)
+        ids = (self.indices + naffils * np.arange(itr)[:, np.newaxis]).ravel()
+        occurrences = np.bincount(ids, weights=author_counts[:, self.owners].ravel(), minlength=itr * naffils)
 
+        return occurrences.reshape(itr, naffils)
 
-            pred_authorships.append(coauthors)
 
-    # print 'diff: %s' % len(pred_authorships) - n_paper
-    # print len(pred_authorships)
+def alias_table(p):
+    """
+    Walker's alias table of the distribution p (Vose's method): i is drawn with
+    probability p by picking a column k uniformly and keeping it with probability
+    prob[k], or taking alias[k] otherwise.
+    """
+    n = len(p)
+    prob = np.ones(n)
+    alias = np.arange(n)
+
+    scaled = p * n
+    small = [i for i in xrange(n) if scaled[i] < 1.0]
+    large = [i for i in xrange(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    # What's left is 1 up to rounding errors
+    return prob, alias
+
+
+def get_random_state(seed=None):
+    """ Generator for the given seed, or numpy's global one if None. """
+    return np.random if seed is None else np.random.RandomState(seed)
+
+
+def rank_nodes_stat(author_graph, author_affils, author_per_paper_dist, author_scores, seed=None):
+    """
+    Simulates 200 papers, choosing their authors at random by author_scores (see
+    ezpred_coauthors), and counts the occurrences of each affiliation. Other ways of
+    choosing the coauthors are in pred_coauthors and pred_coauth_struct.
+    """
+    sampler = CoauthorSampler(author_scores, author_affils)
+    occurrences = sampler.affil_occurrences(author_per_paper_dist, 1, rng=get_random_state(seed))[0]
+
+    affil_scores = defaultdict(float)
+    for i in np.flatnonzero(occurrences):
+        affil_scores[sampler.affils[i]] = occurrences[i]
 
-    # affil_scores = calc_affil_scores(pred_authorships, author_affils)
-    affil_scores = calc_affil_occurrences(pred_authorships, author_affils)
     return affil_scores
 
 
-def avg_scores(author_graph, author_affils, author_per_paper_dist, author_scores, itr=20):
-    affil_scores_list = []
-    for i in xrange(itr):
-        affil_scores = rank_nodes_stat(author_graph, author_affils, author_per_paper_dist, author_scores)
-        affil_scores_list.append(affil_scores)
+def avg_scores(author_graph, author_affils, author_per_paper_dist, author_scores, itr=20, seed=None):
+    """
+    Trimmed average of the scores of rank_nodes_stat over itr simulations, all drawn
+    at once. Each affiliation averages the top half of the simulations it occurs in.
+    """
+    sampler = CoauthorSampler(author_scores, author_affils)
+    occurrences = sampler.affil_occurrences(author_per_paper_dist, itr, rng=get_random_state(seed))
 
     # # 1) total score
-    # avg_affil_scores = defaultdict(float)
-    # for each_scores in affil_scores_list:
-    #     for affil, score in each_scores.iteritems():
-    #         avg_affil_scores[affil] += score
+    # avg_affil_scores = occurrences.sum(axis=0)
 
     # # 2) avg score
-    # avg_affil_scores = defaultdict(float)
-    # affil_count = defaultdict(float)
-    # for each_scores in affil_scores_list:
-    #     for affil, score in each_scores.iteritems():
-    #         avg_affil_scores[affil] += score
-    #         affil_count[affil] += 1
-
-    # for k, v in affil_count.iteritems():
-    #     avg_affil_scores[k] /= v
+    # avg_affil_scores = occurrences.sum(axis=0) / (occurrences > 0).sum(axis=0)
 
     # 3) trimmed avg score
+    top = -np.sort(-occurrences, axis=0)
+    ntop = (occurrences > 0).sum(axis=0) // 2
+    totals = np.vstack((np.zeros(len(sampler.affils)), np.cumsum(top, axis=0)))[ntop, np.arange(len(sampler.affils))]
+
     avg_affil_scores = defaultdict(float)
-    tmp_avg_affil_scores = defaultdict(list)
-    for each_scores in affil_scores_list:
-        for affil, score in each_scores.iteritems():
-            tmp_avg_affil_scores[affil].append(score)
-
-    for k, v in tmp_avg_affil_scores.iteritems():
-        tmp = sorted(v, reverse=True)
-        tmp = tmp[:int(.5*len(tmp))]
-        avg_affil_scores[k] = np.mean(tmp)
+    for i in np.flatnonzero(occurrences.any(axis=0)):
+        # As np.mean of no values, if it occurs in a single simulation
+        avg_affil_scores[sampler.affils[i]] = totals[i] / ntop[i] if ntop[i] else np.nan
 
     return avg_affil_scores
 
@@ -15,6 +15,7 @@ from mymysql.mymysql import MyMySQL
 from ranking.kddcup_searchers import simple_search, SimpleSearcher, RegressionSearcher, \
                     Searcher, ProjectedSearcher, IterProjectedSearcher, StatSearcher, \
                     TemporalSearcher, Bagging
+from ranking.kddcup_snapshot import ConferenceSnapshot
 from evaluation.kddcup_expt import get_results_file, save_results
 
 db = MyMySQL(db=config.DB_NAME, user=config.DB_USER, passwd=config.DB_PASSWD)
@@ -184,8 +185,12 @@ def main():
     for c in confs:
         print "Running on '%s' conf." % c
 
+        # Loaded once and shared by all searchers
+        snapshot = ConferenceSnapshot(c, year)
+
         for s in searchers:
             print "Running %s." % s.name()
+            s.set_snapshot(snapshot)
 
             if s.name() == "SimpleSearcher":
                 s.set_params(**{
@@ -4,7 +4,6 @@ Created on Mar 14, 2016
 @author: hugo
 '''
 
-from datasets.mag import get_selected_expand_pubs
 from ranking.kddcup_ranker import rank_nodes, rank_single_layer_nodes, rank_author_affil_nodes, \
             rank_projected_nodes, rank_paper_author_affil_nodes, rank_nodes_mle, rank_nodes_stat, avg_scores
 from ranking.kddcup_regression import linear_regression, boosted_trees
@@ -34,11 +33,12 @@ builder = None
 db = MyMySQL(db=config.DB_NAME, user=config.DB_USER, passwd=config.DB_PASSWD)
 
 
-def build_graph(conf_name, year, age_relev, H, alpha, min_topic_lift, min_ngram_lift, alg, exclude=[], expanded_year=[], expand_conf_year=[], force=False, save=True, load=False):
+def build_graph(conf_name, year, age_relev, H, alpha, min_topic_lift, min_ngram_lift, alg, exclude=[], expanded_year=[], expand_conf_year=[], force=False, save=True, load=False, snapshot=None):
     """
     Utility method to build and return the graph model. First we check if a graph file
     exists. If not, we check if the builder class is already instantiated. If not, we do
-    it and proceed to build the graph.
+    it and proceed to build the graph. The builder reads from the conference snapshot,
+    if given.
     """
     global builder
     model_folder = config.IN_MODELS_FOLDER % (alg, config.DATASET, H)
@@ -53,6 +53,8 @@ def build_graph(conf_name, year, age_relev, H, alpha, min_topic_lift, min_ngram_
         if not builder:
             builder = kddcup_model.ModelBuilder()
 
+        builder.snapshot = snapshot
+
         # Builds the graph file
         if alg == 'ProjectedLayered':
             graph = builder.build_affils(conf_name, year, age_relev, H, exclude)
@@ -89,7 +91,7 @@ def build_graph(conf_name, year, age_relev, H, alpha, min_topic_lift, min_ngram_
     return graph
 
 
-def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=False, age_relev=0.0, expand_conf_year=[], online_search=True):
+def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=False, age_relev=0.0, expand_conf_year=[], online_search=True, snapshot=None):
     """
     Parameters
     -----------
@@ -98,14 +100,23 @@ def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=Fa
 
     year : A string or list (tuple) of strings
             Specifies targeted years
+
+    snapshot : kddcup_snapshot.ConferenceSnapshot (optional)
+            Loaded data of the conference. If it matches the selection and
+            expansions, scores are summed over its incidence arrays instead.
     """
+    if snapshot and snapshot.matches(conf_name, year, expand_year, expand_conf_year, online_search):
+        affil_scores = snapshot.affil_scores(age_relev, age_decay)
+        return get_ranked_affils(affil_scores, selected_affils)
+
     affil_scores = defaultdict()
-    pub_records, _, __ = get_selected_expand_pubs(conf_name, year, _type='selected', online_search=online_search)
+    pub_records, _, __ = kddcup_model.get_pubs(conf_name, year, 'selected', online_search, snapshot)
+    pub_records = dict(pub_records)  # Shared records (see get_pubs), extended below
 
     # expand docs set by getting more papers accepted by the targeted conference
     if expand_year:
         conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-        expand_records, _, __ = get_selected_expand_pubs(conf_id, expand_year, _type='expanded', online_search=online_search)
+        expand_records, _, __ = kddcup_model.get_pubs(conf_id, expand_year, 'expanded', online_search, snapshot)
         pub_records.update(expand_records)
         print 'expanded %s papers.'%len(expand_records)
 
@@ -113,7 +124,7 @@ def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=Fa
     # expand docs set by getting more papers accepted by related conferences
     for conf, years in expand_conf_year:
         conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf, limit=1)[0]
-        expand_records, _, __ = get_selected_expand_pubs(conf_id, years, _type='expanded', online_search=online_search)
+        expand_records, _, __ = kddcup_model.get_pubs(conf_id, years, 'expanded', online_search, snapshot)
         pub_records.update(expand_records)
         print 'expanded %s papers from %s.' % (len(expand_records), conf)
 
@@ -141,6 +152,11 @@ def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=Fa
                         affil_scores[each] = score2
 
     # import pdb;pdb.set_trace()
+    return get_ranked_affils(affil_scores, selected_affils)
+
+
+
+def get_ranked_affils(affil_scores, selected_affils):
     # we only rank the selected affiliations
     if selected_affils:
         selected_affil_scores = get_selected_nodes(affil_scores, selected_affils)
@@ -152,7 +168,7 @@ def simple_search(selected_affils, conf_name, year, expand_year=[], age_decay=Fa
 
 
 
-def regression_search(selected_affils, conf_name, year, expand_year=[]):
+def regression_search(selected_affils, conf_name, year, expand_year=[], snapshot=None):
     """
     Parameters
     -----------
@@ -163,12 +179,13 @@ def regression_search(selected_affils, conf_name, year, expand_year=[]):
             Specifies targeted years
     """
     affil_scores = defaultdict()
-    pub_records, _, __ = get_selected_expand_pubs(conf_name, year, _type='selected')
+    pub_records, _, __ = kddcup_model.get_pubs(conf_name, year, 'selected', snapshot=snapshot)
+    pub_records = dict(pub_records)  # Shared records (see get_pubs), extended below
 
     # expand docs set by getting more papers accepted by the targeted conference
     if expand_year:
         conf_id = db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
-        expand_recrods, _, __ = get_selected_expand_pubs(conf_id, expand_year, _type='expanded')
+        expand_recrods, _, __ = kddcup_model.get_pubs(conf_id, expand_year, 'expanded', snapshot=snapshot)
         pub_records.update(expand_recrods)
         print 'expanded %s papers.'%len(expand_recrods)
 
@@ -244,7 +261,19 @@ def regression_search(selected_affils, conf_name, year, expand_year=[]):
 
 
 
-class SimpleSearcher():
+class SnapshotReader:
+    """
+    Base of the searchers that can read conference data from a snapshot
+    instead of the DB.
+    """
+    snapshot = None
+
+    def set_snapshot(self, snapshot):
+        """ Conference data (kddcup_snapshot.ConferenceSnapshot) to read from. """
+        self.snapshot = snapshot
+
+
+class SimpleSearcher(SnapshotReader):
     """
     Ranks affliations based on how many of their papers were accepted by
     specific conference in specific period of time.
@@ -264,11 +293,11 @@ class SimpleSearcher():
             self.params[k] = v
 
     def search(self, selected_affils, conf_name, year, expand_year=[], expand_conf_year=[], online_search=True, age_decay=False, rtype="affil"):
-        rst = simple_search(selected_affils, conf_name, year, expand_year=expand_year, age_decay=age_decay, age_relev=self.params['age_relev'], expand_conf_year=expand_conf_year, online_search=online_search)
+        rst = simple_search(selected_affils, conf_name, year, expand_year=expand_year, age_decay=age_decay, age_relev=self.params['age_relev'], expand_conf_year=expand_conf_year, online_search=online_search, snapshot=self.snapshot)
         return rst
 
 
-class RegressionSearcher():
+class RegressionSearcher(SnapshotReader):
     """
     Ranks affliations based on how many of their papers were accepted by
     specific conference in specific period of time.
@@ -288,11 +317,11 @@ class RegressionSearcher():
             self.params[k] = v
 
     def search(self, selected_affils, conf_name, year, expand_year=[], age_decay=False, rtype="affil"):
-        rst = regression_search(selected_affils, conf_name, year, expand_year=expand_year)
+        rst = regression_search(selected_affils, conf_name, year, expand_year=expand_year, snapshot=self.snapshot)
         return rst
 
 
-class Searcher:
+class Searcher(SnapshotReader):
     """
     Basic searcher class for the Multi-Layered method.
     """
@@ -335,7 +364,7 @@ class Searcher:
                             None,
                             self.params['min_topic_lift'],
                             self.params['min_ngram_lift'],
-                            self.name(), exclude_papers, expand_year, expand_conf_year, force, load=True, save=self.save)
+                            self.name(), exclude_papers, expand_year, expand_conf_year, force, load=True, save=self.save, snapshot=self.snapshot)
 
         # Store number of nodes for checking later
         self.nnodes = graph.number_of_nodes()
@@ -359,7 +388,7 @@ class Searcher:
         return results
 
 
-class ProjectedSearcher:
+class ProjectedSearcher(SnapshotReader):
     """
     Basic searcher class for the Projected-Layer method.
     """
@@ -402,7 +431,7 @@ class ProjectedSearcher:
                             self.params['alpha'],
                             self.params['min_topic_lift'],
                             self.params['min_ngram_lift'],
-                            self.name(), exclude_papers, expanded_year, force, load=True, save=self.save)
+                            self.name(), exclude_papers, expanded_year, force, load=True, save=self.save, snapshot=self.snapshot)
 
         # Store number of nodes for checking later
         self.nnodes = graph.number_of_nodes()
@@ -426,7 +455,7 @@ class ProjectedSearcher:
         return results
 
 
-class IterProjectedSearcher:
+class IterProjectedSearcher(SnapshotReader):
     """
     Basic searcher class for the Iterative-Projected-Layer method.
     Two-stage projection: Paper -> Author -> Affil
@@ -463,7 +492,7 @@ class IterProjectedSearcher:
         """
 
         """
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
 
         # scores = builder.get_ranked_affils_by_papers(conf_name, year, self.params['age_relev'], self.params['H'], self.params['alpha'], exclude=exclude_papers)
         scores = builder.get_ranked_affils_by_authors(conf_name, year, self.params['age_relev'], self.params['H'], self.params['alpha'], exclude=exclude_papers, expanded_year=expanded_year, expand_conf_year=expand_conf_year)
@@ -485,7 +514,7 @@ class IterProjectedSearcher:
                             self.params['alpha'],
                             self.params['min_topic_lift'],
                             self.params['min_ngram_lift'],
-                            self.name(), exclude_papers, expanded_year, expand_conf_year, force, load=True, save=self.save)
+                            self.name(), exclude_papers, expanded_year, expand_conf_year, force, load=True, save=self.save, snapshot=self.snapshot)
 
         # Store number of nodes for checking later
         self.nnodes = graph.number_of_nodes()
@@ -529,7 +558,7 @@ class IterProjectedSearcher:
         # # Store number of nodes for checking later
         # self.nnodes = graph.number_of_nodes()
 
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         authors, author_authors, affils, author_affils = builder.build_projected_author_layer(\
                                         conf_name, year, self.params['age_relev'], self.params['H'], \
                                         self.params['alpha'], exclude_papers, expanded_year)
@@ -558,7 +587,7 @@ class IterProjectedSearcher:
 
 
 
-class StatSearcher:
+class StatSearcher(SnapshotReader):
     """
     Basic searcher class for the Statistic method.
     """
@@ -591,10 +620,11 @@ class StatSearcher:
     def search(self, selected_affils, conf_name, year, exclude_papers=[], expanded_year=[], rtype="affil", force=False):
         """
         Checks if the graph model already exists, otherwise creates one and
-        runs the ranking on the nodes.
+        runs the ranking on the nodes. The simulations are reproducible if a
+        'seed' param is set.
         """
 
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         author_graph, author_affils, author_per_paper_dist, author_scores = builder.build_stat_layer(\
                                         conf_name, year, self.params['age_relev'], self.params['H'], \
                                         exclude_papers, expanded_year)
@@ -603,7 +633,7 @@ class StatSearcher:
         # 1)
         # Rank nodes
         # scores = rank_nodes_stat(author_graph, author_affils, author_per_paper_dist, author_scores)
-        scores = avg_scores(author_graph, author_affils, author_per_paper_dist, author_scores)
+        scores = avg_scores(author_graph, author_affils, author_per_paper_dist, author_scores, seed=self.params.get('seed'))
 
         results = get_selected_nodes(scores, selected_affils)
 
@@ -639,7 +669,7 @@ class StatSearcher:
 
 
 
-class TemporalSearcher:
+class TemporalSearcher(SnapshotReader):
     """
     Basic searcher class for the a Temporal method.
     """
@@ -664,7 +694,7 @@ class TemporalSearcher:
 
 
     def author_search(self, selected_affils, conf_name, year, exclude_papers=[], expanded_year=[], rtype="affil", force=False):
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         year_author_rating, watching_list, author_affils = builder.get_year_author_rating(conf_name, force=False)
 
         author_scores, author_affils = builder.rate_projected_authors(conf_name, year, self.params['age_relev'], self.params['H'], self.params['alpha'], exclude=exclude_papers, expanded_year=expanded_year)
@@ -696,7 +726,7 @@ class TemporalSearcher:
 
 
     def affil_search(self, selected_affils, conf_name, year, exclude_papers=[], expanded_year=[], expand_conf_year=[], rtype="affil", force=False):
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         year_affil_rating, watching_list = builder.get_year_affil_rating(conf_name, force=True)
 
 
@@ -745,7 +775,7 @@ class TemporalSearcher:
 
 
 
-class SupervisedSearcher:
+class SupervisedSearcher(SnapshotReader):
     """
     Basic searcher class for the supervised learning model.
     """
@@ -766,7 +796,7 @@ class SupervisedSearcher:
 
 
     def search(self, selected_affils, conf_name, year, exclude_papers=[], expanded_year=[], expand_conf_year=[], rtype="affil", force=False):
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         training_records, testing_records = builder.get_all_metadata(conf_name, year, \
                                 expanded_year, expand_conf_year, force=True)
         # import pdb;pdb.set_trace()
@@ -824,7 +854,7 @@ class SupervisedSearcher:
         7: ListNet
         8: Random Forests
         """
-        builder = kddcup_model.ModelBuilder()
+        builder = kddcup_model.ModelBuilder(snapshot=self.snapshot)
         training_records, testing_records = builder.get_all_metadata(conf_name, year, \
                                 expanded_year, expand_conf_year, force=False)
 
@@ -0,0 +1,168 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import numpy as np
+import config
+import kddcup_model
+from datasets.mag import get_selected_docs, get_selected_expand_pubs
+
+
+def years_key(year):
+    """ Normalizes a year or list of years so equal selections compare equal. """
+    if isinstance(year, basestring) or not hasattr(year, '__iter__'):
+        year = [year]
+
+    return tuple(sorted(set([str(y) for y in year])))
+
+
+class ConferenceSnapshot:
+    """
+    Data of one conference, for some years plus expansions, loaded once and
+    passed to every searcher: the pub records of each selection, the paper x
+    author x affil incidence arrays of all of them and the citation edges
+    of their papers and of the graph nodes built from them. Searchers and model
+    builders fall back to the DB for anything the snapshot doesn't hold.
+    """
+
+    def __init__(self, conf_name, year, expand_year=[], expand_conf_year=[], online_search=True):
+        self.conf_name = conf_name
+        self.year = year
+        self.expand_year = expand_year
+        self.expand_conf_year = expand_conf_year
+        self.online_search = online_search
+
+        # (pub_records, authors, affils) of each selection, in the order loaded
+        self.records = {}
+        self.order = []
+
+        self.load(conf_name, year, 'selected')
+
+        # Expansions are keyed by conference id, like the searchers query them
+        if expand_year:
+            conf_id = kddcup_model.db.select("id", "confs", where="abbr_name='%s'"%conf_name, limit=1)[0]
+            self.load(conf_id, expand_year, 'expanded')
+
+        for conf, years in expand_conf_year:
+            conf_id = kddcup_model.db.select("id", "confs", where="abbr_name='%s'"%conf, limit=1)[0]
+            self.load(conf_id, years, 'expanded')
+
+        # Same merge (later selections override) the searchers do
+        self.pub_records = {}
+        for key in self.order:
+            self.pub_records.update(self.records[key][0])
+
+        self.build_incidence()
+
+        papers = self.graph_papers()
+        self.citations = kddcup_model.CitationIndex(papers, kddcup_model.get_all_edges(papers))
+
+
+    def graph_papers(self):
+        """
+        Papers whose citation edges are kept: those of the pub records plus the
+        nodes the model builder starts from, i.e. the selected docs and their
+        'conf' expansion (see ModelBuilder.get_pubs_layer), which aren't
+        necessarily in the records.
+        """
+        papers = set(self.pub_records)
+
+        selected_docs = get_selected_docs(self.conf_name, self.year)
+        if selected_docs:
+            papers.update(zip(*selected_docs)[0])
+
+        expansions = [(self.conf_name, self.expand_year)] + list(self.expand_conf_year)
+        for conf, years in expansions:
+            expanded_pubs = kddcup_model.get_expanded_conf_pubs(conf, years)
+            if expanded_pubs:
+                papers.update(zip(*expanded_pubs)[0])
+
+        return list(papers)
+
+
+    def key(self, conf, year, _type, online_search):
+        return (_type, conf, years_key(year), online_search)
+
+
+    def load(self, conf, year, _type):
+        key = self.key(conf, year, _type, self.online_search)
+        if key not in self.records:
+            self.records[key] = get_selected_expand_pubs(conf, year, _type=_type, online_search=self.online_search)
+            self.order.append(key)
+
+
+    def has(self, conf, year, _type="selected", online_search=True):
+        return self.key(conf, year, _type, online_search) in self.records
+
+
+    def pubs(self, conf, year, _type="selected", online_search=True):
+        """
+        The (pub_records, authors, affils) get_selected_expand_pubs would return.
+        They're shared by every caller, so they must not be changed (callers
+        extending them work on copies, see kddcup_model.get_pubs).
+        """
+        return self.records[self.key(conf, year, _type, online_search)]
+
+
+    def matches(self, conf_name, year, expand_year=[], expand_conf_year=[], online_search=True):
+        """
+        Whether the snapshot was loaded for exactly this selection and expansions.
+        """
+        return (conf_name == self.conf_name) and \
+               (years_key(year) == years_key(self.year)) and \
+               (years_key(expand_year) == years_key(self.expand_year)) and \
+               ([(c, years_key(y)) for c, y in expand_conf_year] == \
+                [(c, years_key(y)) for c, y in self.expand_conf_year]) and \
+               (online_search == self.online_search)
+
+
+    def build_incidence(self):
+        """
+        One entry per (paper, author, affil) of the merged records, with the
+        share of the paper credited to it: 1/#authors, split evenly among the
+        author's affiliations. Authors without affiliations get no entry.
+        """
+        self.papers = self.pub_records.keys()
+        self.paper_years = np.array([self.pub_records[p]['year'] for p in self.papers], dtype=np.int32)
+
+        author_index, affil_index = {}, {}
+        paper_ids, author_ids, affil_ids, shares = [], [], [], []
+        for i, paper in enumerate(self.papers):
+            authors = self.pub_records[paper]['author']
+            for author, affils in authors.iteritems():
+                for affil in affils:
+                    paper_ids.append(i)
+                    author_ids.append(author_index.setdefault(author, len(author_index)))
+                    affil_ids.append(affil_index.setdefault(affil, len(affil_index)))
+                    shares.append(1.0 / len(authors) / len(affils))
+
+        self.authors = sorted(author_index, key=author_index.get)
+        self.affils = sorted(affil_index, key=affil_index.get)
+
+        self.paper_ids = np.array(paper_ids, dtype=np.int32)
+        self.author_ids = np.array(author_ids, dtype=np.int32)
+        self.affil_ids = np.array(affil_ids, dtype=np.int32)
+        self.shares = np.array(shares, dtype=np.float64)
+
+
+    def paper_weights(self, age_relev=0.0, age_decay=False):
+        """ Exponential age decay of every paper, as used by simple_search. """
+        if not age_decay:
+            return np.ones(len(self.papers))
+
+        current_year = config.PARAMS['current_year']
+        old_year = config.PARAMS['old_year']
+
+        years = np.clip(self.paper_years, old_year, current_year)
+        return np.exp(-age_relev*(current_year - years))
+
+
+    def affil_scores(self, age_relev=0.0, age_decay=False):
+        """
+        Sum of the (age weighted) paper shares of each affiliation.
+        """
+        weights = self.paper_weights(age_relev, age_decay)[self.paper_ids] * self.shares
+        scores = np.bincount(self.affil_ids, weights=weights, minlength=len(self.affils))
+
+        return dict(zip(self.affils, scores.tolist()))
@@ -7,8 +7,7 @@ Created on Jul 7, 2014
 import chardet
 import numpy as np
 import networkx as nx
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import coo_matrix
 from indexer.indexer import Indexer
 from mymysql import MyMySQL
 from collections import defaultdict
@@ -21,6 +20,7 @@ import logging as log
 import words
 import config
 import utils
+from utils import get_rules_by_lift
 
 
 
@@ -121,37 +121,127 @@ def similarity(d1, d2):
   return sim / dem
 
 
-def get_rules_by_lift(transactions, min_lift=1.0):
+def strip_placeholder(ctx):
   """
-  Get strong rules from transactions and minimum lift provided.
+  Removes the citation placeholder, marked with =-= and -=-, from a context.
   """
-  freqs1 = defaultdict(int)  # Frequencies of 1-itemsets
-  freqs2 = defaultdict(int)  # Frequencies of 2-itemsets
-  for trans in transactions:
-    for i in trans:
-      freqs1[i] += 1
+  beg_idx = ctx.find("=-=")
+  if beg_idx < 0:
+    return ctx
 
-    # If there are at least 2 items, let's compute pairs support
-    if len(trans) >= 2:
-      for i1, i2 in itertools.combinations(trans, 2):
-        freqs2[sorted_tuple(i1, i2)] += 1
+  end_idx = ctx.find("-=-", beg_idx)
+  if end_idx < 0:
+    return ctx[:beg_idx]
 
-  n = float(len(transactions))
+  return ctx[:beg_idx] + ctx[end_idx + 3:]
 
-  # Check every co-occurring ngram
-  rules = []
-  for (i1, i2), f in freqs2.items():
 
-    # Consider only the ones that appear more than once together,
-    # otherwise lift values can be huge and not really significant
-    if f >= 1:
-      lift = f * n / (freqs1[i1] * freqs1[i2])
+def table_version(table, where=None, id_field="paper_id"):
+  """
+  Cheap fingerprint of a table's content (row count and largest id), used to
+  tell whether a cache built from it is stale.
+  """
+  count, max_id = db.select_one(["COUNT(*)", "MAX(%s)" % id_field], table=table, where=where)
+  return "%d\t%s" % (count, max_id)
+
+
+def load_graph_contexts_tfidf(path=config.GRAPH_CTX_TFIDF_PATH, rebuild=False):
+  """
+  Loads the TF-IDF vectors of the citation contexts in the 'graph' table, keyed
+  by edge. The first time they are built from all contexts, fetched in a single
+  query, and saved into <path>. Afterwards they are just memory-mapped.
+
+  As in load_doc_values, the store is rebuilt when the number of contexts or the
+  largest citing id changes. Pass rebuild=True if contexts were edited in place.
+  """
+  where = "context IS NOT NULL"
+  version = table_version("graph", where, id_field="citing")
+  version_path = os.path.join(path, "version.txt")
+
+  cached = None
+  if os.path.exists(version_path):
+    with open(version_path) as f:
+      cached = f.read()
 
-      # Include only values higher than min_lift
-      if lift >= min_lift:
-        rules.append((i1, i2, lift))
+  if rebuild or (cached != version):
+    rows = db.select(fields=["citing", "cited", "context"], table="graph", where=where)
 
-  return rules
+    keys = [words.edge_key(citing, cited) for citing, cited, _ctx in rows]
+    texts = [strip_placeholder(ctx) for _citing, _cited, ctx in rows]
+
+    words.texts_tfidf(keys, texts, min_df=2, max_df=0.5).save(path)
+
+    # Written last, so an interrupted build is redone on the next load
+    with open(version_path, 'w') as f:
+      f.write(version)
+
+    log.debug("TF-IDF of %d citation contexts saved to %s." % (len(keys), path))
+
+  return words.SparseRows.load(path)
+
+
+def load_doc_values(table, item_field, where=None, path=None, rebuild=False):
+  """
+  Loads a paper -> (item, value) table, such as doc_topics, as SparseRows keyed by
+  paper id and with one column per item. The first time the whole table is read
+  in a single streamed scan and saved into 'path' (under config.CACHE_FOLDER by
+  default). Afterwards it's just memory-mapped.
+
+  The cache stores the table's row count and largest paper id (see table_version)
+  and is rebuilt when they no longer match. Changes that keep both (e.g. values
+  updated in place) are not detected, so pass rebuild=True in that case.
+  """
+  if path is None:
+    path = os.path.join(config.CACHE_FOLDER, "%s_%s" % (config.DATASET, table))
+
+  version = table_version(table, where)
+  version_path = os.path.join(path, "version.txt")
+
+  cached = None
+  if os.path.exists(version_path):
+    with open(version_path) as f:
+      cached = f.read()
+
+  if rebuild or (cached != version):
+    query = "SELECT paper_id, %s, value FROM %s" % (item_field, table)
+    if where:
+      query += " WHERE %s" % where
+
+    keys, items = {}, {}
+    rows, cols, values = [], [], []
+    for batch in db.select_stream(query, 100000):
+      for paper_id, item, value in batch:
+        rows.append(keys.setdefault(str(paper_id), len(keys)))
+        cols.append(items.setdefault(unicode(item), len(items)))
+        values.append(value)
+
+    matrix = coo_matrix((np.asarray(values, dtype=np.float64), (rows, cols)),
+                        shape=(len(keys), len(items))).tocsr()
+
+    key_list = sorted(keys, key=keys.get)
+    item_list = sorted(items, key=items.get)
+    words.SparseRows(matrix, key_list, item_list).save(path)
+
+    # Written last, so an interrupted build is redone on the next load
+    with open(version_path, 'w') as f:
+      f.write(version)
+
+    log.debug("%d rows of '%s' cached into %s." % (len(rows), table, path))
+
+  return words.SparseRows.load(path)
+
+
+def iter_doc_values(doc_values, doc_ids):
+  """
+  Yields (doc_id, items, values) for the given papers with at least one item,
+  fetching all their rows in a single lookup.
+  """
+  matrix = doc_values.rows([str(doc_id) for doc_id in doc_ids])
+  for i, doc_id in enumerate(doc_ids):
+    start, end = matrix.indptr[i], matrix.indptr[i + 1]
+    if end > start:
+      items = [doc_values.terms[t] for t in matrix.indices[start:end]]
+      yield doc_id, items, matrix.data[start:end]
 
 
 ########################################
@@ -247,15 +337,26 @@ class ModelBuilder:
     # going to be used (some datasets don't have it available)
     self.use_contexts = (config.DATASET == 'csx')
 
-    # Load vocabulary for the tokens in the citation contexts
-    # if self.use_contexts:
-    #   self.ctxs_vocab, self.nctx = words.read_vocab(config.CTXS_VOCAB_PATH)
+    # TF-IDF vectors of the citation contexts in the 'graph' table and of the ones
+    # computed from the full texts (see words.write_contexts_tfidf), memory-mapped
+    # on first use
+    self.ctxs = None
+    self.file_ctxs = None
+
+    # Paper -> (topic, value) and paper -> (ngram, value) tables, loaded on first use
+    self.doc_values = {}
 
     log.debug("ModelBuilder constructed.")
 
 
-  def query_tfidf(self, query):
-    return words.get_tfidf(query, self.ctxs_vocab, self.nctx)
+  def get_context_similarities(self, ctxs, query, edges):
+    """
+    Cosine similarity between the query and the context of each edge. The contexts
+    of all edges are fetched in one lookup and compared to the query vector with a
+    single sparse matrix-vector product.
+    """
+    query_vec = ctxs.vector(utils.tokenize(query))
+    return ctxs.similarities(query_vec, [words.edge_key(u, v) for u, v in edges])
 
 
   def get_context_based_weights_file(self, query, nodes, edges):
@@ -268,24 +369,13 @@ class ModelBuilder:
     if not self.use_contexts:
       return [(u, v, 1.0) for (u, v) in edges]
 
-    # Load contexts around citations for the provided edges
-    ctxs = self.get_edge_contexts(nodes, edges)
-
-    # Get TF-IDF representation for the query
-    query_vec = self.query_tfidf(query)
+    # Contexts around citations extracted from the full texts
+    if self.file_ctxs is None:
+      self.file_ctxs = words.SparseRows.load(config.CTX_TFIDF_PATH)
 
     # Weights the edges according to the similarity to contexts' similarity to the query
-    weighted_edges = []
-    self.ctx_query_sims = []
-    for u, v in edges:
-      if (u, v) in ctxs:
-        ctx_query_sim = similarity(query_vec, ctxs[(u, v)])
-      else:
-        ctx_query_sim = 0.0
-
-      weighted_edges.append((u, v, ctx_query_sim))
-
-    return weighted_edges
+    sims = self.get_context_similarities(self.file_ctxs, query, edges)
+    return [(u, v, float(sim)) for (u, v), sim in zip(edges, sims)]
 
 
   def get_context_based_weights(self, query, nodes, edges):
@@ -298,38 +388,13 @@ class ModelBuilder:
     if not self.use_contexts:
       return [(u, v, 1.0) for (u, v) in edges]
 
-    ctxs = []
-    for citing, cited in edges :
-      ctx = db.select_one(fields="context",
-                          table="graph",
-                          where="citing='%s' AND cited='%s'" % (citing, cited))
-
-      if ctx == None: ctx = u''
-      # Remove placeholders marked with =-= and -=-
-      beg_idx = ctx.find("=-=")
-      end_idx = ctx.find("-=-", beg_idx) + 3
-
-      ctx = ctx[:beg_idx] + ctx[end_idx:]
-      ctxs.append(ctx)
-
-    # Get the TF_IDF vector representation for the contexts
-    vec = TfidfVectorizer(min_df=2, max_df=0.5, stop_words="english", ngram_range=(1, 3))
-    vctxs = vec.fit_transform(ctxs)
-
-    # Get TF-IDF vector representation for the query (given and returned as a vector)
-    vquery = vec.transform([query])[0]
+    # Contexts stored in the 'graph' table
+    if self.ctxs is None:
+      self.ctxs = load_graph_contexts_tfidf()
 
     # Weights the edges according to the similarity to contexts' similarity to the query
-    weighted_edges = [(citing, cited , cosine_similarity(vquery, vctxs[i])[0][0])
-                      for i, (citing, cited) in enumerate(edges)]
-
-    # print "-- %s --" % query
-    # for i, ctx in enumerate(ctxs):
-    #   print
-    #   print ctx
-    #   print weighted_edges[i][2]
-
-    return weighted_edges
+    sims = self.get_context_similarities(self.ctxs, query, edges)
+    return [(citing, cited, float(sim)) for (citing, cited), sim in zip(edges, sims)]
 
 
   def get_pubs_layer(self, query, n_starting_nodes, n_hops, exclude_list=set()):
@@ -568,6 +633,18 @@ class ModelBuilder:
     return rules
 
 
+  def get_doc_values(self, table, item_field, where=None, name=None, rebuild=False):
+    """
+    Memory-mapped paper -> (item, value) rows of the given table (see load_doc_values).
+    """
+    name = name or table
+    if name not in self.doc_values:
+      path = os.path.join(config.CACHE_FOLDER, "%s_%s" % (config.DATASET, name))
+      self.doc_values[name] = load_doc_values(table, item_field, where, path, rebuild)
+
+    return self.doc_values[name]
+
+
   def get_topics_layer_from_db(self, doc_ids, min_conf_topics):
     """
     Run topic modeling for the content on the given papers and assemble the topic nodes
@@ -580,23 +657,16 @@ class ModelBuilder:
     topic_nodes = set()
     topic_paper_edges = set()
 
-    # Retrieve top topics for each document from the db
+    # Retrieve top topics for each document from the (cached) doc_topics table
     topic_ids_per_doc = []
-    for doc_id in doc_ids:
-
-      topics = db.select(fields=["topic_id", "value"], table="doc_topics", where="paper_id='%s'" % doc_id)
-      if len(topics):
-        topic_ids, topic_values = zip(*topics)
-
-        topic_ids_per_doc.append(topic_ids)
-        # 				topic_values_per_doc.append(topic_values)
+    doc_topics = self.get_doc_values("doc_topics", "topic_id")
+    for doc_id, topic_ids, topic_values in iter_doc_values(doc_topics, doc_ids):
 
-        topic_nodes.update(topic_ids)
-        topic_paper_edges.update([(doc_id, topic_ids[t], topic_values[t]) for t in xrange(len(topic_ids))])
+      topic_ids = map(int, topic_ids)
+      topic_ids_per_doc.append(topic_ids)
 
-      # 		for d in xrange(len(doc_ids)) :
-      # 			topic_ids = topic_ids_per_doc[d]
-      # 			topic_values = topic_values_per_doc[d]
+      topic_nodes.update(topic_ids)
+      topic_paper_edges.update([(doc_id, topic_ids[t], topic_values[t]) for t in xrange(len(topic_ids))])
 
 
     # Normalize edge weights with the maximum value
@@ -746,21 +816,17 @@ class ModelBuilder:
     word_nodes = set()
     paper_word_edges = list()
 
-    doc_ids_str = ",".join(["'%s'" % doc_id for doc_id in doc_ids])
-
     MIN_NGRAM_TFIDF = 0.25
 
-    table = "doc_ngrams"
-    rows = db.select(fields=["paper_id", "ngram", "value"], table=table,
-             where="paper_id IN (%s) AND (value>=%f)" % (doc_ids_str, MIN_NGRAM_TFIDF))
+    doc_ngrams = self.get_doc_values("doc_ngrams", "ngram", where="value>=%f" % MIN_NGRAM_TFIDF)
 
     #
     ngrams_per_doc = defaultdict(list)
-    for doc_id, ngram, value in rows:
-      word_nodes.add(ngram)
-      paper_word_edges.append((str(doc_id), ngram, value))
+    for doc_id, ngrams, values in iter_doc_values(doc_ngrams, doc_ids):
+      word_nodes.update(ngrams)
+      paper_word_edges += zip([str(doc_id)] * len(ngrams), ngrams, values)
 
-      ngrams_per_doc[str(doc_id)].append(ngram)
+      ngrams_per_doc[str(doc_id)] = ngrams
 
     # Get get_rules_by_lift between co-occurring ngrams to create edges between ngrams
     word_word_edges = get_rules_by_lift(ngrams_per_doc.values(), min_lift=min_ngram_lift)
@@ -783,29 +849,25 @@ class ModelBuilder:
     word_nodes = set()
     paper_word_edges = list()
 
-    doc_ids_str = ",".join(["'%s'" % doc_id for doc_id in doc_ids])
-
-    where = "paper_id IN (%s)" % doc_ids_str
+    where = None
     if config.KEYWORDS == "extracted":
-      where += " AND (extracted=1)"
+      where = "(extracted=1)"
 
     elif config.KEYWORDS == "extended":
-      where += " AND (extracted=0) AND (value>=%f)" % config.MIN_NGRAM_TFIDF
+      where = "(extracted=0) AND (value>=%f)" % config.MIN_NGRAM_TFIDF
 
     elif config.KEYWORDS == "both":
-      where += " AND (value>=%f)" % config.MIN_NGRAM_TFIDF
+      where = "(value>=%f)" % config.MIN_NGRAM_TFIDF
 
-    rows = db.select(fields=["paper_id", "ngram"],
-             table="doc_kws",
-             where=where)
+    doc_kws = self.get_doc_values("doc_kws", "ngram", where=where, name="doc_kws_%s" % config.KEYWORDS)
 
     #
     ngrams_per_doc = defaultdict(list)
-    for doc_id, ngram in rows:
-      word_nodes.add(ngram)
-      paper_word_edges.append((str(doc_id), ngram, 1.0))
+    for doc_id, ngrams, _values in iter_doc_values(doc_kws, doc_ids):
+      word_nodes.update(ngrams)
+      paper_word_edges += [(str(doc_id), ngram, 1.0) for ngram in ngrams]
 
-      ngrams_per_doc[str(doc_id)].append(ngram)
+      ngrams_per_doc[str(doc_id)] = ngrams
 
     # Get get_rules_by_lift between co-occurring ngrams to create edges between ngrams
     word_word_edges = get_rules_by_lift(ngrams_per_doc.values(), min_lift=min_ngram_lift)
@@ -1003,30 +1065,6 @@ class ModelBuilder:
     return graph
 
 
-  def parse_tfidf_line(self, line):
-    parts = line.strip().split()
-    tokens = parts[0::2]
-    tfidf = map(float, parts[1::2])
-    return dict(zip(tokens, tfidf))
-
-
-  def get_edge_contexts(self, papers, citation_edges):
-
-    citation_edges = set(citation_edges)
-
-    tokens_per_citation = {}
-    for citing in papers:
-      if os.path.exists(config.CTX_PATH % citing):
-        with open(config.CTX_PATH % citing, "r") as file:
-          for line in file:
-            cited, tokens_tfidf = line.strip().split('\t')
-
-            if (citing, cited) in citation_edges:
-              tokens_per_citation[(citing, cited)] = self.parse_tfidf_line(tokens_tfidf)
-
-    return tokens_per_citation
-
-
   def get_venues_layer(self, pubs):
     """
     Returns the venues' ids and edges from publications to venues according
@@ -3,6 +3,7 @@ Created on Aug 24, 2014
 
 @author: luamct
 '''
+from __future__ import absolute_import
 # from topic_modeling import get_doc_ids
 import os
 from utils import progress
@@ -12,12 +13,13 @@ import random
 import re
 from contexts import contexts
 from collections import Counter, defaultdict
-from utils import tokenize
+from utils import tokenize, tokenize_many
 import nltk
 import utils
-import logging
-import sys
-from config import TOKENS_PATH
+from config import TOKENS_STORE, CTXS_VOCAB_PATH
+from words.token_store import TokenStore
+from words.vocabulary import VocabularyBuilder, read_top_vocab
+from words.tfidf import SparseRows, counts_matrix, texts_counts_matrix, tfidf, idf_weights, top_terms, edge_key
 from sklearn.feature_extraction.text import TfidfVectorizer
 #from scipy.sparse.csr import csr_matrix
 from config import DB_NAME, DB_USER, DB_PASSWD
@@ -52,170 +54,96 @@ def read_line(line) :
 	return (unicode(token, "UTF-8"), int(count))
 
 
-def write_doc_vocab(ids, vocab_path) :
+def write_doc_vocab(ids, vocab_path, store=None) :
+	'''
+	Writes the document and corpus frequencies of the tokens in the given 
+	documents, read from the packed token store.
+	'''
+	if store is None :
+		store = TokenStore(TOKENS_STORE)
 
 	print "Constructing vocabulary for %d documents." % len(ids)
-	nwords = []
-
-	# Define a quick class to use to count the tokens both 
-	class Frequency:
-		def __init__(self):
-			self.doc = 0
-			self.corpus = 0
-
-	# Choose proper path template to get files (full_text or just important parts)
-
-	vocab = defaultdict(Frequency)
-	for i, id in enumerate(ids) :
+	doc_freqs, corpus_freqs, ndocs = store.frequencies(ids)
 
-		with open(TOKENS_PATH % id, 'r') as f :
-			tokens = map(read_line, f.readlines())
-			tokens = filter_tokens(tokens)
-
-#		tokens = Counter(tokenize(text.lower()))
-
-		# Update document frequency for each token. Note that by taking the set of 
-		# the tokens above we ignore multiple occurrences within the document.
-		for token, freq in tokens :
-			vocab[token].doc += 1
-			vocab[token].corpus += freq
-
-		if (i%1000==0) and i :
-			nwords.append((i, float(len(vocab))/1e6))
-			print "%d documents loaded and vocabulary size %d." % (i, len(vocab))
+	# Same filter previously applied to the tokens of each document
+	tokens = filter_tokens([(store.vocab[token_id], token_id) for token_id in np.flatnonzero(doc_freqs)])
 
 	# And the vocabulary of the sample
 	with open(vocab_path, 'w') as f :
 
-		print "Writing %d words to vocabulary." % (len(vocab))
-		print >> f, "%d" % len(tokens)
-		for (token, freq) in vocab.items() :
-			print >> f, "%s\t%d\t%d" % (token.encode("UTF-8"), freq.doc, freq.corpus)
+		print "Writing %d words to vocabulary." % (len(tokens))
+		print >> f, "%d" % ndocs
+		for (token, token_id) in tokens :
+			print >> f, "%s\t%d\t%d" % (token.encode("UTF-8"), doc_freqs[token_id], corpus_freqs[token_id])
 
 
 def read_vocab(tokens_path, min_doc_freq=1, limit=100000) :
 	'''
 	Reads vocabulary and the document ids which created it from file.
 	Also filters tokens on minimum document frequency and keeps only the
-	top 'limit' most frequent tokens to control the dimensionality.
+	top 'limit' most frequent tokens to control the dimensionality. The
+	file is streamed, so only the kept tokens are held in memory.
 	'''
-
-	ntokens = 0
-	corpus_freqs = []
-	docs_freqs = []
-	tokens = []
-	with open(tokens_path, 'r') as f :
-
-		ndocs = int(f.readline().strip())
-		for _lineno, line in enumerate(f.readlines()) :
-
-			token, doc_freq, corpus_freq = line.strip().split()
-			token = unicode(token ,"UTF-8")
-			doc_freq, corpus_freq = int(doc_freq), int(corpus_freq) 
-			ntokens += 1
-
-			# Filter by document frequency
-			if doc_freq >= min_doc_freq :			
-				tokens.append(token)
-				corpus_freqs.append(corpus_freq)
-				docs_freqs.append(doc_freq)
-
-
-	# Only keep the top 'limit' most popular 
-	top_idx = np.argsort(corpus_freqs)[::-1][:limit]
-
-	tokens = {tokens[i]: (docs_freqs[i], corpus_freqs[i]) for i in top_idx}
-
-	logging.info("Vocabulary: %d tokens loaded, but keeping %d tokens."	% (ntokens, len(tokens)))
-	return tokens, ndocs
+	return read_top_vocab(tokens_path, min_doc_freq, limit)
 
 
 
 def dump_words_tfidf(doc_ids, texts, folder, db):
+	'''
+	Computes the TF-IDF matrix of the given texts, saves it into <folder> and
+	writes the TOP_N words of each document into the DB.
+	'''
 
 	# Get vocabulary from cache (or create and dump it)
 	tokens_path = os.path.join(folder, "doc_tokens.txt")
-	vocab, _ndocs = read_vocab(tokens_path, min_doc_freq=10, limit=50000)
+	vocab, ndocs = read_vocab(tokens_path, min_doc_freq=10, limit=50000)
 
 	TOP_N = 10
 
-	words = {}
-	N = float(len(doc_ids))
-	for i in progress(xrange(len(texts)), 1000) :
-
-		text = texts[i]
-		doc_id = doc_ids[i]
+	terms = sorted(vocab)
+	# Document frequencies come from the vocabulary sample, so the IDF uses its size
+	idf = idf_weights([vocab[term][0] for term in terms], ndocs)
 
-#		for text in texts :
-		tokens = Counter(tokenize(text)).items()
+	keys, counts = texts_counts_matrix(doc_ids, texts, terms)
+	matrix = tfidf(counts, idf)
+	SparseRows(matrix, keys, terms, idf).save(os.path.join(folder, "doc_words_tfidf"))
 
-		for token, count in tokens :
+	# Find the most relevant words according to the TF-IDF value and write them in bulk
+	row_values = []
+	for doc_id, (cols, values) in progress(zip(keys, top_terms(matrix, TOP_N)), 1000) :
+		row_values += [(doc_id, terms[col], value) for col, value in zip(cols, values)]
 
-			# Only include if present in vocabulary 
-			if (token in vocab) :
-				tf = int(count)
-				idf = np.log(N/(vocab[token][0]+1.0)) + 1.0
-				words[token] = tf * idf
+		if len(row_values) >= 10000 :
+			db.insert(into="doc_words", fields=["paper_id", "word", "value"], values=row_values)
+			row_values = []
 
-		# Find the most relevant word according to the TF-IDf value
-		top_words = sorted(words.items(), key=lambda (k,v):v, reverse=True)[:TOP_N]
-
-		# And write them into the DB
-		row_values = [(doc_id, word, tfidf) for word, tfidf in top_words]
+	if row_values :
 		db.insert(into="doc_words", fields=["paper_id", "word", "value"], values=row_values)
 
 
-def write_file(doc_id, tokens_tfidf) :
-
-	with open("/data/contexts_tfidfs/%s.txt"%doc_id, "w") as f:
-		for cited, ctx_tfidfs in tokens_tfidf.items() :
-# 			try :
-				tokens_str = ' '.join(["%s %f"%(token.encode("UTF-8"),tfidf) for token,tfidf in ctx_tfidfs])
-				f.write("%s\t%s\n" % (str(cited), tokens_str))
-# 			except Exception, e:
-# 				import traceback
-# 				print traceback.format_exc()
-# 				print tokens_str
-
-
 def write_contexts_vocab(ids, tokens_path) :
 	'''
 	Parses, tokenizes and counts the tokens in the citation contexts of all the documents.
 	A document is this scenario is actually all contexts for some cited document B within 
-	some document A.
+	some document A. Counts are spilled to disk, so memory is bounded.
 	'''
 
 	print "Constructing vocabulary for %d documents." % len(ids)
 
-	ndocs = 0
-	
 	# Keep track of the document frequency and the total corpus frequency
-	doc_freqs = defaultdict(int)
-	corpus_freqs = defaultdict(int)
+	vocab = VocabularyBuilder()
 	for i, id in enumerate(ids) :
 
 		tokens_per_citation = get_tokens_per_citation(id)
 		for tokens in tokens_per_citation.values() :
-			
-			ndocs += 1
-			for token, freq in Counter(tokens).items() :
-				doc_freqs[token]    += 1
-				corpus_freqs[token] += freq
+			vocab.add(tokens)
 
 		if (i%1000==0) and i :
-			print "%d documents processed and vocabulary size %d." % (i, len(doc_freqs))
-
-	
-	# And the vocabulary of the sample
-	with open(tokens_path, 'w') as f :
+			print "%d documents processed." % i
 
-		# First line stores the total number of documents 
-		# that generated this vocabulary
-		print >> f, ndocs
-
-		for token in doc_freqs.keys() :
-			if doc_freqs[token] > 1 :
-				print >> f, "%s\t%d\t%d" % (token.encode("UTF-8"), doc_freqs[token], corpus_freqs[token])
+	# And the vocabulary of the sample. The first line stores the 
+	# total number of documents that generated this vocabulary.
+	vocab.write(tokens_path, min_doc_freq=2)
 
 
 # def read_contexts_vocab(tokens_path) :
@@ -238,38 +166,26 @@ def get_tokens_per_citation(doc_id) :
 
 	text = utils.read_text(doc_id)
 
-	tokens_per_citation = defaultdict(list)
-	ctxs = {}
-	for cited, start, end in citations :
+	# Only process citation if cited paper is known (cited != None)
+	citations = [(cited, start, end) for cited, start, end in citations if cited]
 
-		# Only process citation if cited paper is known (cited != None)
-		if cited:
-			if (start,end) not in ctxs :
-				ctxs[(start,end)] = tokenize( contexts.find_sentence(text, start, end) )
+	# Each context is tokenized once, even if shared by several citations
+	spans = list(set([(start, end) for _cited, start, end in citations]))
+	sentences = [contexts.find_sentence(text, start, end) for start, end in spans]
+	ctxs = dict(zip(spans, tokenize_many(sentences)))
 
-			tokens_per_citation[cited] += ctxs[(start,end)]
+	tokens_per_citation = defaultdict(list)
+	for cited, start, end in citations :
+		tokens_per_citation[cited] += ctxs[(start,end)]
 
 	return tokens_per_citation
 
 
-def get_tfidf(text, vocab, n) :
+def write_contexts_tfidf(path):
 	'''
-	Returns a TF-IDF representation of the given text provided the vocabulary (including 
-	document frequency values) and the total number of documents.
+	Computes the TF-IDF vectors of the citation contexts of every (citing, cited)
+	edge and saves them as a sparse matrix into <path>, with rows keyed by edge.
 	'''
-	tfidf = {}
-	tokens = tokenize(text)
-	for token, tf in Counter(tokens).items() :
-
-		# Only include if present in vocabulary 
-		if (token in vocab) :
-			idf = np.log(float(n)/(vocab[token][0]+1.0)) + 1.0
-			tfidf[token] = tf*idf 
-
-	return tfidf
-
-
-def write_contexts_tfidf(path):
 
 	# Process all available documents
 	
@@ -277,42 +193,30 @@ def write_contexts_tfidf(path):
 	doc_ids = db.select(fields="id", table="tasks", where="status='TOKENIZED'")
 
 	# Get vocabulary from cache (or create and dump it)
-	tokens_path = path + "_tokens.txt"
+	tokens_path = CTXS_VOCAB_PATH
 	if not os.path.exists(tokens_path) :
 		write_contexts_vocab(doc_ids, tokens_path)
 
 	# Load vocabulary from file
 	vocab, n = read_vocab(tokens_path, min_doc_freq=10, limit=50000)
 
-	sys.exit()
-# 	_v = sorted(vocab.items(), key=(lambda (k,(df,cf)): df))
+	terms = sorted(vocab)
+	term_index = {term: i for i, term in enumerate(terms)}
 
-	for doc_id in progress(doc_ids, 100) :
+	def rows() :
+		for doc_id in progress(doc_ids, 100) :
 
-		# For every cited paper in doc_id we get the tokens around that citation
-		tokens_per_citation = get_tokens_per_citation(doc_id)
-
-		tokens_tfidf = defaultdict(list)
-		for cited, tokens in tokens_per_citation.items() :
-
-			counter = Counter(tokens)
-			for token, tf in counter.items():
+			# For every cited paper in doc_id we get the tokens around that citation
+			for cited, tokens in get_tokens_per_citation(doc_id).items() :
 
 				# Only include if present in vocabulary 
-				if (token in vocab) :
-					idf = np.log(float(n)/(vocab[token][0]+1.0)) + 1.0
-					tokens_tfidf[cited].append( (token, tf*idf) )
-
-
-		# Only dump to file if there's something
-		if tokens_tfidf :
-			write_file(doc_id, tokens_tfidf) 
-
-# 		print "\n".join(contexts.values()))
-# 		print '\n'.join(["%15s:\t%s" % (cited, ' '.join(tokens)) for (cited, tokens) in tokens_per_citation.items()])
+				counts = Counter([term_index[token] for token in tokens if token in term_index])
+				if counts :
+					yield edge_key(doc_id, cited), counts.keys(), counts.values()
 
-# 		positions = {doc_id: [(start, end) for _citing, _cited, start, end in citations]}
-# 		contexts = get_contexts(positions)
+	keys, counts = counts_matrix(rows(), len(terms))
+	idf = idf_weights([vocab[term][0] for term in terms], n)
+	SparseRows(tfidf(counts, idf), keys, terms, idf).save(path)
 
 
 def merge(s1, s2):
@@ -12,6 +12,12 @@ import re
 import os
 import random
 
+# Cached tokenizer, shared by every module using utils.tokenize
+from tokens import tokenize, tokenize_many
+
+# Vectorized association rules, shared by the model builders
+from rules import get_rules_by_lift
+
 
 stemmer = nltk.stem.porter.PorterStemmer()
 stopwords = set(nltk.corpus.stopwords.words('english'))
@@ -86,22 +92,6 @@ def get_texts(pub_ids, use_title=True, use_abs=True) :
   return texts
 
 
-def tokenize(text) :
-  """
-  Tokenizes input string using TOKEN_REGEX expression. Sets to lower string, removes
-  english stop words, ignore numerical tokens and stems the output.
-  """
-  tokens = []
-  for token in TOKEN_REGEX.findall(text.lower()) :
-
-    # If not a stop word or a number, apply stemmer and append.
-    if (token not in stopwords) and \
-       (not re.match(NUMBER_REGEX, token)) :
-      tokens.append(stemmer.stem(token))
-
-  return tokens
-
-
 def progress(items, step=1000) :
   '''
   Simple decorator to print progress every <step> iterations.
@@ -0,0 +1,58 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import itertools
+import numpy as np
+from scipy.sparse import csr_matrix, triu
+
+
+def get_rules_by_lift(transactions, min_lift=1.0, min_support=1):
+  """
+  Get strong rules from transactions and minimum lift provided. Every transaction
+  is a row of a sparse binary document x item matrix X, so the support of every
+  pair of items is read from X^T X at once. Pairs found together in less than
+  'min_support' transactions are dropped. Returns a list of (item1, item2, lift),
+  with item1 < item2.
+  """
+  transactions = [set(trans) for trans in transactions]
+  n = len(transactions)
+
+  # Items that can't reach the minimum support can't be in any pair either
+  supports = count_items(transactions)
+  items = sorted([item for item, s in supports.iteritems() if s >= min_support])
+  if len(items) < 2:
+    return []
+
+  index = {item: i for i, item in enumerate(items)}
+
+  cols = [[index[item] for item in trans if item in index] for trans in transactions]
+  lengths = np.array(map(len, cols), dtype=np.int64)
+
+  indptr = np.zeros(n + 1, dtype=np.int64)
+  np.cumsum(lengths, out=indptr[1:])
+  indices = np.fromiter(itertools.chain.from_iterable(cols), dtype=np.int32, count=indptr[-1])
+
+  X = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n, len(items)))
+
+  # Upper triangle of the co-occurrence matrix, so each pair appears once
+  pairs = triu(X.T.dot(X), k=1).tocoo()
+
+  item_supports = np.asarray(X.sum(axis=0)).ravel()
+  lifts = pairs.data * float(n) / (item_supports[pairs.row] * item_supports[pairs.col])
+
+  keep = (pairs.data >= min_support) & (lifts >= min_lift)
+
+  return [(items[i1], items[i2], float(lift))
+          for i1, i2, lift in zip(pairs.row[keep], pairs.col[keep], lifts[keep])]
+
+
+def count_items(transactions):
+  """ Number of transactions each item appears in. """
+  supports = {}
+  for trans in transactions:
+    for item in trans:
+      supports[item] = supports.get(item, 0) + 1
+
+  return supports
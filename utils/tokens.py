@@ -0,0 +1,90 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import re
+import nltk
+import multiprocessing as mp
+
+
+# Only matches tokens with 2 or more characters that are not purely numerical
+FILTERED_TOKEN_REGEX = re.compile(r"(?u)\b(?!\d+\b)\w\w+\b")
+
+
+class StemCache() :
+  '''
+  Bounded memo of the stemmed form of each token. Stop words are stored as
+  None, so a single lookup both filters and stems each token occurrence.
+  It's an approximate LRU with two generations: once the recent generation
+  fills up it replaces the old one, so tokens not used since then are
+  dropped while frequent ones are promoted back on their next use.
+  '''
+
+  def __init__(self, maxsize=500000) :
+    self.maxsize = maxsize
+    self.stemmer = nltk.stem.porter.PorterStemmer()
+    self.stopwords = set(nltk.corpus.stopwords.words('english'))
+
+    self.recent = {}
+    self.old = {}
+
+
+  def stem(self, token) :
+
+    if token in self.recent :
+      return self.recent[token]
+
+    if token in self.old :
+      stem = self.old[token]
+    elif token in self.stopwords :
+      stem = None
+    else :
+      stem = self.stemmer.stem(token)
+
+    if len(self.recent) >= self.maxsize :
+      self.old = self.recent
+      self.recent = {}
+
+    self.recent[token] = stem
+    return stem
+
+
+  def __len__(self) :
+    return len(self.recent) + len(self.old)
+
+
+# Shared by every call in the process (and inherited by forked workers)
+_cache = StemCache()
+
+
+def tokenize(text) :
+  """
+  Tokenizes input string. Sets to lower string, removes english stop words,
+  ignore numerical tokens and stems the output.
+  """
+  stem = _cache.stem
+
+  tokens = []
+  for token in FILTERED_TOKEN_REGEX.findall(text.lower()) :
+    token = stem(token)
+    if token is not None :
+      tokens.append(token)
+
+  return tokens
+
+
+def tokenize_many(texts, nprocs=1, chunksize=100) :
+  '''
+  Tokenizes a list of texts, returning a list of token lists. If <nprocs>
+  is larger than 1, the texts are split among a pool of processes.
+  '''
+  if nprocs <= 1 :
+    return map(tokenize, texts)
+
+  pool = mp.Pool(nprocs)
+  try :
+    return pool.map(tokenize, texts, chunksize)
+  finally :
+    pool.close()
+    pool.join()
@@ -12,7 +12,11 @@ from collections import Counter, defaultdict
 import numpy as np
 import random
 import nltk
+from sklearn.preprocessing import normalize
 from utils import PubTexts
+from config import DATA, DATASET
+import os
+import sys
 
 
 db = MyMySQL(db='csx', user='root', passwd='')
@@ -25,6 +29,9 @@ db = MyMySQL(db='csx', user='root', passwd='')
 
 MAX_KWS = 10
 
+# Document frequencies and processed ids of the incremental keywords extraction
+KWS_STATE_PATH = DATA + "keywords_" + DATASET + "/"
+
 
 
 def get_keywords(min=1) :
@@ -46,35 +53,153 @@ def add_words_to_db(pub_id, kws, values):
 	db.insert(into="doc_kws", fields=["paper_id", "ngram", "value"], values=zip([pub_id]*len(kws), kws, values))
 
 
-def get_frequent_keywords() :
+def stream_pub_texts(db, batch_size, skip=frozenset()) :
+	'''
+	Yields (pub_ids, texts) batches with the title and abstract of the papers,
+	read through a server side cursor. Papers in 'skip' are left out.
+	'''
+	query = "SELECT id, title, abstract FROM papers"
+	for rows in db.select_stream(query, batch_size) :
+		rows = [(str(id), title, abs) for id, title, abs in rows if str(id) not in skip]
+		if rows :
+			yield [id for id, _t, _a in rows], [" ".join([t for t in (title, abs) if t]) for _id, title, abs in rows]
 
-	_freq_kws_, unique_kws = get_keywords(min=5)
-	vocab = unique_kws - set(nltk.corpus.stopwords.words('english'))
-	print "# Keywords:", len(unique_kws)
 
-#	counter = CountVectorizer(ngram_range=(1,2), vocabulary=vocab)
-	counter = TfidfVectorizer(ngram_range=(1,3), vocabulary=vocab, min_df=2, max_df=0.5)
+class KeywordsExtractor() :
+	'''
+	Extracts the top TF-IDF keywords of the papers' titles and abstracts in fixed
+	size batches, so memory doesn't grow with the number of papers. Document
+	frequencies are accumulated in a first pass (and kept in 'folder' along with
+	the processed ids) and the keywords are scored and inserted in a second one.
+	In incremental mode only papers not processed before are read, and their
+	frequencies are added to the stored ones.
+	'''
+
+	def __init__(self, vocab, folder=KWS_STATE_PATH, batch_size=5000, min_df=2, max_df=0.5) :
 
-	pubs = PubTexts()
-	pub_ids = pubs.ids()
-	texts = pubs.texts(pub_ids, use_title=True, use_abs=True)
+		self.folder = folder
+		self.batch_size = batch_size
+		self.min_df = min_df
+		self.max_df = max_df
 
-	del pubs, unique_kws, _freq_kws_
-	ngrams = counter.fit_transform(texts)
+		self.set_vocab(sorted(vocab))
+		self.processed = set()
 
-	print "TfIdf calculated."
-	del texts
 
-	vocab = np.asarray(counter.get_feature_names())
-	for i in xrange(len(pub_ids)):
-#		print texts[i]
-		pub_ngrams = ngrams[i].tocoo()
-		top_ngrams_idx = np.argsort(pub_ngrams.data)[::-1][:MAX_KWS]
-		add_words_to_db(pub_ids[i], vocab[pub_ngrams.col[top_ngrams_idx]], pub_ngrams.data[top_ngrams_idx])
+	def set_vocab(self, vocab) :
 
-#		pub_ngrams[pub_ids[i]] = top_ngrams_idx[:MAX_KWS]
-#		print "\n".join(vocab[top_ngrams_idx])
-#		print
+		# The vocabulary is fixed, so the vectorizer needs no fitting and each
+		# batch can be transformed independently.
+		self.counter = CountVectorizer(ngram_range=(1,3), vocabulary=vocab)
+		self.vocab = np.asarray(self.counter.get_feature_names())
+
+		self.doc_freqs = np.zeros(len(self.vocab), dtype=np.int64)
+		self.ndocs = 0
+
+
+	def load_state(self) :
+		'''
+		Loads the vocabulary, frequencies and processed ids of previous runs, if
+		any. The stored vocabulary is kept so the frequencies remain valid.
+		'''
+		vocab_path = os.path.join(self.folder, "vocab.txt")
+		if not os.path.exists(vocab_path) :
+			return
+
+		with open(vocab_path, 'r') as f :
+			self.set_vocab([unicode(line.rstrip('\n'), "UTF-8") for line in f])
+
+		self.doc_freqs = np.load(os.path.join(self.folder, "doc_freqs.npy"))
+		with open(os.path.join(self.folder, "ids.txt"), 'r') as f :
+			self.processed = set([line.strip() for line in f])
+		self.ndocs = len(self.processed)
+
+
+	def save_state(self, new_ids) :
+		if not os.path.exists(self.folder) :
+			os.makedirs(self.folder)
+
+		with open(os.path.join(self.folder, "vocab.txt"), 'w') as f :
+			f.write(''.join([kw.encode("UTF-8") + '\n' for kw in self.vocab]))
+
+		np.save(os.path.join(self.folder, "doc_freqs.npy"), self.doc_freqs)
+		with open(os.path.join(self.folder, "ids.txt"), 'a') as f :
+			f.write(''.join(["%s\n" % id for id in new_ids]))
+
+
+	def idf(self) :
+		'''
+		Smoothed IDF, as in TfidfVectorizer. Terms outside the [min_df, max_df]
+		range are zeroed so they're never picked.
+		'''
+		idf = np.log((1.0 + self.ndocs) / (1.0 + self.doc_freqs)) + 1.0
+		idf[(self.doc_freqs < self.min_df) | (self.doc_freqs > self.max_df*self.ndocs)] = 0.0
+		return idf
+
+
+	def top_keywords(self, pub_ids, texts, idf) :
+		'''
+		Returns the (paper_id, ngram, value) rows of the MAX_KWS top keywords of
+		each paper, with L2 normalized TF-IDF values.
+		'''
+		x = self.counter.transform(texts).astype(np.float64)
+		x.data *= idf[x.indices]
+		x.eliminate_zeros()
+		x = normalize(x)
+
+		rows = []
+		for i in xrange(len(pub_ids)) :
+			start, end = x.indptr[i], x.indptr[i+1]
+			cols, values = x.indices[start:end], x.data[start:end]
+			top = np.argsort(values)[::-1][:MAX_KWS]
+			rows += zip([pub_ids[i]]*len(top), self.vocab[cols[top]], values[top])
+
+		return rows
+
+
+	def run(self, incremental=False) :
+
+		if incremental :
+			self.load_state()
+		elif os.path.exists(os.path.join(self.folder, "ids.txt")) :
+			os.remove(os.path.join(self.folder, "ids.txt"))
+
+		# Reads with a server side cursor, so writes need their own connection
+		reader = MyMySQL(db='csx', user='root', passwd='')
+
+		# First pass: document frequencies of the new papers
+		skip = frozenset(self.processed)
+		new_ids = []
+		for pub_ids, texts in stream_pub_texts(reader, self.batch_size, skip) :
+			x = self.counter.transform(texts)
+			self.doc_freqs += np.bincount(x.indices, minlength=len(self.vocab))
+			self.ndocs += len(pub_ids)
+			new_ids += pub_ids
+
+		print "Document frequencies updated with %d papers (%d in total)." % (len(new_ids), self.ndocs)
+		idf = self.idf()
+
+		# Second pass: score and write the keywords of the new papers in bulk
+		for pub_ids, texts in stream_pub_texts(reader, self.batch_size, skip) :
+			rows = self.top_keywords(pub_ids, texts, idf)
+
+			db.delete("doc_kws", "paper_id IN (%s)" % ",".join(["'%s'" % id for id in pub_ids]))
+			for i in xrange(0, len(rows), 10000) :
+				db.insert(into="doc_kws", fields=["paper_id", "ngram", "value"], values=rows[i:i+10000])
+
+			print "Keywords written for %d papers." % len(pub_ids)
+
+		reader.close()
+		self.save_state(new_ids)
+
+
+def get_frequent_keywords(incremental=False) :
+
+	_freq_kws_, unique_kws = get_keywords(min=5)
+	vocab = unique_kws - set(nltk.corpus.stopwords.words('english'))
+	print "# Keywords:", len(unique_kws)
+
+	KeywordsExtractor(vocab).run(incremental)
 
 
 #	for pid, (title, abs) in pubs.items()[:10] :
@@ -146,7 +271,7 @@ def classif_missing_kws() :
 
 if __name__ == '__main__':
 
-	get_frequent_keywords()
+	get_frequent_keywords(incremental=("incremental" in sys.argv[1:]))
 #	classif_missing_kws()
 
 
@@ -0,0 +1,247 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from collections import Counter
+from utils import tokenize_many
+
+
+def edge_key(citing, cited) :
+	''' Row key used for the citation contexts of the (citing, cited) edge. '''
+	return "%s\t%s" % (citing, cited)
+
+
+def idf_weights(doc_freqs, ndocs) :
+	'''
+	Same IDF used across the project: log(N/(df+1)) + 1.
+	'''
+	return np.log(float(ndocs)/(np.asarray(doc_freqs, dtype=np.float64)+1.0)) + 1.0
+
+
+def counts_matrix(rows, ncols) :
+	'''
+	Builds a CSR matrix from an iterable of (key, column_ids, counts) rows.
+	Returns the keys, in row order, and the matrix.
+	'''
+	keys, cols, vals, lengths = [], [], [], []
+	for key, row_cols, row_vals in rows :
+		keys.append(key)
+		cols.append(np.asarray(row_cols, dtype=np.int32))
+		vals.append(np.asarray(row_vals, dtype=np.float64))
+		lengths.append(len(row_cols))
+
+	indptr = np.zeros(len(keys)+1, dtype=np.int64)
+	np.cumsum(lengths, out=indptr[1:])
+
+	if keys :
+		cols, vals = np.concatenate(cols), np.concatenate(vals)
+	else :
+		cols, vals = np.zeros(0, dtype=np.int32), np.zeros(0)
+
+	matrix = csr_matrix((vals, cols, indptr), shape=(len(keys), ncols))
+	matrix.sum_duplicates()
+	return keys, matrix
+
+
+def texts_counts_matrix(keys, texts, terms, nprocs=1) :
+	'''
+	Tokenizes the texts and builds their counts matrix over the given terms.
+	'''
+	term_index = {term: i for i, term in enumerate(terms)}
+
+	def rows() :
+		for key, tokens in zip(keys, tokenize_many(texts, nprocs)) :
+			counts = Counter([term_index[t] for t in tokens if t in term_index])
+			yield key, counts.keys(), counts.values()
+
+	return counts_matrix(rows(), len(terms))
+
+
+def texts_tfidf(keys, texts, min_df=1, max_df=1.0, nprocs=1) :
+	'''
+	TF-IDF rows of the given texts, with vocabulary and IDF taken from the texts
+	themselves. Terms found in less than <min_df> texts or in more than a <max_df>
+	fraction of them are dropped.
+	'''
+	tokens = tokenize_many(texts, nprocs)
+
+	doc_freqs = Counter()
+	for doc_tokens in tokens :
+		doc_freqs.update(set(doc_tokens))
+
+	ndocs = len(tokens)
+	terms = sorted([t for t, df in doc_freqs.iteritems() if min_df <= df <= max_df*ndocs])
+	term_index = {term: i for i, term in enumerate(terms)}
+
+	def rows() :
+		for key, doc_tokens in zip(keys, tokens) :
+			counts = Counter([term_index[t] for t in doc_tokens if t in term_index])
+			yield key, counts.keys(), counts.values()
+
+	keys, counts = counts_matrix(rows(), len(terms))
+	idf = idf_weights([doc_freqs[term] for term in terms], ndocs)
+	return SparseRows(tfidf(counts, idf), keys, terms, idf)
+
+
+def tfidf(counts, idf) :
+	'''
+	TF-IDF weighting of a counts matrix, done in place over the non-zeros.
+	'''
+	matrix = csr_matrix(counts, dtype=np.float64, copy=True)
+	matrix.data *= idf[matrix.indices]
+	return matrix
+
+
+def top_terms(matrix, n) :
+	'''
+	Yields, for each row, the column ids and values of its <n> largest entries.
+	'''
+	for i in xrange(matrix.shape[0]) :
+		start, end = matrix.indptr[i], matrix.indptr[i+1]
+		cols, vals = matrix.indices[start:end], matrix.data[start:end]
+		top = np.argsort(vals)[::-1][:n]
+		yield cols[top], vals[top]
+
+
+class SparseRows() :
+	'''
+	Persistent sparse matrix (e.g. TF-IDF vectors) whose rows are looked up by
+	key. It's saved as .npy arrays in a folder and loaded as memory maps, so
+	only the rows actually used are read from disk.
+	'''
+
+	def __init__(self, matrix, keys, terms, idf=None) :
+		'''
+		<matrix> is either a sparse matrix or its (data, indices, indptr) CSR
+		arrays, which are used as they are (e.g. memory maps).
+		'''
+		if isinstance(matrix, tuple) :
+			self.data, self.indices, self.indptr = matrix
+		else :
+			matrix = csr_matrix(matrix)
+			self.data, self.indices, self.indptr = matrix.data, matrix.indices, matrix.indptr
+
+		self.keys = list(keys)
+		self.terms = list(terms)
+		self.idf = idf
+		self.shape = (len(self.keys), len(self.terms))
+
+		self.key_index = {key: i for i, key in enumerate(self.keys)}
+		self.term_index = {term: i for i, term in enumerate(self.terms)}
+
+
+	def save(self, folder) :
+		if not os.path.exists(folder) :
+			os.makedirs(folder)
+
+		np.save(os.path.join(folder, "data.npy"), self.data)
+		np.save(os.path.join(folder, "indices.npy"), self.indices)
+		np.save(os.path.join(folder, "indptr.npy"), self.indptr)
+		if self.idf is not None :
+			np.save(os.path.join(folder, "idf.npy"), self.idf)
+
+		with open(os.path.join(folder, "keys.txt"), 'w') as f :
+			f.write(''.join(["%s\n" % key for key in self.keys]))
+
+		with open(os.path.join(folder, "terms.txt"), 'w') as f :
+			f.write(''.join([term.encode("UTF-8") + '\n' for term in self.terms]))
+
+
+	@staticmethod
+	def load(folder, mmap=True) :
+		mode = 'r' if mmap else None
+		load = lambda name: np.load(os.path.join(folder, name), mmap_mode=mode)
+
+		with open(os.path.join(folder, "keys.txt"), 'r') as f :
+			keys = [line.rstrip('\n') for line in f]
+
+		with open(os.path.join(folder, "terms.txt"), 'r') as f :
+			terms = [unicode(line.rstrip('\n'), "UTF-8") for line in f]
+
+		idf = None
+		if os.path.exists(os.path.join(folder, "idf.npy")) :
+			idf = np.load(os.path.join(folder, "idf.npy"))
+
+		arrays = (load("data.npy"), load("indices.npy"), load("indptr.npy"))
+		return SparseRows(arrays, keys, terms, idf)
+
+
+	def __contains__(self, key) :
+		return key in self.key_index
+
+
+	def row(self, key) :
+		''' Returns the (term ids, values) of the given row, or None if missing. '''
+		if key not in self.key_index :
+			return None
+
+		i = self.key_index[key]
+		start, end = self.indptr[i], self.indptr[i+1]
+		return np.asarray(self.indices[start:end]), np.asarray(self.data[start:end])
+
+
+	def row_dict(self, key) :
+		''' Row as a {term: value} dict, like the old per document text files. '''
+		row = self.row(key)
+		if row is None :
+			return {}
+		return {self.terms[t]: float(v) for t, v in zip(*row)}
+
+
+	def rows(self, keys) :
+		'''
+		Returns a CSR matrix with one row per given key, in the same order.
+		Missing keys get empty rows.
+		'''
+		cols, vals, lengths = [], [], []
+		for key in keys :
+			row = self.row(key)
+			if row is None :
+				lengths.append(0)
+			else :
+				cols.append(row[0])
+				vals.append(row[1])
+				lengths.append(len(row[0]))
+
+		indptr = np.zeros(len(lengths)+1, dtype=np.int64)
+		np.cumsum(lengths, out=indptr[1:])
+
+		if cols :
+			cols, vals = np.concatenate(cols), np.concatenate(vals)
+		else :
+			cols, vals = np.zeros(0, dtype=np.int32), np.zeros(0)
+
+		return csr_matrix((vals, cols, indptr), shape=(len(lengths), self.shape[1]))
+
+
+	def vector(self, tokens) :
+		'''
+		TF-IDF row vector (1 x terms) for the given tokens, using this matrix' IDF.
+		'''
+		counts = Counter([self.term_index[t] for t in tokens if t in self.term_index])
+		cols = np.array(counts.keys(), dtype=np.int32)
+		vals = np.array(counts.values(), dtype=np.float64)
+		if self.idf is not None and len(cols) :
+			vals *= self.idf[cols]
+
+		return csr_matrix((vals, cols, [0, len(cols)]), shape=(1, self.shape[1]))
+
+
+	def similarities(self, vector, keys) :
+		'''
+		Cosine similarity between <vector> (1 x terms) and the rows of the given
+		keys, computed with a single sparse product. Missing rows get 0.
+		'''
+		matrix = self.rows(keys)
+		dots = np.asarray(matrix.dot(vector.T).todense()).ravel()
+		norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+		norms *= np.sqrt(vector.multiply(vector).sum())
+
+		sims = np.zeros(len(keys))
+		valid = (norms > 0)
+		sims[valid] = dots[valid] / norms[valid]
+		return sims
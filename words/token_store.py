@@ -0,0 +1,227 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+
+Packed storage for the per document token counts. Instead of one text
+file per document, the store is a folder with three files:
+
+  vocab.txt : one token per line. The line number is the token id.
+  data.bin  : append-only sequence of (token_id, count) int32 pairs.
+  index.txt : one "doc_id offset length" line per stored document,
+              pointing to its slice of data.bin.
+
+Data is read through a memory map, so both random access by document
+id and full sequential scans avoid reparsing text. Appends are guarded
+by a file lock, so several tokenizer processes can write concurrently.
+If a document is stored more than once, the last entry wins.
+'''
+import os
+import fcntl
+import numpy as np
+from collections import Counter
+
+
+PAIR = np.dtype([('token', '<i4'), ('count', '<i4')])
+
+
+class TokenStore() :
+
+	def __init__(self, folder) :
+		'''
+		Opens (or creates) the store in the given folder.
+		'''
+		if not os.path.exists(folder) :
+			os.makedirs(folder)
+
+		self.folder = folder
+		self.vocab_path = os.path.join(folder, "vocab.txt")
+		self.data_path  = os.path.join(folder, "data.bin")
+		self.index_path = os.path.join(folder, "index.txt")
+		self.lock_path  = os.path.join(folder, "lock")
+
+		# Token strings and their ids
+		self.vocab = []
+		self.token_ids = {}
+
+		# Document id -> (offset, length) in data.bin
+		self.index = {}
+
+		# Bytes already read from the vocab and index files, so only the
+		# entries appended by other processes need to be read again.
+		self._vocab_pos = 0
+		self._index_pos = 0
+
+		self._data = None
+		self._data_size = -1
+
+		self.refresh()
+
+
+	def refresh(self) :
+		''' Reads the vocabulary and index entries appended since the last call. '''
+		if os.path.exists(self.vocab_path) :
+			with open(self.vocab_path, 'r') as f :
+				f.seek(self._vocab_pos)
+				for line in f :
+					# Partially written line. Will be read on the next refresh.
+					if not line.endswith('\n') :
+						break
+					self.token_ids[unicode(line[:-1], "UTF-8")] = len(self.vocab)
+					self.vocab.append(unicode(line[:-1], "UTF-8"))
+					self._vocab_pos += len(line)
+
+		if os.path.exists(self.index_path) :
+			with open(self.index_path, 'r') as f :
+				f.seek(self._index_pos)
+				for line in f :
+					if not line.endswith('\n') :
+						break
+					doc_id, offset, length = line.split()
+					self.index[doc_id] = (int(offset), int(length))
+					self._index_pos += len(line)
+
+
+	def data(self) :
+		''' Memory map of the (token_id, count) pairs. Remapped if the file grew. '''
+		size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+		if size != self._data_size :
+			self._data_size = size
+			if size :
+				self._data = np.memmap(self.data_path, dtype=PAIR, mode='r')
+			else :
+				self._data = np.zeros(0, dtype=PAIR)
+
+		return self._data
+
+
+	def add(self, doc_id, tokens) :
+		'''
+		Stores the token counts of a document. <tokens> is either a list of
+		tokens or a dict-like {token: count}.
+		'''
+		if not hasattr(tokens, "items") :
+			tokens = Counter(tokens)
+
+		with open(self.lock_path, 'a') as lock :
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try :
+				# Other processes may have added tokens in the meantime
+				self.refresh()
+
+				new_tokens = [token for token in tokens if token not in self.token_ids]
+				if new_tokens :
+					with open(self.vocab_path, 'a') as f :
+						f.write(''.join([token.encode("UTF-8") + '\n' for token in new_tokens]))
+					self.refresh()
+
+				pairs = np.array([(self.token_ids[token], count) for token, count in tokens.items()], dtype=PAIR)
+
+				with open(self.data_path, 'ab') as f :
+					offset = f.tell() // PAIR.itemsize
+					f.write(pairs.tobytes())
+
+				with open(self.index_path, 'a') as f :
+					f.write("%s %d %d\n" % (doc_id, offset, len(pairs)))
+
+				self.index[str(doc_id)] = (offset, len(pairs))
+
+			finally :
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+	def __contains__(self, doc_id) :
+		return str(doc_id) in self.index
+
+
+	def __len__(self) :
+		return len(self.index)
+
+
+	def doc_ids(self) :
+		return self.index.keys()
+
+
+	def get(self, doc_id) :
+		'''
+		Returns the token ids and counts of the given document as two arrays.
+		'''
+		offset, length = self.index[str(doc_id)]
+		pairs = self.data()[offset:offset+length]
+		return pairs['token'], pairs['count']
+
+
+	def get_tokens(self, doc_id) :
+		''' Returns the (token, count) pairs of a document, like the old token files. '''
+		token_ids, counts = self.get(doc_id)
+		return [(self.vocab[t], int(c)) for t, c in zip(token_ids, counts)]
+
+
+	def scan(self, doc_ids=None) :
+		'''
+		Yields (doc_id, token_ids, counts) for each given document (all of them
+		if not provided), in the order they were stored in the data file.
+		'''
+		if doc_ids is None :
+			doc_ids = self.index.keys()
+
+		entries = sorted([(self.index[str(d)][0], self.index[str(d)][1], str(d)) for d in doc_ids if str(d) in self.index])
+
+		data = self.data()
+		for offset, length, doc_id in entries :
+			pairs = data[offset:offset+length]
+			yield doc_id, pairs['token'], pairs['count']
+
+
+	def frequencies(self, doc_ids=None, chunk=10000) :
+		'''
+		Returns the document frequency and the corpus frequency of every token
+		in the vocabulary, as arrays indexed by token id, and the number of
+		documents considered.
+		'''
+		self.refresh()
+		nvocab = len(self.vocab)
+		doc_freqs = np.zeros(nvocab, dtype=np.int64)
+		corpus_freqs = np.zeros(nvocab, dtype=np.int64)
+
+		ndocs = 0
+		token_ids, counts = [], []
+		for _doc_id, doc_tokens, doc_counts in self.scan(doc_ids) :
+			token_ids.append(doc_tokens)
+			counts.append(doc_counts)
+			ndocs += 1
+
+			# Token ids are unique within each document, so counting them
+			# gives the document frequency.
+			if len(token_ids) == chunk :
+				t, c = np.concatenate(token_ids), np.concatenate(counts)
+				doc_freqs += np.bincount(t, minlength=nvocab)
+				corpus_freqs += np.bincount(t, weights=c, minlength=nvocab).astype(np.int64)
+				token_ids, counts = [], []
+
+		if token_ids :
+			t, c = np.concatenate(token_ids), np.concatenate(counts)
+			doc_freqs += np.bincount(t, minlength=nvocab)
+			corpus_freqs += np.bincount(t, weights=c, minlength=nvocab).astype(np.int64)
+
+		return doc_freqs, corpus_freqs, ndocs
+
+
+def import_files(doc_ids, path_template, store) :
+	'''
+	Loads the old one file per document token counts (e.g. config.TOKENS_PATH)
+	into the given store.
+	'''
+	for doc_id in doc_ids :
+		path = path_template % doc_id
+		if not os.path.exists(path) :
+			continue
+
+		tokens = {}
+		with open(path, 'r') as f :
+			for line in f :
+				if line.strip() :
+					token, count = line.split()
+					tokens[unicode(token, "UTF-8")] = int(count)
+
+		store.add(doc_id, tokens)
@@ -0,0 +1,149 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import os
+import heapq
+import logging
+import tempfile
+from itertools import groupby
+from collections import Counter, defaultdict
+
+
+def parse_vocab_line(line) :
+	token, doc_freq, corpus_freq = line.rstrip('\n').split('\t')
+	return token, int(doc_freq), int(corpus_freq)
+
+
+class VocabularyBuilder() :
+	'''
+	Counts the document and corpus frequency of the tokens of a stream of
+	documents with bounded memory. Counts are kept in memory until there
+	are <max_tokens> distinct tokens, when they are spilled to disk as a
+	run sorted by token. Runs are merged when the vocabulary is written.
+	'''
+
+	def __init__(self, max_tokens=2000000, tmp_folder=None) :
+		self.max_tokens = max_tokens
+		self.tmp_folder = tmp_folder
+
+		self.doc_freqs = defaultdict(int)
+		self.corpus_freqs = defaultdict(int)
+
+		self.runs = []
+		self.ndocs = 0
+
+
+	def add(self, tokens) :
+		'''
+		Adds a document. <tokens> is either a list of tokens or a dict-like
+		{token: count}.
+		'''
+		if not hasattr(tokens, "items") :
+			tokens = Counter(tokens)
+
+		for token, count in tokens.items() :
+			self.doc_freqs[token] += 1
+			self.corpus_freqs[token] += count
+
+		self.ndocs += 1
+		if len(self.doc_freqs) >= self.max_tokens :
+			self.spill()
+
+
+	def spill(self) :
+		''' Writes the current counts as a sorted run and clears them. '''
+		if not self.doc_freqs :
+			return
+
+		fd, path = tempfile.mkstemp(prefix="vocab_run_", dir=self.tmp_folder)
+		with os.fdopen(fd, 'w') as f :
+			for token in sorted(self.doc_freqs, key=lambda t: t.encode("UTF-8")) :
+				f.write("%s\t%d\t%d\n" % (token.encode("UTF-8"), self.doc_freqs[token], self.corpus_freqs[token]))
+
+		logging.info("Vocabulary run with %d tokens written to %s." % (len(self.doc_freqs), path))
+		self.runs.append(path)
+		self.doc_freqs = defaultdict(int)
+		self.corpus_freqs = defaultdict(int)
+
+
+	def merged(self) :
+		'''
+		Yields (token, doc_freq, corpus_freq) for each token, in token order,
+		merging all runs on the fly. Tokens are UTF-8 encoded strings.
+		'''
+		self.spill()
+
+		files = [open(path, 'r') for path in self.runs]
+		try :
+			entries = heapq.merge(*[(parse_vocab_line(line) for line in f) for f in files])
+			for token, group in groupby(entries, key=lambda e: e[0]) :
+				doc_freq = corpus_freq = 0
+				for _token, df, cf in group :
+					doc_freq += df
+					corpus_freq += cf
+				yield token, doc_freq, corpus_freq
+
+		finally :
+			for f in files :
+				f.close()
+
+
+	def write(self, vocab_path, min_doc_freq=1, valid=None) :
+		'''
+		Writes the vocabulary in the usual format: number of documents in the
+		first line followed by one "token doc_freq corpus_freq" line per token.
+		Tokens below <min_doc_freq> or rejected by <valid>(token) are skipped.
+		Returns the number of tokens written.
+		'''
+		ntokens = 0
+		with open(vocab_path, 'w') as f :
+			print >> f, self.ndocs
+			for token, doc_freq, corpus_freq in self.merged() :
+				if (doc_freq >= min_doc_freq) and (valid is None or valid(unicode(token, "UTF-8"))) :
+					f.write("%s\t%d\t%d\n" % (token, doc_freq, corpus_freq))
+					ntokens += 1
+
+		self.close()
+		return ntokens
+
+
+	def close(self) :
+		''' Removes the temporary runs. '''
+		for path in self.runs :
+			os.remove(path)
+		self.runs = []
+
+
+def read_top_vocab(tokens_path, min_doc_freq=1, limit=100000) :
+	'''
+	Streams a vocabulary file and returns the 'limit' tokens with highest
+	corpus frequency among those with document frequency of at least
+	'min_doc_freq', as {token: (doc_freq, corpus_freq)}, plus the number
+	of documents. Only 'limit' entries are kept in memory at any time.
+	'''
+	ntokens = 0
+	top = []
+	with open(tokens_path, 'r') as f :
+
+		ndocs = int(f.readline().strip())
+		for line in f :
+			token, doc_freq, corpus_freq = line.split()
+			ntokens += 1
+
+			# Filter by document frequency
+			if int(doc_freq) < min_doc_freq :
+				continue
+
+			# Min-heap holding the most frequent tokens seen so far
+			entry = (int(corpus_freq), int(doc_freq), token)
+			if len(top) < limit :
+				heapq.heappush(top, entry)
+			elif entry > top[0] :
+				heapq.heapreplace(top, entry)
+
+	tokens = {unicode(token, "UTF-8"): (doc_freq, corpus_freq) for corpus_freq, doc_freq, token in top}
+
+	logging.info("Vocabulary: %d tokens loaded, but keeping %d tokens."	% (ntokens, len(tokens)))
+	return tokens, ndocs
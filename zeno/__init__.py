@@ -6,4 +6,4 @@ Created on Jun 3, 2014
 import os
 from processor import launch, ProcessorBase
 from task_manager import TasksManager
-
+from supervisor import supervise, Supervisor, RetryTaskException, ReleaseTaskException
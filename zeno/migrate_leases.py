@@ -0,0 +1,64 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import sys
+import MySQLdb
+
+from task_manager import ZENO_DB_NAME
+
+
+# Columns needed by the task leases, retries and backoff
+LEASE_COLUMNS = [("lease_owner", "VARCHAR(128) NULL"),
+								 ("lease_expires", "DATETIME NULL"),
+								 ("retries", "INT NOT NULL DEFAULT 0"),
+								 ("available_after", "DATETIME NULL")]
+
+LEASE_INDEXES = [("state_status", "state, status"),
+								 ("lease_owner", "lease_owner"),
+								 ("status_lease_expires", "status, lease_expires")]
+
+
+def migrate(table, host="localhost", user="root", passwd="") :
+	'''
+	Adds the lease columns and indexes to the tasks <table>. Those already
+	there are skipped, so it's safe to run more than once.
+	'''
+	db = MySQLdb.connect(host=host,
+											user=user,
+											passwd=passwd,
+											db=ZENO_DB_NAME,
+											charset="utf8",
+											unix_socket="/var/run/mysqld/mysqld.sock")
+	cursor = db.cursor()
+
+	cursor.execute("SHOW COLUMNS FROM %s" % table)
+	columns = set([row[0] for row in cursor.fetchall()])
+
+	# Indexes are compared by their columns, whatever their names
+	cursor.execute("SHOW INDEX FROM %s" % table)
+	indexes = {}
+	for row in cursor.fetchall() :
+		indexes.setdefault(row[2], []).append((row[3], row[4]))
+	indexed = set([", ".join([col for _seq, col in sorted(cols)]) for cols in indexes.values()])
+
+	changes  = ["ADD COLUMN %s %s" % (name, definition) for name, definition in LEASE_COLUMNS if name not in columns]
+	changes += ["ADD INDEX %s (%s)" % (name, fields) for name, fields in LEASE_INDEXES if fields not in indexed]
+
+	if changes :
+		cursor.execute("ALTER TABLE %s %s" % (table, ", ".join(changes)))
+		db.commit()
+
+	print "%s: %d changes applied." % (table, len(changes))
+
+	cursor.close()
+	db.close()
+
+
+if __name__ == '__main__':
+
+	tables = sys.argv[1:] if len(sys.argv) > 1 else ["tasks"]
+	for table in tables :
+		migrate(table)
+
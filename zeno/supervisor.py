@@ -0,0 +1,401 @@
+'''
+Created on Oct 18, 2016
+
+@author: luamct
+'''
+import multiprocessing as mp
+from Queue import Empty
+
+import os
+import time
+import signal
+import logging
+import traceback
+
+from task_manager import TasksManager, NothingToProcessException
+
+
+class RetryTaskException(Exception):
+	'''
+	Raised by a worker when the task failed due to a transient problem. The
+	task is retried later (with backoff) and counts towards its retries.
+	'''
+	pass
+
+
+class ReleaseTaskException(Exception):
+	'''
+	Raised by a worker when the task could not be processed for reasons
+	unrelated to the task itself (e.g. request limits). The task is made
+	available again right away and does not count as a retry. If <pause> is
+	given, the rest of the worker's chunk is released as well and the worker
+	sleeps for that many seconds before taking new tasks.
+	'''
+	def __init__(self, message="", pause=0) :
+		Exception.__init__(self, message)
+		self.pause = pause
+
+
+# Messages sent from the workers back to the supervisor
+START, OK, FAILED, RETRY, RELEASE, PAUSE = range(6)
+
+
+def worker(cls, args, wid, task_queue, result_queue, log) :
+	'''
+	Entry point of each worker process. Builds the processor object and
+	calls its process(task_id) method for every task id received through
+	its own <task_queue>, reporting the outcome through <result_queue>. Task
+	ids arrive in chunks, and if the processor has a prefetch(task_ids)
+	method it's called once per chunk to load whatever it needs in bulk.
+	'''
+	# Shutdown is coordinated by the supervisor
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+	parent = os.getppid()
+	proc = cls(**args)
+
+	while True :
+		try :
+			task_ids = task_queue.get(timeout=5)
+		except Empty :
+			# Don't outlive a supervisor that was killed
+			if os.getppid() != parent :
+				break
+			continue
+
+		# Sentinel sent by the supervisor when shutting down
+		if task_ids is None :
+			break
+
+		# Tasks are still processed one by one if the prefetch fails
+		if hasattr(proc, "prefetch") :
+			try :
+				proc.prefetch(task_ids)
+			except Exception :
+				log.exception("Worker %d: prefetch of %d tasks failed." % (wid, len(task_ids)))
+
+		for i, task_id in enumerate(task_ids) :
+			result_queue.put((START, wid, task_id, None, 0.0))
+			start = time.time()
+			try :
+				proc.process(task_id)
+				result_queue.put((OK, wid, task_id, None, time.time()-start))
+
+			except RetryTaskException, e :
+				result_queue.put((RETRY, wid, task_id, str(e), time.time()-start))
+
+			except ReleaseTaskException, e :
+				result_queue.put((RELEASE, wid, task_id, str(e), time.time()-start))
+
+				# Don't sit on the chunk while paused
+				if e.pause :
+					for other_id in task_ids[i+1:] :
+						result_queue.put((RELEASE, wid, other_id, str(e), 0.0))
+					result_queue.put((PAUSE, wid, None, str(e), e.pause))
+
+					log.warn("Worker %d: pausing for %ds (%s)." % (wid, e.pause, e))
+					time.sleep(e.pause)
+					break
+
+			except Exception, e :
+				message = str(e) or traceback.format_exc().splitlines()[-1]
+				result_queue.put((FAILED, wid, task_id, message, time.time()-start))
+
+	if hasattr(proc, "close") :
+		proc.close()
+
+
+class Supervisor() :
+
+	def __init__(self, cls, nprocs, args, group, from_state, to_state, tasks_params={},
+							 batch_size=20, chunk_size=1, queue_size=None, wait=False, report_interval=60, log=None) :
+		'''
+		Drives <nprocs> worker processes of class <cls>. Tasks in <from_state>
+		are leased in batches from the <group> table and pushed to the workers
+		through one queue per worker, so only the supervisor talks to the tasks
+		DB and it always knows which worker holds each task. Successful tasks
+		are moved to <to_state>. Each worker receives up to <chunk_size> ids at
+		a time. If <wait> is True, keeps waiting for new tasks instead of
+		exiting when there's nothing left.
+
+		'args' follows the same convention as zeno.launch: a single dictionary
+		of constructor parameters, or a list with one dictionary per process.
+		'''
+		self.cls = cls
+		self.nprocs = nprocs
+		self.args = args
+		self.from_state = from_state
+		self.to_state = to_state
+		self.batch_size = batch_size
+		self.chunk_size = chunk_size
+		self.wait = wait
+		self.report_interval = report_interval
+
+		# Leasing stops while this many tasks are assigned to the workers and
+		# not finished yet (backpressure)
+		self.queue_size = queue_size or nprocs*chunk_size + 2*max(nprocs*chunk_size, batch_size)
+
+		self.tasks = TasksManager(group, **tasks_params)
+
+		self.task_queues = {}
+		self.result_queue = mp.Queue()
+
+		# Tasks assigned to each worker (queued or being processed), the one
+		# each worker is currently processing and when paused workers resume
+		self.taken = {}
+		self.inflight = {}
+		self.paused = {}
+
+		# Outcomes are accumulated and written to the DB in bulk
+		self.done, self.failed, self.retry, self.release = [], [], [], []
+
+		# Per-worker throughput metrics
+		self.metrics = {}
+
+		self.procs = {}
+		self.stopping = False
+
+		if log is None :
+			log = logging.getLogger("zeno")
+			if not log.handlers :
+				handler = logging.StreamHandler()
+				handler.setFormatter(logging.Formatter('%(asctime)s (%(name)s) [%(levelname)6s]: %(message)s',
+																							 "%Y-%m-%d %H:%M:%S"))
+				log.addHandler(handler)
+				log.setLevel(logging.INFO)
+		self.log = log
+
+
+	def start_worker(self, wid) :
+		''' (Re)starts the worker with the given index. '''
+		if isinstance(self.args, (list, tuple)) :
+			proc_args = self.args[wid]
+		else :
+			proc_args = self.args
+
+		# A worker killed while reading its queue may leave it unusable, so
+		# each (re)started worker gets a new one
+		self.task_queues[wid] = mp.Queue()
+		self.taken[wid] = set()
+
+		proc = mp.Process(target=worker, args=(self.cls, proc_args, wid, self.task_queues[wid], self.result_queue, self.log))
+		proc.start()
+
+		self.procs[wid] = proc
+		self.metrics.setdefault(wid, {'ok': 0, 'failed': 0, 'busy': 0.0, 'restarts': 0})
+
+
+	def stop(self, signum=None, frame=None) :
+		''' Signal handler. Stops leasing and lets the workers finish their current task. '''
+		if not self.stopping :
+			self.log.info("Shutting down...")
+		self.stopping = True
+
+
+	def check_workers(self) :
+		''' 
+		Restarts workers that died unexpectedly, retrying the task they were 
+		processing and giving back every other task assigned to them.
+		'''
+		for wid, proc in self.procs.items() :
+			if proc.is_alive() :
+				continue
+
+			proc.join()
+
+			# Reports sent before it exited are still in the result queue
+			self.collect_results(timeout=0.01)
+
+			task_id = self.inflight.pop(wid, None)
+			if task_id is not None :
+				self.retry.append((task_id, "Worker crashed (exit code %s)" % proc.exitcode))
+
+			self.release += [(t, None) for t in self.taken.pop(wid) if t != task_id]
+
+			# Chunks left in its queue were released above
+			self.task_queues.pop(wid).cancel_join_thread()
+
+			if not self.stopping :
+				self.log.warn("Worker %d died (exit code %s). Restarting." % (wid, proc.exitcode))
+				self.metrics[wid]['restarts'] += 1
+				self.start_worker(wid)
+			else :
+				del self.procs[wid]
+
+
+	def collect_results(self, timeout) :
+		''' Reads the workers' reports until the queue is empty. '''
+		while True :
+			try :
+				kind, wid, task_id, message, elapsed = self.result_queue.get(timeout=timeout)
+			except Empty :
+				break
+
+			# Only the first read may block
+			timeout = 0.01
+
+			if kind == START :
+				self.inflight[wid] = task_id
+				continue
+
+			# The rest of its chunk was released. Chunks queued for it are too.
+			if kind == PAUSE :
+				self.paused[wid] = time.time() + elapsed
+				self.release += [(t, message) for t in self.drain(wid)]
+				continue
+
+			self.inflight.pop(wid, None)
+			self.taken[wid].discard(task_id)
+			self.metrics[wid]['busy'] += elapsed
+
+			if kind == OK :
+				self.done.append(task_id)
+				self.metrics[wid]['ok'] += 1
+			else :
+				self.metrics[wid]['failed'] += 1
+				{FAILED: self.failed, RETRY: self.retry, RELEASE: self.release}[kind].append((task_id, message))
+
+
+	def flush(self) :
+		''' Writes the accumulated outcomes to the tasks DB. '''
+		self.tasks.update_success(self.done, self.to_state)
+		self.tasks.update_error_batch(self.failed)
+		for task_id, message in self.retry :
+			self.tasks.update_retry(task_id, message)
+		for task_id, message in self.release :
+			self.tasks.update_release(task_id, message)
+
+		self.done, self.failed, self.retry, self.release = [], [], [], []
+
+
+	def drain(self, wid) :
+		''' Takes back the chunks still waiting in a worker's queue and returns their ids. '''
+		task_ids = []
+		while True :
+			try :
+				chunk = self.task_queues[wid].get(timeout=0.1)
+			except Empty :
+				break
+
+			# Shutdown sentinel, which must stay last
+			if chunk is None :
+				self.task_queues[wid].put(None)
+				break
+			task_ids += chunk
+
+		self.taken[wid].difference_update(task_ids)
+		return task_ids
+
+
+	def assign(self, task_ids) :
+		''' Queues a chunk for the least loaded worker, preferring those not paused. '''
+		now = time.time()
+		wid = min(self.procs, key=lambda w: (max(self.paused.get(w, 0), now), len(self.taken[w])))
+
+		# Recorded before the worker can take it, so it's never lost if the worker dies
+		self.taken[wid].update(task_ids)
+		self.task_queues[wid].put(task_ids)
+
+
+	def lease(self) :
+		'''
+		Leases more tasks if the workers have room for them. Returns False if
+		there was nothing to process.
+		'''
+		free = self.queue_size - sum([len(t) for t in self.taken.values()])
+		if free < min(self.batch_size, self.queue_size) :
+			return True
+
+		try :
+			task_ids = self.tasks.get_next_batch(self.from_state, free)
+		except NothingToProcessException :
+			return False
+
+		for i in xrange(0, len(task_ids), self.chunk_size) :
+			self.assign(task_ids[i:i+self.chunk_size])
+
+		return True
+
+
+	def report(self, elapsed) :
+		''' Logs the throughput of each worker and the overall one. '''
+		total = 0
+		for wid in sorted(self.metrics) :
+			m = self.metrics[wid]
+			total += m['ok'] + m['failed']
+			self.log.info("Worker %2d: %6d ok, %5d failed, %6.2f tasks/s busy, %d restarts" %
+										(wid, m['ok'], m['failed'], (m['ok']+m['failed'])/max(m['busy'], 1e-6), m['restarts']))
+
+		self.log.info("Total: %d tasks in %.0fs (%.2f tasks/s)" % (total, elapsed, total/max(elapsed, 1e-6)))
+
+
+	def shutdown(self) :
+		'''
+		Releases the tasks still waiting in the queues, waits for the workers to
+		finish their current chunk and writes the last outcomes.
+		'''
+		# Workers exiting from now on are not restarted
+		self.stopping = True
+
+		for wid in self.procs :
+			self.release += [(task_id, None) for task_id in self.drain(wid)]
+			self.task_queues[wid].put(None)
+
+		# Whatever a worker didn't report is released when it exits
+		while self.procs :
+			self.collect_results(timeout=1)
+			self.check_workers()
+
+		self.flush()
+		self.tasks.close()
+
+
+	def run(self) :
+		''' Main supervision loop. '''
+		signal.signal(signal.SIGINT, self.stop)
+		signal.signal(signal.SIGTERM, self.stop)
+
+		for wid in xrange(self.nprocs) :
+			self.start_worker(wid)
+
+		start = last_report = time.time()
+		idle = 1
+		while not self.stopping :
+
+			# Kept for compatibility with the stop file convention
+			if os.path.exists("stop") :
+				self.stop()
+				break
+
+			has_tasks = self.lease()
+			self.collect_results(timeout=0.5)
+			self.check_workers()
+			self.flush()
+			self.tasks.heartbeat()
+
+			# Nothing leased and nothing left to process
+			if not has_tasks and not any(self.taken.values()) :
+				if not self.wait :
+					self.log.info("Nothing to process.")
+					break
+
+				time.sleep(idle)
+				idle = min(2*idle, 30)
+			else :
+				idle = 1
+
+			if (time.time() - last_report) > self.report_interval :
+				self.report(time.time() - start)
+				last_report = time.time()
+
+		self.shutdown()
+		self.report(time.time() - start)
+
+
+def supervise(cls, nprocs, from_state, to_state, args={}, group="tasks", tasks_params={}, **params) :
+	'''
+	Processes every task in <from_state> with <nprocs> supervised instances of
+	<cls>, which must implement a process(task_id) method. See Supervisor.
+	'''
+	Supervisor(cls, nprocs, args, group, from_state, to_state, tasks_params, **params).run()
@@ -4,86 +4,240 @@ Created on Apr 17, 2014
 @author: luamct
 '''
 
+import os
 import sys
+import time
+import uuid
+import socket
+import threading
 import MySQLdb
 
 
 ZENO_DB_NAME = "zeno"
 
+# Default time (in seconds) a leased task is reserved for its owner
+LEASE_TIME = 600
+
+# How often (in seconds) each process looks for expired leases to reclaim
+RECLAIM_INTERVAL = 60
+
+# Tasks whose lease expires (or that are sent to retry) this many times are
+# moved to the dead-letter status instead of becoming available again.
+MAX_RETRIES = 3
+
+# Base of the exponential backoff (in seconds) applied before a retry
+RETRY_BACKOFF = 30
+
+# Leasing requires a few extra columns in the tasks table, added to existing
+# tables by zeno/migrate_leases.py.
+
 
 class NothingToProcessException(Exception):
 	""" Raised when there are no more available pins on the DB """
 	pass
 
 
+class LeaseHeartbeat(threading.Thread):
+	'''
+	Renews the leases of a TasksManager every third of the lease time, from a
+	thread with its own DB connection. This way the leases survive tasks that 
+	take longer than the lease time, as long as the process is alive.
+	'''
+
+	def __init__(self, tasks, lease) :
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.tasks = tasks
+		self.lease = lease
+		self.stopped = threading.Event()
+
+
+	def run(self) :
+		db = self.tasks.connect()
+		try :
+			while not self.stopped.wait(self.lease/3.0) :
+				try :
+					self.tasks.renew_leases(db, self.lease)
+				except MySQLdb.Error, e :
+					sys.stderr.write("Failed to renew the leases of %s: %s\n" % (self.tasks.owner, e))
+		finally :
+			db.close()
+
+
+	def stop(self) :
+		self.stopped.set()
+
+
 class TasksManager:
 
 
 	def __init__(self, group, host="localhost", user="root", passwd="") :
 
-		self.db = MySQLdb.connect(host=host, 
-														user=user, 
-														passwd=passwd, 
-														db=ZENO_DB_NAME,
-														charset="utf8",
-														unix_socket="/var/run/mysqld/mysqld.sock",
-														init_command="SET AUTOCOMMIT=0")
+		self.db_params = dict(host=host, user=user, passwd=passwd)
+		self.db = self.connect()
 
 		# Table used for controlling the access
 		self.table = group
 
+		# Identifies this process as the owner of the leased tasks
+		self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+		# Last time leases were renewed and expired leases were reclaimed
+		self.last_heartbeat = time.time()
+		self.last_reclaim = 0
+
+		# Started with the first lease
+		self.heartbeat_thread = None
+
+
+	def connect(self) :
+		''' Opens a new connection to the tasks DB. '''
+		return MySQLdb.connect(db=ZENO_DB_NAME,
+													charset="utf8",
+													unix_socket="/var/run/mysqld/mysqld.sock",
+													init_command="SET AUTOCOMMIT=0",
+													**self.db_params)
+
 
-	def get_next(self, state):
+	def get_next(self, state, lease=LEASE_TIME):
 		'''
-		Returns one available task.
+		Leases and returns one available task.
 		'''
+		return self.get_next_batch(state, 1, lease)[0]
+
+
+	def get_next_batch(self, state, n, lease=LEASE_TIME):
+		'''
+		Leases up to <n> available tasks at once and returns their ids. The
+		tasks are claimed with a single UPDATE tagged with a unique lease
+		token, so no row lock is held between the select and the update
+		and concurrent workers never block each other for long.
+		'''
+		# Tasks left behind by dead processes are put back from time to time 
+		if (time.time() - self.last_reclaim) > RECLAIM_INTERVAL :
+			self.reclaim_expired()
+
+		token = "%s:%s" % (self.owner, uuid.uuid4().hex[:16])
+
 		cursor = self.db.cursor()
+		query = """UPDATE %s
+							 SET status='IN_PROGRESS', lease_owner='%s',
+							     lease_expires=NOW() + INTERVAL %d SECOND
+							 WHERE state='%s' AND status='AVAILABLE'
+							   AND (available_after IS NULL OR available_after <= NOW())
+							 ORDER BY id DESC LIMIT %d""" % (self.table, token, lease, state, n)
+		leased = cursor.execute(query)
+		self.db.commit()
+		self.last_heartbeat = time.time()
 
-		# Query for next available user using FOR UPDATE to avoid race conditions
-		query = """SELECT id FROM %s
-						 	 WHERE state='%s' AND status='AVAILABLE' 
-						 	 ORDER BY id DESC LIMIT 1 
-						 	 FOR UPDATE""" % (self.table, state)
-		cursor.execute(query)
+		if self.heartbeat_thread is None :
+			self.heartbeat_thread = LeaseHeartbeat(self, lease)
+			self.heartbeat_thread.start()
 
-		result = cursor.fetchone()
-		if (result == None) :
+		if not leased :
+			cursor.close()
 			raise NothingToProcessException()
 
-		# Drop tuple and unicode type 
-		task_id = str(result[0])
+		cursor.execute("SELECT id FROM %s WHERE lease_owner='%s'" % (self.table, token))
+		task_ids = [str(task_id) for (task_id,) in cursor.fetchall()]
+		cursor.close()
+
+		return task_ids
+
 
-		# Mark the account as being processed
+	def heartbeat(self, lease=LEASE_TIME, force=False):
+		'''
+		Renews the lease of every task currently held by this process. Leases
+		are renewed by a LeaseHeartbeat thread once a task is leased, so this
+		is only needed with force, e.g. to extend them with a longer lease. 
+		Otherwise the DB is only touched after a third of the lease time.
+		'''
+		if (not force) and (time.time() - self.last_heartbeat) < (lease/3.0) :
+			return
+
+		self.renew_leases(self.db, lease)
+
+
+	def renew_leases(self, db, lease=LEASE_TIME):
+		''' Renews the leases of this process, through connection <db>. '''
+		cursor = db.cursor()
 		query = """UPDATE %s
-							 SET status='IN_PROGRESS' 
-							 WHERE id='%s'""" % (self.table, task_id)
+							 SET lease_expires=NOW() + INTERVAL %d SECOND
+							 WHERE status='IN_PROGRESS' AND %s""" % (self.table, lease, self._where_owned())
 		cursor.execute(query)
+		db.commit()
+		cursor.close()
 
+		self.last_heartbeat = time.time()
+
+
+	def reclaim_expired(self):
+		'''
+		Puts back tasks whose lease has expired, most likely because the process
+		holding them died. Each reclamation counts as a retry and is delayed by 
+		an exponential backoff. Tasks that exhausted their retries are moved to
+		the 'DEAD' status. Returns the number of reclaimed tasks.
+		'''
+		# MySQL applies the assignments from left to right, so 'retries' must be 
+		# incremented last for the status and backoff to see the previous count.
+		cursor = self.db.cursor()
+		query = """UPDATE %s
+							 SET status=IF(retries+1 >= %d, 'DEAD', 'AVAILABLE'),
+							     available_after=NOW() + INTERVAL %d*POW(2, retries) SECOND,
+							     retries=retries+1, lease_owner=NULL, lease_expires=NULL,
+							     message='Lease expired'
+							 WHERE status='IN_PROGRESS' AND lease_expires < NOW()""" % (self.table, MAX_RETRIES, RETRY_BACKOFF)
+		reclaimed = cursor.execute(query)
 		self.db.commit()
 		cursor.close()
 
-		return task_id
+		self.last_reclaim = time.time()
+		return reclaimed
+
+
+	def _where_ids(self, task_ids):
+		''' WHERE clause matching a single task id or a list of them. '''
+		if isinstance(task_ids, basestring) :
+			return "id='%s'" % task_ids
+
+		return "id IN (%s)" % ",".join(["'%s'" % task_id for task_id in task_ids])
+
+
+	def _where_owned(self):
+		''' 
+		WHERE condition matching the tasks leased by this process. The result
+		of a task whose lease expired and was taken by another process is dropped.
+		'''
+		return "lease_owner LIKE '%s:%%'" % self.owner
+
 
-	
 	def update_task(self, task_id, state=None, status=None, message=None) :
-		''' Update task execution status. '''
+		''' 
+		Update task execution status. <task_id> can also be a list of ids, in 
+		which case all of them are updated with a single query. Only tasks 
+		leased by this process are updated, and their lease is cleared.
+		'''
+		if not isinstance(task_id, basestring) and len(task_id)==0 :
+			return
 
 		sets = {}
 		if state!=None: sets['state'] = state
 		if status!=None: sets['status'] = status
 		if message!=None: sets['message'] = message
 
-		set_clause = ", ".join(['%s="%s"' % (name,value) for name, value in sets.items()])
+		set_clause = ", ".join(['%s="%s"' % (name,value) for name, value in sets.items()] + 
+													 ["lease_owner=NULL", "lease_expires=NULL"])
 
 		cursor = self.db.cursor()
-		query = "UPDATE %s SET %s WHERE id='%s'" % (self.table, set_clause, task_id)
+		query = "UPDATE %s SET %s WHERE %s AND %s" % (self.table, set_clause, self._where_ids(task_id), self._where_owned())
 		cursor.execute(query)
 		self.db.commit()
 		cursor.close()
 
 
 	def update_success(self, task_id, state) :
-		''' Updates task status as successful and ready for next state. '''
+		''' Updates task status (one id or a list) as successful and ready for next state. '''
 
 		self.update_task(task_id, state, 'AVAILABLE')
 
@@ -94,6 +248,46 @@ class TasksManager:
 		self.update_task(task_id, status='FAILED', message=message)
 
 
+	def update_error_batch(self, errors) :
+		''' 
+		Marks several tasks as failed within a single transaction. <errors> 
+		is a list of (task_id, message) pairs.
+		'''
+		if len(errors)==0 :
+			return
+
+		cursor = self.db.cursor()
+		query = "UPDATE " + self.table + " SET status='FAILED', message=%s, lease_owner=NULL, lease_expires=NULL " + \
+						"WHERE id=%s AND lease_owner LIKE %s"
+		cursor.executemany(query, [(message, task_id, self.owner + ":%") for task_id, message in errors])
+		self.db.commit()
+		cursor.close()
+
+
+	def update_retry(self, task_id, message=None) :
+		'''
+		Releases the task (one id or a list) to be attempted again after an
+		exponential backoff, or moves it to the 'DEAD' status if it already
+		exhausted its retries. Use for transient errors (network, timeouts).
+		'''
+		if not isinstance(task_id, basestring) and len(task_id)==0 :
+			return
+
+		message_str = ""
+		if message!=None :
+			message_str = ', message="%s"' % message
+
+		cursor = self.db.cursor()
+		query = """UPDATE %s
+							 SET status=IF(retries+1 >= %d, 'DEAD', 'AVAILABLE'),
+							     available_after=NOW() + INTERVAL %d*POW(2, retries) SECOND,
+							     retries=retries+1, lease_owner=NULL, lease_expires=NULL%s
+							 WHERE %s AND %s""" % (self.table, MAX_RETRIES, RETRY_BACKOFF, message_str, self._where_ids(task_id), self._where_owned())
+		cursor.execute(query)
+		self.db.commit()
+		cursor.close()
+
+
 	def update_release(self, task_id, message=None) :
 		''' 
 		Releases the task to be processed by another process, probably due 
@@ -104,4 +298,8 @@ class TasksManager:
 
 
 	def close(self) :
+		if self.heartbeat_thread is not None :
+			self.heartbeat_thread.stop()
+			self.heartbeat_thread.join()
+
 		self.db.close()